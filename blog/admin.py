@@ -1,9 +1,27 @@
 from django.contrib import admin
+from . import pagecache
 from .models import Category, Tag, Post
+from .renderers import get_renderer
+from .search import get_search_backend
 
 
 class PostAdmin(admin.ModelAdmin):
     list_display = ['title', 'created_time', 'updated_time', 'category', 'author']
+    actions = ['render_selected']
+
+    def render_selected(self, request, queryset):
+        # 所选文章一批交给渲染服务，进程池模式下并行渲染
+        posts = list(queryset.only('id', 'title', 'body', 'excerpt'))
+        for post, result in zip(posts, get_renderer().render_many([post.body for post in posts])):
+            post.render_body(result)
+        Post.objects.bulk_update(posts, ['body_html', 'toc_html', 'body_hash', 'excerpt'])
+        # bulk_update 不发送信号：详情页和列表页（摘要）的缓存、搜索索引都要在这里更新
+        pagecache.bump('list', *['post:%s' % post.pk for post in posts])
+        search = get_search_backend()
+        for post in posts:
+            search.index_post(post)
+        self.message_user(request, '重新渲染了 %d 篇文章' % len(posts))
+    render_selected.short_description = '重新渲染所选文章'
 
 
 # Register your models here.
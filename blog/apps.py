@@ -3,3 +3,11 @@ from django.apps import AppConfig
 
 class BlogConfig(AppConfig):
     name = 'blog'
+
+    def ready(self):
+        # 注册信号处理函数
+        from . import signals  # noqa: F401
+        # 新建的SQLite连接设置WAL等PRAGMA
+        from django.db.backends.signals import connection_created
+        from blogsite.db import configure_sqlite
+        connection_created.connect(configure_sqlite, dispatch_uid='blogsite.db.configure_sqlite')
@@ -0,0 +1,63 @@
+from collections import Counter
+from datetime import datetime
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from .models import ArchiveMonth, Category, Post, Tag
+
+
+def month_of(created_time):
+    local = timezone.localtime(created_time) if timezone.is_aware(created_time) else created_time
+    return local.year, local.month
+
+
+def month_range(year, month):
+    """
+    某月在当前时区的起止时间 [start, end)，无效的年月抛出 ValueError 或 OverflowError
+    """
+    start = timezone.make_aware(datetime(year, month, 1))
+    end = timezone.make_aware(datetime(year + month // 12, month % 12 + 1, 1))
+    return start, end
+
+
+def adjust_month(created_time, delta):
+    year, month = month_of(created_time)
+    if ArchiveMonth.objects.filter(year=year, month=month).update(num_posts=F('num_posts') + delta):
+        return
+    if delta > 0:
+        try:
+            with transaction.atomic():
+                ArchiveMonth.objects.create(year=year, month=month, num_posts=delta)
+        except IntegrityError:
+            # 并发时别的请求已经创建了这个月份
+            ArchiveMonth.objects.filter(year=year, month=month).update(num_posts=F('num_posts') + delta)
+
+
+def adjust_category(category_id, delta):
+    Category.objects.filter(pk=category_id).update(num_posts=F('num_posts') + delta)
+
+
+def adjust_tags(tag_ids, delta):
+    if tag_ids:
+        Tag.objects.filter(pk__in=tag_ids).update(num_posts=F('num_posts') + delta)
+
+
+def rebuild():
+    """
+    根据文章表重新计算全部计数，批量导入数据或修改时区后使用
+    """
+    months = Counter(month_of(created_time) for created_time in
+                     Post.objects.values_list('created_time', flat=True).iterator())
+    category_counts = dict(Post.objects.order_by().values_list('category').annotate(n=Count('pk')))
+    tag_counts = dict(Post.tags.through.objects.order_by().values_list('tag').annotate(n=Count('pk')))
+    with transaction.atomic():
+        ArchiveMonth.objects.all().delete()
+        ArchiveMonth.objects.bulk_create(
+            [ArchiveMonth(year=year, month=month, num_posts=n) for (year, month), n in months.items()])
+        for model, counts in ((Category, category_counts), (Tag, tag_counts)):
+            objs = list(model.objects.only('pk', 'num_posts'))
+            for obj in objs:
+                obj.num_posts = counts.get(obj.pk, 0)
+            model.objects.bulk_update(objs, ['num_posts'], batch_size=500)
@@ -1,5 +1,8 @@
+from django.conf import settings
 from django.contrib.syndication.views import Feed
-from .models import Post
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from .models import Category, Post, Tag
 
 
 class AllPostRssFeed(Feed):
@@ -10,14 +13,52 @@ class AllPostRssFeed(Feed):
     # 显示在聚合阅读器上的描述信息
     description = 'Django 博客教程演示项目测试文章'
 
-    # 需要显示的内容条目
+    def get_queryset(self):
+        # 标题中要显示分类，一次性把分类join进来；描述只用到渲染好的HTML，不加载Markdown正文和目录
+        return Post.objects.select_related('category').summaries('body_html')
+
+    # 需要显示的内容条目，只输出最新的 FEED_ITEM_LIMIT 篇文章
     def items(self):
-        return Post.objects.all()
+        return self.get_queryset()[:settings.FEED_ITEM_LIMIT]
 
     # 聚合器中显示的内容条目的标题
     def item_title(self, item):
         return '[%s] %s' % (item.category, item.title)
 
-    # 聚合器中显示的内容条目的描述
+    # 聚合器中显示的内容条目的描述，使用保存文章时渲染好的HTML
     def item_description(self, item):
-        return item.body
+        return item.body_html or item.excerpt
+
+
+class CategoryPostRssFeed(AllPostRssFeed):
+    def get_object(self, request, pk):
+        return get_object_or_404(Category, pk=pk)
+
+    def title(self, obj):
+        return 'Django 博客教程演示项目 - 分类：%s' % obj.name
+
+    def link(self, obj):
+        return reverse('blog:category', args=[obj.pk])
+
+    def description(self, obj):
+        return '分类“%s”下的文章' % obj.name
+
+    def items(self, obj):
+        return self.get_queryset().filter(category=obj)[:settings.FEED_ITEM_LIMIT]
+
+
+class TagPostRssFeed(AllPostRssFeed):
+    def get_object(self, request, pk):
+        return get_object_or_404(Tag, pk=pk)
+
+    def title(self, obj):
+        return 'Django 博客教程演示项目 - 标签：%s' % obj.name
+
+    def link(self, obj):
+        return reverse('blog:tag', args=[obj.pk])
+
+    def description(self, obj):
+        return '标签“%s”下的文章' % obj.name
+
+    def items(self, obj):
+        return self.get_queryset().filter(tags=obj)[:settings.FEED_ITEM_LIMIT]
@@ -0,0 +1,144 @@
+"""
+按请求抽样的性能记录
+
+被抽中的请求记录总耗时、数据库查询次数和耗时、Markdown渲染、模板渲染和缓存命中情况，
+汇总到 blog.metrics 的直方图里，由 /metrics/ 查看；
+PERF_SERVER_TIMING 打开时（默认只在DEBUG下）还通过 Server-Timing 响应头返回给浏览器的开发者工具。
+没有被抽中的请求只多一次随机数判断，timed/count 也只多一次属性查找
+"""
+import random
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.template.backends.django import DjangoTemplates
+
+from .metrics import metrics
+
+_state = threading.local()
+
+
+class RequestTimings(object):
+    def __init__(self):
+        self.durations = {}
+        self.counts = {}
+
+    def add(self, name, seconds):
+        total, n = self.durations.get(name, (0.0, 0))
+        self.durations[name] = (total + seconds, n + 1)
+
+    def incr(self, name):
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+
+def current():
+    """
+    当前线程正在记录的请求，没有被抽中时为None
+    """
+    return getattr(_state, 'timings', None)
+
+
+@contextmanager
+def timed(name):
+    timings = current()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+def count(name):
+    """
+    进程内计数器加一，被抽中的请求同时记在自己的 Server-Timing 里
+    """
+    metrics.incr(name)
+    timings = current()
+    if timings is not None:
+        timings.incr(name)
+
+
+def record_query(execute, sql, params, many, context):
+    # connection.execute_wrapper 的包装函数，只在被抽中的请求中安装
+    timings = current()
+    if timings is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.add('db', time.perf_counter() - start)
+
+
+class PerformanceMiddleware(object):
+    """
+    按 PERF_SAMPLE_RATE 抽样记录请求，放在 MIDDLEWARE 的第一个以便计入其他中间件的耗时
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= getattr(settings, 'PERF_SAMPLE_RATE', 0):
+            return self.get_response(request)
+        timings = _state.timings = RequestTimings()
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(record_query))
+                response = self.get_response(request)
+        finally:
+            _state.timings = None
+        total = time.perf_counter() - start
+        self.record(request, timings, total)
+        if getattr(settings, 'PERF_SERVER_TIMING', settings.DEBUG):
+            response['Server-Timing'] = self.server_timing(timings, total)
+        return response
+
+    @staticmethod
+    def record(request, timings, total):
+        metrics.incr('requests.sampled')
+        metrics.observe('request', total * 1000)
+        match = getattr(request, 'resolver_match', None)
+        if match is not None:
+            metrics.observe('request:%s' % match.view_name, total * 1000)
+        for name, (seconds, n) in timings.durations.items():
+            metrics.observe(name, seconds * 1000)
+        metrics.incr('db.queries', timings.durations.get('db', (0, 0))[1])
+
+    @staticmethod
+    def server_timing(timings, total):
+        entries = ['total;dur=%.1f' % (total * 1000)]
+        for name, (seconds, n) in sorted(timings.durations.items()):
+            entries.append('%s;dur=%.1f;desc="%d"' % (name, seconds * 1000, n))
+        for name, n in sorted(timings.counts.items()):
+            entries.append('%s;desc="%d"' % (name, n))
+        return ', '.join(entries)
+
+
+class TimedTemplate(object):
+    def __init__(self, template):
+        self.template = template
+        self.origin = template.origin
+
+    def render(self, context=None, request=None):
+        with timed('template'):
+            return self.template.render(context, request)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """
+    记录模板渲染耗时的Django模板引擎，只包装视图直接渲染的模板，include和继承的模板算在里面
+    """
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
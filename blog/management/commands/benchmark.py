@@ -0,0 +1,312 @@
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment, \
+    teardown_test_environment
+from django.urls import reverse
+from django.utils import timezone
+
+from blog import counts
+from blog.models import Category, Post, Tag
+from blog.rendering import body_hash, make_excerpt, render_markdown
+from blog.search import get_search_backend
+from blog.viewcount import view_counter
+from comments.models import Comment
+
+WORDS = ['Django', 'Python', '博客', '模板', '视图', '模型', '缓存', '数据库', '索引', '分页', 'Markdown', '部署',
+         '性能', '查询', '表单', '评论', '标签', '分类', '归档', '测试']
+SEARCH_TERMS = ['Django', '缓存', '数据库 索引', 'Markdown 渲染', '不存在的关键词']
+
+
+class Command(BaseCommand):
+    help = '在临时的SQLite测试数据库中生成模拟数据，测量热点页面的延迟、查询次数和内存分配，结果输出为JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=500, help='文章数量')
+        parser.add_argument('--categories', type=int, default=10, help='分类数量')
+        parser.add_argument('--tags', type=int, default=50, help='标签数量')
+        parser.add_argument('--tags-per-post', type=int, default=3, help='每篇文章的标签数量')
+        parser.add_argument('--comments-per-post', type=int, default=5, help='每篇文章的评论数量')
+        parser.add_argument('--paragraphs', type=int, default=30, help='每篇文章正文的段落数')
+        parser.add_argument('--code-blocks', type=int, default=10, help='每篇文章正文的代码块数')
+        parser.add_argument('--requests', type=int, default=100, help='每个场景测量的请求次数')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='在本进程内同时用测试客户端发起请求的线程数；报告的每秒请求数是这些线程在一个进程内'
+                                 '（受GIL限制、不经过WSGI服务器）的结果，不代表WSGI服务器的吞吐量')
+        parser.add_argument('--alloc-requests', type=int, default=10, help='每个场景测量内存分配的请求次数')
+        parser.add_argument('--page-cache', action='store_true', help='测量时开启整页缓存（默认关闭，测量视图本身的开销）')
+        parser.add_argument('--seed', type=int, default=42, help='随机数种子，保证每次生成的数据相同')
+        parser.add_argument('--output', help='把结果写入这个JSON文件')
+        parser.add_argument('--compare', help='和之前输出的JSON结果比较')
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        setup_test_environment()
+        tmpdir = None
+        if options['concurrency'] > 1 and connection.vendor == 'sqlite':
+            # 多个线程不能共用内存中的测试数据库（共享缓存模式下并发写入会直接报表被锁），
+            # 改用临时文件，和线上一样以WAL模式运行
+            tmpdir = tempfile.TemporaryDirectory()
+            connection.settings_dict['TEST']['NAME'] = os.path.join(tmpdir.name, 'benchmark.sqlite3')
+        old_config = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(VIEW_COUNT_FLUSH_INTERVAL=0, COMMENT_RATE_LIMIT=0, HIGHLIGHT_CACHE_ALIAS='default',
+                                   PAGE_CACHE_ENABLED=options['page_cache']):
+                started = time.perf_counter()
+                self.seed(options)
+                seed_seconds = time.perf_counter() - started
+                results = {name: self.measure(requests, options) for name, requests in self.scenarios()}
+        finally:
+            view_counter.clear()
+            cache.clear()
+            connection.creation.destroy_test_db(old_config, verbosity=0)
+            teardown_test_environment()
+            if tmpdir is not None:
+                tmpdir.cleanup()
+
+        report = {
+            'meta': {
+                'commit': self.git_commit(),
+                'time': timezone.now().isoformat(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'page_cache': options['page_cache'],
+                # 请求由本进程内的测试客户端线程直接调用Django处理，不经过WSGI服务器
+                'load': 'test client, %d thread(s) in one process' % options['concurrency'],
+                'seed_seconds': round(seed_seconds, 3),
+                'scale': {key: options[key] for key in (
+                    'posts', 'categories', 'tags', 'tags_per_post', 'comments_per_post', 'paragraphs', 'code_blocks',
+                    'requests', 'concurrency', 'seed')},
+            },
+            'results': results,
+        }
+        self.print_report(report)
+        if options['compare']:
+            with open(options['compare']) as f:
+                self.print_comparison(json.load(f), report)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+
+    def make_body(self, options):
+        blocks = []
+        for i in range(max(options['paragraphs'], options['code_blocks'])):
+            if i < options['paragraphs']:
+                if i % 10 == 0:
+                    blocks.append('## %s %d' % (random.choice(WORDS), i))
+                blocks.append(' '.join(random.choice(WORDS) for _ in range(60)))
+            if i < options['code_blocks']:
+                lines = ['def handler_%d(request, pk):' % i] + [
+                    '    value_%d = Post.objects.filter(pk=pk).count() + %d' % (n, n) for n in range(15)]
+                blocks.append('```python\n%s\n```' % '\n'.join(lines))
+        return '\n\n'.join(blocks)
+
+    def seed(self, options):
+        user = User.objects.create_user('benchmark', 'benchmark@example.com', 'benchmark')
+        # SQLite的bulk_create不会回填主键，插入后重新查询
+        Category.objects.bulk_create([Category(name='分类 %d' % i) for i in range(options['categories'])])
+        Tag.objects.bulk_create([Tag(name='标签 %d' % i) for i in range(options['tags'])])
+        categories = list(Category.objects.all())
+        tags = list(Tag.objects.all())
+
+        # 只渲染少量不同的正文然后重复使用，避免生成数据的时间被Markdown渲染占满
+        bodies = []
+        for _ in range(min(options['posts'], 20)):
+            body = self.make_body(options)
+            html, toc = render_markdown(body)
+            bodies.append((body, html, toc))
+
+        now = timezone.now()
+        posts = []
+        for i in range(options['posts']):
+            body, html, toc = random.choice(bodies)
+            created_time = now - timezone.timedelta(hours=i * 7)
+            posts.append(Post(
+                title='%s %s 第%d篇' % (random.choice(WORDS), random.choice(WORDS), i), body=body,
+                body_html=html, toc_html=toc, body_hash=body_hash(body), excerpt=make_excerpt(html),
+                created_time=created_time, updated_time=created_time,
+                category=random.choice(categories), author=user, views=random.randint(0, 1000),
+                comment_count=options['comments_per_post'],
+            ))
+        Post.objects.bulk_create(posts)
+        post_pks = list(Post.objects.values_list('pk', flat=True))
+
+        through = Post.tags.through
+        links = []
+        for pk in post_pks:
+            for tag in random.sample(tags, min(options['tags_per_post'], len(tags))):
+                links.append(through(post_id=pk, tag_id=tag.pk))
+        through.objects.bulk_create(links)
+        Comment.objects.bulk_create([
+            Comment(name='读者 %d' % n, email='reader%d@example.com' % n, url='http://example.com',
+                    text='评论内容 %d' % n, post_id=pk)
+            for pk in post_pks for n in range(options['comments_per_post'])
+        ])
+        get_search_backend().rebuild(Post.objects.only('id', 'title', 'body', 'body_html').iterator())
+        # bulk_create 不发送信号，归档、分类和标签的文章数需要统一计算
+        counts.rebuild()
+        self.post_pks = post_pks
+        self.category_pks = [category.pk for category in categories]
+        self.tag_pks = [tag.pk for tag in tags]
+
+    def scenarios(self):
+        """
+        每个场景返回一个函数，调用时用测试客户端发起一次请求
+        """
+        pages = max(1, len(self.post_pks) // settings.PAGE_NUM)
+
+        def index(client):
+            return client.get(reverse('blog:index'), {'page': random.randint(1, pages)})
+
+        def detail(client):
+            return client.get(reverse('blog:detail', args=[random.choice(self.post_pks)]))
+
+        def category(client):
+            return client.get(reverse('blog:category', args=[random.choice(self.category_pks)]))
+
+        def tag(client):
+            return client.get(reverse('blog:tag', args=[random.choice(self.tag_pks)]))
+
+        def search(client):
+            return client.get(reverse('blog:search'), {'q': random.choice(SEARCH_TERMS)})
+
+        def rss(client):
+            return client.get(reverse('blog:rss'))
+
+        def post_comment(client):
+            return client.post(reverse('comments:post_comment', args=[random.choice(self.post_pks)]), {
+                'name': '压测', 'email': 'bench@example.com', 'url': 'http://example.com', 'text': '压测评论',
+            })
+
+        return [
+            ('IndexView', index),
+            ('PostDetailView', detail),
+            ('CategoryView', category),
+            ('TagView', tag),
+            ('search', search),
+            ('AllPostRssFeed', rss),
+            ('post_comment', post_comment),
+        ]
+
+    def measure(self, request, options):
+        client = Client()
+        cache.clear()
+        # 预热：导入模块、编译模板、填充侧边栏缓存
+        for _ in range(3):
+            request(client)
+
+        latencies = []
+        queries = []
+        statuses = set()
+        lock = threading.Lock()
+
+        def run(count):
+            # 每个线程用自己的测试客户端；connection 会取到当前线程自己的数据库连接
+            thread_client = Client() if options['concurrency'] > 1 else client
+            for _ in range(count):
+                with CaptureQueriesContext(connection) as ctx:
+                    started = time.perf_counter()
+                    response = request(thread_client)
+                    elapsed = (time.perf_counter() - started) * 1000
+                with lock:
+                    latencies.append(elapsed)
+                    queries.append(len(ctx.captured_queries))
+                    statuses.add(response.status_code)
+
+        concurrency = max(1, min(options['concurrency'], options['requests']))
+        counts = [options['requests'] // concurrency + (i < options['requests'] % concurrency)
+                  for i in range(concurrency)]
+        started = time.perf_counter()
+        if concurrency == 1:
+            run(counts[0])
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                list(pool.map(run, counts))
+        wall_seconds = time.perf_counter() - started
+
+        allocated = []
+        peaks = []
+        for _ in range(options['alloc_requests']):
+            tracemalloc.start()
+            request(client)
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            allocated.append(sum(stat.size for stat in snapshot.statistics('filename')))
+            peaks.append(peak)
+
+        latencies.sort()
+        return {
+            'status_codes': sorted(statuses),
+            'latency_ms': {
+                'mean': round(statistics.mean(latencies), 3),
+                'p50': round(self.percentile(latencies, 50), 3),
+                'p90': round(self.percentile(latencies, 90), 3),
+                'p99': round(self.percentile(latencies, 99), 3),
+                'max': round(latencies[-1], 3),
+            },
+            'queries': {'mean': round(statistics.mean(queries), 2), 'max': max(queries)},
+            'in_process_rps': round(len(latencies) / wall_seconds, 1) if wall_seconds else None,
+            'alloc_bytes': {
+                'retained_mean': int(statistics.mean(allocated)) if allocated else None,
+                'peak_mean': int(statistics.mean(peaks)) if peaks else None,
+            },
+        }
+
+    @staticmethod
+    def percentile(values, percent):
+        if not values:
+            raise CommandError('没有测量到任何请求')
+        index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+        return values[index]
+
+    @staticmethod
+    def git_commit():
+        try:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                                           stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def print_report(self, report):
+        self.stdout.write('%-16s %10s %10s %10s %10s %10s %12s' % (
+            '场景', 'p50(ms)', 'p99(ms)', '进程内请求/秒', '查询/次', '查询max', '峰值内存(KB)'))
+        for name, result in report['results'].items():
+            self.stdout.write('%-16s %10.2f %10.2f %10.1f %10.2f %10d %12.1f' % (
+                name, result['latency_ms']['p50'], result['latency_ms']['p99'], result.get('in_process_rps') or 0,
+                result['queries']['mean'], result['queries']['max'], (result['alloc_bytes']['peak_mean'] or 0) / 1024.0))
+        self.stdout.write('进程内请求/秒：本进程内 %d 个线程用测试客户端直接调用Django的结果，不是WSGI服务器的吞吐量'
+                          % report['meta']['scale']['concurrency'])
+
+    def print_comparison(self, baseline, report):
+        self.stdout.write('\n与 %s 比较（正数表示变慢/变多）' % (baseline['meta'].get('commit') or '基线'))
+        for name, result in report['results'].items():
+            old = baseline['results'].get(name)
+            if old is None:
+                continue
+            self.stdout.write('%-16s p50 %+7.1f%%  p99 %+7.1f%%  查询 %+.2f' % (
+                name,
+                self.change(old['latency_ms']['p50'], result['latency_ms']['p50']),
+                self.change(old['latency_ms']['p99'], result['latency_ms']['p99']),
+                result['queries']['mean'] - old['queries']['mean'],
+            ))
+
+    @staticmethod
+    def change(old, new):
+        return (new - old) / old * 100 if old else 0.0
@@ -0,0 +1,47 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.http.request import validate_host
+
+from blog import staticsite
+from blogsite.db import use_primary
+
+
+class Command(BaseCommand):
+    help = '把首页、文章详情、归档、分类、标签、RSS和sitemap.xml预先生成静态文件，默认只重新生成上次以来变化的文章影响到的页面'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=settings.STATIC_SITE_ROOT, help='输出目录')
+        parser.add_argument('--full', action='store_true', help='忽略上次的状态，全部重新生成')
+        parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='并行生成页面的进程数')
+        parser.add_argument('--chunk-size', type=int, default=50, help='每个进程每次领取的页面数量')
+        parser.add_argument('--host', help='请求页面时使用的域名，必须在ALLOWED_HOSTS中，默认取ALLOWED_HOSTS中的第一个')
+        parser.add_argument('--base-url', help='sitemap中的网站地址，例如 https://www.zmrenwu.com')
+
+    # 先读后写的命令全部走主库，副本有延迟时不会按旧数据写入
+    @use_primary()
+    def handle(self, *args, **options):
+        host = self.get_host(options['host'])
+        try:
+            result = staticsite.build(
+                options['output'], host, options['base_url'] or 'http://%s' % host,
+                jobs=options['jobs'], full=options['full'], chunk_size=options['chunk_size'],
+            )
+        except staticsite.BuildError as e:
+            raise CommandError('生成静态页面失败：%s' % e)
+        self.stdout.write(self.style.SUCCESS('%s生成了 %d 个页面，删除了 %d 个页面，输出目录 %s' % (
+            '全量' if result.full else '增量', result.rendered, result.removed, options['output'])))
+
+    @staticmethod
+    def get_host(host):
+        # 和Django检查请求域名的规则相同：DEBUG下ALLOWED_HOSTS为空时允许本机
+        allowed = settings.ALLOWED_HOSTS
+        if settings.DEBUG and not allowed:
+            allowed = ['.localhost', '127.0.0.1', '[::1]']
+        host = host or next((host.lstrip('.') for host in allowed if host != '*'), None)
+        if host is None:
+            raise CommandError('ALLOWED_HOSTS 中没有可用的域名，请用 --host 指定')
+        if not validate_host(host, allowed):
+            raise CommandError('%s 不在 ALLOWED_HOSTS 中，生成的每个页面都会是400' % host)
+        return host
@@ -0,0 +1,68 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from blog.models import ArchiveMonth, Category, Post, Tag
+from blog.views import with_list_relations
+from comments.models import Comment
+
+# SQLite的查询计划中，没有用到索引的 SCAN 就是全表扫描
+FULL_SCAN_RE = re.compile(r'\bSCAN (?:TABLE )?(\w+)(?!.*\bUSING (?:COVERING )?INDEX\b)')
+TEMP_SORT_RE = re.compile(r'USE TEMP B-TREE FOR (ORDER BY|DISTINCT|GROUP BY)')
+
+
+def hot_queries():
+    """
+    返回 (名称, 查询集, 允许全表扫描的表) 列表，和视图、模板标签、评论视图中实际执行的查询保持一致
+    归档月份、分类和标签表很小，侧边栏读取它们时允许扫描
+    """
+    now = timezone.now()
+    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    posts = with_list_relations(Post.objects.all())
+    return [
+        ('IndexView 本页文章', posts[:10], ()),
+        ('IndexView 游标分页', posts.filter(
+            Q(created_time__lt=now) | Q(created_time=now, pk__lt=1)).order_by('-created_time', '-pk')[:10], ()),
+        ('ArchivesView', posts.filter(created_time__gte=month_start, created_time__lt=now)[:10], ()),
+        ('CategoryView', posts.filter(category=1)[:10], ()),
+        ('TagView', posts.filter(tags=1)[:10], ()),
+        ('PostDetailView', Post.objects.filter(pk=1), ()),
+        ('PostDetailView 标签', Tag.objects.filter(post=1), ()),
+        ('评论分页', Comment.objects.filter(post=1, pk__gt=0).order_by('pk')[:21], ()),
+        ('get_recent_posts', Post.objects.order_by('-created_time')[:10], ()),
+        ('archives', ArchiveMonth.objects.filter(num_posts__gt=0), ('blog_archivemonth',)),
+        ('get_categories', Category.objects.filter(num_posts__gt=0), ('blog_category',)),
+        ('get_tags', Tag.objects.filter(num_posts__gt=0), ('blog_tag',)),
+        ('AllPostRssFeed', Post.objects.select_related('category')[:20], ()),
+        ('按名称查找分类', Category.objects.filter(name='Django'), ()),
+        ('按名称查找标签', Tag.objects.filter(name='Django'), ()),
+    ]
+
+
+class Command(BaseCommand):
+    help = '对热点查询执行 EXPLAIN QUERY PLAN，出现全表扫描时以非零状态退出'
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('目前只支持解析SQLite的查询计划')
+        failures = []
+        for name, queryset, allow_scan in hot_queries():
+            plan = queryset.explain()
+            scans = [table for table in FULL_SCAN_RE.findall(plan) if table not in allow_scan]
+            sorts = TEMP_SORT_RE.findall(plan)
+            if scans:
+                failures.append(name)
+                status = self.style.ERROR('全表扫描: %s' % ', '.join(scans))
+            elif sorts:
+                status = self.style.WARNING('临时排序: %s' % ', '.join(sorts))
+            else:
+                status = self.style.SUCCESS('OK')
+            self.stdout.write('%s  %s' % (name, status))
+            if options['verbosity'] > 1:
+                for line in plan.splitlines():
+                    self.stdout.write('    %s' % line)
+        if failures:
+            raise CommandError('%d 个查询存在全表扫描: %s' % (len(failures), ', '.join(failures)))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from blog import transfer
+
+
+class Command(BaseCommand):
+    help = '把全部文章导出成JSON Lines文件或Markdown目录，可以再用 import_posts 导入'
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', help='输出的 .jsonl 文件，或者 --format markdown 时的输出目录')
+        parser.add_argument('--format', choices=['jsonl', 'markdown'], default='jsonl', help='导出格式')
+        parser.add_argument('--batch-size', type=int, default=500, help='每批从数据库读取的文章数量')
+
+    def handle(self, *args, **options):
+        records = transfer.export_records(options['batch_size'])
+        if options['format'] == 'markdown':
+            count = transfer.write_markdown_dir(records, options['target'])
+        else:
+            count = transfer.write_jsonl(records, options['target'])
+        self.stdout.write(self.style.SUCCESS('导出了 %d 篇文章到 %s' % (count, options['target'])))
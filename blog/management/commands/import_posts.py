@@ -0,0 +1,33 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from blog import transfer
+from blogsite.db import use_primary
+
+
+class Command(BaseCommand):
+    help = '从JSON Lines文件或Markdown目录批量导入文章，格式见 blog/transfer.py'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='.jsonl 文件或存放 .md 文件的目录')
+        parser.add_argument('--author', help='没有写作者的文章使用的默认作者（用户名）')
+        parser.add_argument('--batch-size', type=int, default=500, help='每批写入数据库的文章数量')
+        parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='渲染Markdown的进程数')
+        parser.add_argument('--no-render', action='store_true',
+                            help='不渲染正文，之后用 python manage.py render_posts 补上')
+
+    # 先读后写的命令全部走主库，副本有延迟时不会按旧数据写入
+    @use_primary()
+    def handle(self, *args, **options):
+        if not os.path.exists(options['source']):
+            raise CommandError('%s 不存在' % options['source'])
+        importer = transfer.Importer(
+            author=options['author'], batch_size=options['batch_size'],
+            jobs=options['jobs'], render=not options['no_render'],
+        )
+        try:
+            result = importer.run(transfer.read_records(options['source']))
+        except ValueError as e:
+            raise CommandError('导入中止，已导入 %d 篇：%s' % (importer.imported, e))
+        self.stdout.write(self.style.SUCCESS('导入了 %d 篇文章，新建 %d 个分类、%d 个标签' % result))
@@ -0,0 +1,78 @@
+import json
+import os
+import re
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# python -X importtime 输出的每一行：import time: 自身耗时(us) | 累计耗时(us) | 缩进表示层级的模块名
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+# 在子进程中执行：导入入口模块并加载URL配置，和web进程处理第一个请求前做的事情相同
+CHILD_CODE = '''
+import json, time
+started = time.perf_counter()
+import {module}
+from django.urls import get_resolver
+get_resolver().url_patterns
+print(json.dumps({{'seconds': time.perf_counter() - started}}))
+'''
+
+
+def parse_importtime(output):
+    """
+    解析 -X importtime 的输出，返回 [(模块名, 自身耗时ms, 累计耗时ms, 层级)]
+    """
+    modules = []
+    for line in output.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match:
+            own, cumulative, indent, name = match.groups()
+            modules.append((name, int(own) / 1000, int(cumulative) / 1000, len(indent) // 2))
+    return modules
+
+
+class Command(BaseCommand):
+    help = '在新的Python进程中导入WSGI入口并加载URL配置，按模块报告导入耗时，用于排查worker启动慢'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--module', default=settings.WSGI_APPLICATION.rsplit('.', 1)[0],
+                            help='入口模块，默认为 WSGI_APPLICATION 所在的模块')
+        parser.add_argument('--limit', type=int, default=25, help='显示耗时最多的模块数量')
+        parser.add_argument('--sort', choices=['self', 'cumulative'], default='self',
+                            help='按模块自身的导入耗时还是包含子模块的累计耗时排序')
+        parser.add_argument('--prefix', action='append', default=[],
+                            help='只显示以此开头的模块，可以指定多个，例如 --prefix blog --prefix comments')
+        parser.add_argument('--warm-up', action='store_true', help='同时执行启动预热（blog/warmup.py），计入总耗时')
+        parser.add_argument('--json', action='store_true', help='以JSON输出')
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'blogsite.settings'),
+                   DJANGO_WARM_UP='1' if options['warm_up'] else '0')
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', CHILD_CODE.format(module=options['module'])],
+            cwd=settings.BASE_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+        )
+        if process.returncode:
+            raise CommandError('导入 %s 失败：\n%s' % (options['module'], process.stderr[-2000:]))
+        seconds = json.loads(process.stdout.strip().splitlines()[-1])['seconds']
+        modules = parse_importtime(process.stderr)
+        if options['prefix']:
+            modules = [m for m in modules if m[0].startswith(tuple(options['prefix']))]
+        modules.sort(key=lambda m: m[1] if options['sort'] == 'self' else m[2], reverse=True)
+        modules = modules[:options['limit']]
+
+        if options['json']:
+            self.stdout.write(json.dumps({
+                'module': options['module'],
+                'startup_ms': round(seconds * 1000, 1),
+                'modules': [{'name': name, 'self_ms': own, 'cumulative_ms': cumulative}
+                            for name, own, cumulative, level in modules],
+            }, ensure_ascii=False, indent=2))
+            return
+        self.stdout.write('%s 导入及加载URL配置共 %.1fms%s' % (
+            options['module'], seconds * 1000, '（含预热）' if options['warm_up'] else ''))
+        self.stdout.write('%10s %10s  %s' % ('自身ms', '累计ms', '模块'))
+        for name, own, cumulative, level in modules:
+            self.stdout.write('%10.1f %10.1f  %s' % (own, cumulative, name))
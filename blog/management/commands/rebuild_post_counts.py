@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from blog import counts, sidebar
+from blogsite.db import use_primary
+
+
+class Command(BaseCommand):
+    help = '重新计算按月归档、分类和标签的文章数'
+
+    # 先读后写的命令全部走主库，副本有延迟时不会按旧数据写入
+    @use_primary()
+    def handle(self, *args, **options):
+        counts.rebuild()
+        sidebar.invalidate()
+        self.stdout.write(self.style.SUCCESS('文章计数已重建'))
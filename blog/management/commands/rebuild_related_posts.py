@@ -0,0 +1,21 @@
+import os
+
+from django.core.management.base import BaseCommand
+from blog import related
+from blogsite.db import use_primary
+
+
+class Command(BaseCommand):
+    help = '重新计算全部文章的相关文章'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                            help='并行计算的进程数，默认为CPU核数')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='每个进程一次计算的文章数')
+
+    # 先读后写的命令全部走主库，副本有延迟时不会按旧数据写入
+    @use_primary()
+    def handle(self, *args, **options):
+        rows = related.rebuild(jobs=options['jobs'], chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS('相关文章已重建，共 %d 条' % rows))
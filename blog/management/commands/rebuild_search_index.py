@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from blog.models import Post
+from blog.search import get_search_backend
+from blogsite.db import use_primary
+
+
+class Command(BaseCommand):
+    help = '重建文章的全文搜索索引'
+
+    # 先读后写的命令全部走主库，副本有延迟时不会按旧数据写入
+    @use_primary()
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        posts = Post.objects.only('id', 'title', 'body', 'body_html').order_by('pk').iterator()
+        with transaction.atomic():
+            backend.rebuild(posts)
+        self.stdout.write(self.style.SUCCESS('已使用 %s 重建搜索索引' % type(backend).__name__))
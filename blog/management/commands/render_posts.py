@@ -0,0 +1,52 @@
+import os
+
+from django.core.management.base import BaseCommand
+from blog import pagecache
+from blog.models import Post
+from blog.renderers import InlineRenderer, PoolRenderer
+from blog.search import get_search_backend
+from blogsite.db import use_primary
+
+
+class Command(BaseCommand):
+    help = '重新渲染文章正文的HTML、目录和空缺的摘要（修改Markdown扩展或批量导入后用于回填）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='忽略摘要值，重新渲染全部文章')
+        parser.add_argument('--batch-size', type=int, default=200, help='每批写回数据库的文章数量')
+        parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='渲染Markdown的进程数')
+
+    # 先读后写的命令全部走主库，副本有延迟时不会按旧数据写入
+    @use_primary()
+    def handle(self, *args, **options):
+        force = options['force']
+        batch_size = options['batch_size']
+        batch = []
+        rendered = 0
+        # 每批文章在进程池中并行渲染，单篇超时或过大时写入转义后的原文，见 blog/renderers.py
+        renderer = PoolRenderer(max_workers=options['jobs']) if options['jobs'] > 1 else InlineRenderer()
+        with renderer:
+            # 只取渲染需要的字段，用iterator避免一次性把全部文章加载到内存
+            queryset = Post.objects.only('id', 'title', 'body', 'body_hash', 'excerpt').order_by('pk')
+            for post in queryset.iterator(chunk_size=batch_size):
+                if not force and not post.needs_render() and post.excerpt:
+                    continue
+                batch.append(post)
+                if len(batch) >= batch_size:
+                    rendered += self.flush(batch, renderer)
+            rendered += self.flush(batch, renderer)
+        self.stdout.write(self.style.SUCCESS('共重新渲染了 %d 篇文章' % rendered))
+
+    def flush(self, batch, renderer):
+        count = len(batch)
+        if count:
+            for post, result in zip(batch, renderer.render_many([post.body for post in batch])):
+                post.render_body(result)
+            Post.objects.bulk_update(batch, ['body_html', 'toc_html', 'body_hash', 'excerpt'])
+            # bulk_update 不发送信号：详情页和列表页（摘要）的缓存、搜索索引都要在这里更新
+            pagecache.bump('list', *['post:%s' % post.pk for post in batch])
+            search = get_search_backend()
+            for post in batch:
+                search.index_post(post)
+            batch.clear()
+        return count
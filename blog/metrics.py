@@ -0,0 +1,106 @@
+import bisect
+import threading
+from collections import Counter
+
+# 直方图的桶上界（毫秒），最后一个桶收集超过5秒的值
+HISTOGRAM_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+
+class Histogram(object):
+    """
+    固定分桶的耗时直方图，分位数按所在桶的上界估算
+    """
+
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def snapshot(self):
+        def bound(value):
+            return '+Inf' if value == float('inf') else value
+
+        return {
+            'count': self.count,
+            'sum_ms': round(self.total, 3),
+            'mean_ms': round(self.total / self.count, 3) if self.count else None,
+            'p50_ms': bound(self.quantile(0.5)),
+            'p90_ms': bound(self.quantile(0.9)),
+            'p99_ms': bound(self.quantile(0.99)),
+            'buckets': {'le_%s' % bound(value): n for value, n in zip(self.buckets, self.counts)},
+        }
+
+
+class Metrics(object):
+    """
+    进程内的简单计数器和耗时直方图，比如缓存命中/未命中次数、抽样请求的各阶段耗时
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = Counter()
+        self._histograms = {}
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self._counters[name] += n
+
+    def get(self, name):
+        with self._lock:
+            return self._counters[name]
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def histogram(self, name):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            return histogram.snapshot() if histogram else None
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def report(self):
+        """
+        计数器、由 xxx.hit / xxx.miss 计数器算出的命中率，以及全部直方图
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {name: histogram.snapshot() for name, histogram in self._histograms.items()}
+        rates = {}
+        for name, hits in counters.items():
+            if name.endswith('.hit'):
+                prefix = name[:-len('.hit')]
+                total = hits + counters.get(prefix + '.miss', 0)
+                rates[prefix + '.hit_rate'] = round(hits / total, 4) if total else None
+        return {'counters': counters, 'rates': rates, 'histograms': histograms}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+metrics = Metrics()
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0002_auto_20190425_0932'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='body_hash',
+            field=models.CharField(blank=True, editable=False, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='body_html',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='toc_html',
+            field=models.TextField(blank=True, editable=False),
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations, transaction
+from django.db.utils import OperationalError
+
+
+def create_fts_table(apps, schema_editor):
+    # 只有SQLite且编译了FTS5时才创建全文索引表，否则搜索会回退到纯Python索引
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS blog_post_fts USING fts5(title, body, tokenize = 'unicode61')"
+            )
+    except OperationalError:
+        pass
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS blog_post_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0003_post_rendered_body'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:41
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_comment_count(apps, schema_editor):
+    Post = apps.get_model('blog', 'Post')
+    Comment = apps.get_model('comments', 'Comment')
+    db_alias = schema_editor.connection.alias
+    counts = Comment.objects.using(db_alias).filter(post=OuterRef('pk')).order_by().values('post') \
+        .annotate(c=Count('pk')).values('c')
+    Post.objects.using(db_alias).update(comment_count=Coalesce(Subquery(counts, output_field=models.IntegerField()), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0004_post_fts'),
+        ('comments', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_comment_count, migrations.RunPython.noop),
+    ]
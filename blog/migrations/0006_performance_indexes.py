@@ -0,0 +1,31 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0005_post_comment_count'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='category',
+            name='name',
+            field=models.CharField(db_index=True, max_length=32),
+        ),
+        migrations.AlterField(
+            model_name='tag',
+            name='name',
+            field=models.CharField(db_index=True, max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['created_time', 'id'], name='post_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['category', 'created_time'], name='post_category_created_idx'),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:30
+
+from collections import Counter
+
+from django.db import migrations, models
+from django.db.models import Count
+from django.utils import timezone
+
+
+def backfill_post_counts(apps, schema_editor):
+    Post = apps.get_model('blog', 'Post')
+    Category = apps.get_model('blog', 'Category')
+    Tag = apps.get_model('blog', 'Tag')
+    ArchiveMonth = apps.get_model('blog', 'ArchiveMonth')
+    db_alias = schema_editor.connection.alias
+    months = Counter()
+    for created_time in Post.objects.using(db_alias).values_list('created_time', flat=True).iterator():
+        local = timezone.localtime(created_time) if timezone.is_aware(created_time) else created_time
+        months[local.year, local.month] += 1
+    ArchiveMonth.objects.using(db_alias).bulk_create(
+        [ArchiveMonth(year=year, month=month, num_posts=n) for (year, month), n in months.items()])
+    for category_id, n in Post.objects.using(db_alias).order_by().values_list('category').annotate(n=Count('pk')):
+        Category.objects.using(db_alias).filter(pk=category_id).update(num_posts=n)
+    for tag_id, n in Post.tags.through.objects.using(db_alias).order_by().values_list('tag').annotate(n=Count('pk')):
+        Tag.objects.using(db_alias).filter(pk=tag_id).update(num_posts=n)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0006_performance_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='num_posts',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='num_posts',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.CreateModel(
+            name='ArchiveMonth',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField()),
+                ('month', models.PositiveSmallIntegerField()),
+                ('num_posts', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['-year', '-month'],
+                'unique_together': {('year', 'month')},
+            },
+        ),
+        migrations.RunPython(backfill_post_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+import re
+
+from django.db import migrations
+from django.utils.html import strip_tags
+
+# 分词规则复制自当时的 blog/search.py，迁移的结果不随以后分词的修改而变化
+CJK_CHARS = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+TOKEN_RE = re.compile(r'[%s]+|[^\W_%s]+' % (CJK_CHARS, CJK_CHARS))
+CJK_RE = re.compile(r'[%s]' % CJK_CHARS)
+
+
+def tokenize(text):
+    # 连续的中日韩字符切成二元组并加入每个单字，其它文字按字母数字切词
+    tokens = []
+    for word in TOKEN_RE.findall(text.lower()):
+        if CJK_RE.match(word) and len(word) > 1:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+            tokens.extend(word)
+        else:
+            tokens.append(word)
+    return tokens
+
+
+def fts_row(post):
+    body = strip_tags(post.body_html) if post.body_html else post.body
+    return post.pk, ' '.join(tokenize(post.title)), ' '.join(tokenize(body))
+
+
+def fill_fts_table(apps, connection):
+    Post = apps.get_model('blog', 'Post')
+    posts = Post.objects.using(connection.alias).only('id', 'title', 'body', 'body_html').order_by('pk')
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM blog_post_fts')
+        cursor.executemany(
+            'INSERT INTO blog_post_fts (rowid, title, body) VALUES (%s, %s, %s)',
+            [fts_row(post) for post in posts.iterator()],
+        )
+
+
+def reindex_fts_table(apps, schema_editor):
+    # 迁移0004只创建了空的索引表，'auto' 模式一检测到索引表就改用FTS5，已有文章的数据库升级后搜什么都是0条；
+    # 这里按现在的分词（加入了中日韩单字）填充。没有索引表时使用纯Python索引，什么都不用做
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite' and 'blog_post_fts' in connection.introspection.table_names():
+        fill_fts_table(apps, connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0008_related_posts'),
+    ]
+
+    operations = [
+        migrations.RunPython(reindex_fts_table, migrations.RunPython.noop),
+    ]
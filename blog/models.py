@@ -1,7 +1,9 @@
-import markdown
 from django.db import models
 from django.contrib.auth.models import User
-from django.utils.html import strip_tags
+from django.urls import reverse
+from .renderers import get_renderer
+from .rendering import EXCERPT_LENGTH, body_hash, make_excerpt
+from .viewcount import view_counter
 
 
 class Category(models.Model):
@@ -14,7 +16,9 @@ class Category(models.Model):
     Django 内置的全部类型可查看文档：
     https://docs.djangoproject.com/en/1.10/ref/models/fields/#field-types
     """
-    name = models.CharField(max_length=32)
+    name = models.CharField(max_length=32, db_index=True)
+    # 该分类下的文章数，由blog/counts.py在文章变化时增量维护
+    num_posts = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.name
@@ -25,16 +29,50 @@ class Tag(models.Model):
     标签Tag也比较简单，和Category一样
     再次强调一定要继承models.Model
     """
-    name = models.CharField(max_length=64)
+    name = models.CharField(max_length=64, db_index=True)
+    # 该标签下的文章数，由blog/counts.py在文章标签变化时增量维护
+    num_posts = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.name
 
 
+class ArchiveMonth(models.Model):
+    """
+    按月归档的文章数，相当于 Post.objects.dates('created_time', 'month') 的物化结果
+    月份按 TIME_ZONE 设置的时区计算，由blog/counts.py在文章变化时增量维护
+    """
+    year = models.PositiveSmallIntegerField()
+    month = models.PositiveSmallIntegerField()
+    num_posts = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return '%s年%s月' % (self.year, self.month)
+
+    class Meta:
+        ordering = ['-year', '-month']
+        unique_together = ['year', 'month']
+
+
+# 列表页、侧边栏和RSS用不到的大字段，一篇长文章的正文和渲染结果可能有几百KB
+LIST_DEFERRED_FIELDS = ('body', 'body_html', 'toc_html')
+
+
+class PostQuerySet(models.QuerySet):
+    def summaries(self, *keep):
+        """
+        列表用的轻量查询：不加载正文、正文HTML和目录，keep 中的字段除外（比如RSS需要body_html）
+        模板里如果用到了被推迟的字段，每篇文章会多一次查询，测试中的查询次数断言可以发现这种情况
+        """
+        return self.defer(*[name for name in LIST_DEFERRED_FIELDS if name not in keep])
+
+
 class Post(models.Model):
     """
     文章的数据库表稍微复杂一点，主要是涉及的字段更多
     """
+    objects = PostQuerySet.as_manager()
+
     # 文章标题
     title = models.CharField(max_length=128)
     # 文章正文，我们使用TextField
@@ -62,31 +100,88 @@ class Post(models.Model):
     author = models.ForeignKey(User, on_delete=models.CASCADE)
     # 新增views字段用于记录阅读量
     views = models.PositiveIntegerField(default=0)
+    # 渲染好的正文HTML和文章目录，以及渲染时正文的摘要值
+    # 只有正文发生变化（摘要值不一致）时才会重新渲染，详情页直接使用渲染结果
+    body_html = models.TextField(blank=True, editable=False)
+    toc_html = models.TextField(blank=True, editable=False)
+    body_hash = models.CharField(max_length=40, blank=True, editable=False)
+    # 评论数，评论新增和删除时由comments应用的信号维护，列表页和详情页不用再COUNT评论表
+    comment_count = models.PositiveIntegerField(default=0, editable=False)
 
     def increase_views(self):
+        # 阅读量先累加到内存缓冲里，由viewcount模块定期批量写回数据库
         self.views += 1
-        self.save(update_fields=['views'])
+        view_counter.incr(self.pk)
+
+    def needs_render(self):
+        return self.body_hash != body_hash(self.body)
+
+    def render_body(self, result=None):
+        """
+        渲染正文并更新body_html、toc_html、body_hash三个字段，不会保存到数据库
+        没有填写摘要时顺便从渲染结果中截取摘要，不需要为了摘要再单独渲染一次
+        result 是批量渲染（见 blog/renderers.py 的 render_many）已经得到的结果，返回使用的渲染结果
+        """
+        result = result or get_renderer().render(self.body)
+        self.body_html, self.toc_html = result.html, result.toc
+        # 渲染超时或出错时显示的是转义后的原文，不记录摘要值，下次保存或重新渲染时再试；
+        # 正文过大时结果不会变，记下摘要值
+        self.body_hash = body_hash(self.body) if result.status in ('ok', 'too_large') else ''
+        if not self.excerpt and result.status == 'ok':
+            self.excerpt = make_excerpt(self.body_html)
+        elif not self.excerpt:
+            self.excerpt = self.body[:EXCERPT_LENGTH]
+        return result
 
     # 文章摘要
-    def save(self,*args, **kwargs):
-        # 如果没有填写摘要
-        if not self.excerpt:
-            # 首先实例化一个Markdown类，用于渲染body的文本
-            md = markdown.Markdown(
-                extensions=[
-                    'markdown.extensions.extra',
-                    'markdown.extensions.codehilite',
-                ]
-            )
-            # 先将Markdown文本渲染成HTML文本
-            # strip_tags去掉Html文本的全部HTML标签
-            # 从文本摘取前54个字符赋给excerpt
-            self.excerpt = strip_tags(md.convert(self.body))[:54]
+    def save(self, *args, render=True, **kwargs):
+        """
+        render=False 时跳过渲染（比如批量导入），正文的HTML和摘要留给
+        python manage.py render_posts 批量生成，或者在详情页第一次被访问时生成
+        """
+        update_fields = kwargs.get('update_fields')
+        # 正文有变化时重新渲染，只更新部分字段（比如阅读量）时不需要渲染
+        if render and (update_fields is None or 'body' in update_fields) and self.needs_render():
+            self.render_body()
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'body_html', 'toc_html', 'body_hash', 'excerpt'}
+        elif render and not self.excerpt and self.body_html:
+            # 正文没变但摘要被清空了，直接从已有的渲染结果中截取
+            self.excerpt = make_excerpt(self.body_html)
         # 调用父类的save方法将数据保存到数据库中
         super(Post, self).save(*args, **kwargs)
 
     def __str__(self):
         return self.title
 
+    def get_absolute_url(self):
+        return reverse('blog:detail', kwargs={'pk': self.pk})
+
     class Meta:
         ordering = ['-created_time']
+        indexes = [
+            # 首页、归档、最新文章和RSS按创建时间排序，id用于游标分页时区分相同的创建时间
+            models.Index(fields=['created_time', 'id'], name='post_created_idx'),
+            # 分类页按分类过滤后再按创建时间排序
+            models.Index(fields=['category', 'created_time'], name='post_category_created_idx'),
+        ]
+
+
+class RelatedPost(models.Model):
+    """
+    预先计算好的相关文章，每篇文章保存最相关的几篇及相似度，由blog/related.py维护
+    """
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='related_entries')
+    related = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+
+    def __str__(self):
+        return '%s -> %s' % (self.post_id, self.related_id)
+
+    class Meta:
+        ordering = ['-score']
+        unique_together = ['post', 'related']
+        indexes = [
+            # 详情页按文章取相似度最高的几篇，一次索引查询
+            models.Index(fields=['post', '-score'], name='related_post_score_idx'),
+        ]
@@ -0,0 +1,111 @@
+import hashlib
+import re
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from .instrumentation import count
+
+# 页面缓存的内容版本号，以微秒时间戳表示最近一次变化的时间，由信号更新：
+#   list     任何文章、分类、标签或评论变化，列表页依赖它
+#   sidebar  任何文章、分类、标签变化，所有带侧边栏的页面和RSS依赖它
+#   post:pk  某篇文章本身或它的评论变化，文章详情页依赖它
+VERSION_KEY = 'blog:version:%s'
+PAGE_KEY = 'blog:page:%s'
+CSRF_TOKEN_RE = re.compile(r'(name="csrfmiddlewaretoken" value=")[^"]*(")')
+CSRF_PLACEHOLDER = '__CSRF_TOKEN__'
+
+
+def bump(*names):
+    now = int(time.time() * 1000000)
+    cache.set_many({VERSION_KEY % name: now for name in names}, None)
+
+
+def get_versions(names):
+    keys = [VERSION_KEY % name for name in names]
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        # 版本号被缓存淘汰了，当作刚刚发生过变化
+        now = int(time.time() * 1000000)
+        for key in missing:
+            cache.add(key, now, None)
+        versions.update(cache.get_many(missing))
+    return [versions.get(key, 0) for key in keys]
+
+
+def list_versions(request, *args, **kwargs):
+    return get_versions(['list'])
+
+
+def post_versions(request, *args, **kwargs):
+    return get_versions(['sidebar', 'post:%s' % kwargs.get('pk')])
+
+
+def feed_versions(request, *args, **kwargs):
+    # RSS里没有评论，评论变化时不需要重新生成
+    return get_versions(['sidebar'])
+
+
+def is_cacheable(request):
+    # 只缓存匿名读者的GET请求，带着会话cookie的请求（比如已登录的管理员）直接交给视图处理
+    if not getattr(settings, 'PAGE_CACHE_ENABLED', True):
+        return False
+    return request.method in ('GET', 'HEAD') and settings.SESSION_COOKIE_NAME not in request.COOKIES
+
+
+def page_cache(versions_func, on_hit=None):
+    """
+    整页缓存装饰器
+    缓存键由完整URL和页面依赖的内容版本号组成，内容变化后版本号改变，旧缓存自然失效；
+    同时根据版本号生成ETag和Last-Modified，浏览器的条件请求命中时直接返回304
+    页面中的CSRF令牌在缓存时替换成占位符，每次返回时再填入当前读者的令牌
+    on_hit 在命中缓存（包括304）时调用，比如给文章记一次阅读量
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if not is_cacheable(request):
+                return view(request, *args, **kwargs)
+            versions = versions_func(request, *args, **kwargs)
+            digest = hashlib.md5(('%s|%s' % (request.get_full_path(), versions)).encode('utf-8')).hexdigest()
+            etag = 'W/"%s"' % digest
+            last_modified = max(versions) // 1000000
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is not None:
+                count('page_cache.not_modified')
+                if on_hit is not None:
+                    on_hit(request, *args, **kwargs)
+                return response
+            cached = cache.get(PAGE_KEY % digest)
+            if cached is not None:
+                count('page_cache.hit')
+                content, content_type = cached
+                response = HttpResponse(content.replace(CSRF_PLACEHOLDER, get_token(request)), content_type=content_type)
+                if on_hit is not None:
+                    on_hit(request, *args, **kwargs)
+            else:
+                count('page_cache.miss')
+                response = view(request, *args, **kwargs)
+                if hasattr(response, 'render') and callable(response.render):
+                    response.render()
+                if response.status_code != 200:
+                    return response
+                content = CSRF_TOKEN_RE.sub(r'\g<1>%s\g<2>' % CSRF_PLACEHOLDER, response.content.decode(response.charset))
+                cache.set(PAGE_KEY % digest, (content, response['Content-Type']),
+                          getattr(settings, 'PAGE_CACHE_TIMEOUT', 600))
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+            patch_cache_control(response, max_age=0, must_revalidate=True)
+            return response
+
+        return wrapped
+
+    return decorator
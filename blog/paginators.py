@@ -0,0 +1,129 @@
+from datetime import datetime, timedelta
+
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.http import Http404
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_cursor(post):
+    """
+    游标由文章的创建时间（微秒时间戳）和id组成，例如 1556155920000000-42
+    """
+    return '%d-%d' % ((post.created_time - EPOCH) // timedelta(microseconds=1), post.pk)
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, pk = cursor.split('-')
+        return EPOCH + timedelta(microseconds=int(timestamp)), int(pk)
+    except (ValueError, OverflowError):
+        raise Http404('无效的分页游标')
+
+
+class CountedPaginator(Paginator):
+    """
+    总数由调用者传入（来自物化的计数，见 blog/sidebar.py），不再执行 COUNT(*)，
+    没有传入时和 Paginator 一样查询数据库
+    """
+
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True, count=None):
+        super().__init__(object_list, per_page, orphans=orphans, allow_empty_first_page=allow_empty_first_page)
+        self.known_count = count
+
+    @cached_property
+    def count(self):
+        if self.known_count is not None:
+            return self.known_count
+        return super().count
+
+
+class CursorPage(object):
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def next_cursor(self):
+        return encode_cursor(self.object_list[-1]) if self.object_list and self.has_next() else None
+
+    def previous_cursor(self):
+        return encode_cursor(self.object_list[0]) if self.object_list and self.has_previous() else None
+
+
+class CursorPaginator(object):
+    """
+    基于 (created_time, id) 的游标分页，翻到多深都只需要一次带索引条件的查询，
+    不再需要 OFFSET 和 COUNT(*)
+    after 参数取某一文章之后（更早）的一页，before 参数取某一文章之前（更新）的一页，
+    同一个游标链接总是指向同一批文章，爬虫可以放心地反复抓取；
+    游标之后（之前）已经没有文章时（比如文章被删除后的旧链接）和页码越界一样返回404
+    总数只用于页面上的“共有N篇文章”：传入了 count 时直接使用，否则从缓存中读取，允许有一点延迟
+    """
+
+    def __init__(self, queryset, per_page, count_key=None, count_timeout=300, count=None):
+        self.queryset = queryset.order_by('-created_time', '-pk')
+        self.per_page = per_page
+        self.count_key = count_key
+        self.count_timeout = count_timeout
+        self.known_count = count
+
+    @property
+    def count(self):
+        if self.known_count is not None:
+            return self.known_count
+        if self.count_key is None:
+            return self.queryset.count()
+        count = cache.get(self.count_key)
+        if count is None:
+            count = self.queryset.count()
+            cache.set(self.count_key, count, self.count_timeout)
+        return count
+
+    @property
+    def num_pages(self):
+        return max(1, -(-self.count // self.per_page))
+
+    def page(self, after=None, before=None):
+        queryset = self.queryset
+        if before:
+            created_time, pk = decode_cursor(before)
+            queryset = queryset.filter(
+                Q(created_time__gt=created_time) | Q(created_time=created_time, pk__gt=pk)
+            ).order_by('created_time', 'pk')
+            rows = list(queryset[:self.per_page + 1])
+            if not rows:
+                raise Http404('这一页没有文章')
+            has_previous = len(rows) > self.per_page
+            object_list = rows[:self.per_page][::-1]
+            return CursorPage(object_list, self, has_next=True, has_previous=has_previous)
+        if after:
+            created_time, pk = decode_cursor(after)
+            queryset = queryset.filter(
+                Q(created_time__lt=created_time) | Q(created_time=created_time, pk__lt=pk)
+            )
+        rows = list(queryset[:self.per_page + 1])
+        if after and not rows:
+            raise Http404('这一页没有文章')
+        has_next = len(rows) > self.per_page
+        return CursorPage(rows[:self.per_page], self, has_next=has_next, has_previous=bool(after))
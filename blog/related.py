@@ -0,0 +1,289 @@
+"""
+相关文章
+
+每篇文章表示成一个稀疏的TF-IDF向量，特征是它的标签、分类，以及可选的标题中的词，
+两篇文章的相似度是向量的余弦值。每个特征的权重为 log(1 + 文章总数 / 含该特征的文章数) 乘以特征类型的系数，
+越少见的标签权重越高，几乎每篇文章都有的特征权重接近0
+
+候选文章只从共享标签或分类的文章中找，每个特征只取最新的 RELATED_POSTS_CANDIDATES 篇，
+这样热门标签也不会让计算量爆炸；候选的得分按全部共享特征精确计算，
+每篇文章最相关的 RELATED_POSTS_COUNT 篇存入 RelatedPost 表
+
+rebuild() 批量重算全部文章，在fork出来的多个进程中并行；
+文章的分类、标题或标签变化时 update_post() 只重算这篇文章，并顺带更新和它相关的文章的列表。
+增量更新不会因为文章总数和标签文章数的变化去重算其他文章的得分，时间长了排序会和批量重算略有出入，
+可以定期运行 python manage.py rebuild_related_posts 校正
+"""
+import heapq
+import math
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, transaction
+
+from . import pagecache
+from .models import Category, Post, RelatedPost, Tag
+from .search import tokenize
+
+# 标题中的词的文档频率在批量重算时写入缓存，增量更新时读取
+TITLE_DF_KEY = 'blog:related:title_df'
+
+# 批量重算时fork出来的子进程直接使用父进程建好的索引，不需要序列化传递
+_index = None
+
+
+def related_settings():
+    return (
+        getattr(settings, 'RELATED_POSTS_COUNT', 5),
+        getattr(settings, 'RELATED_POSTS_CANDIDATES', 200),
+        getattr(settings, 'RELATED_POSTS_CATEGORY_WEIGHT', 0.5),
+        getattr(settings, 'RELATED_POSTS_TITLE_WEIGHT', 0.0),
+    )
+
+
+def post_features(category_id, tag_ids, title, title_weight):
+    features = {'t%d' % tag_id for tag_id in tag_ids}
+    if category_id is not None:
+        features.add('c%d' % category_id)
+    if title_weight:
+        features.update('w' + term for term in tokenize(title))
+    return features
+
+
+def is_generator(feature):
+    # 只有标签和分类用来找候选文章，标题中的词只参与打分
+    return feature[0] in 'tc'
+
+
+class FeatureWeights(object):
+    """
+    特征权重的平方，构造时对给定的全部特征一次算好，打分时只做字典查找
+    """
+
+    def __init__(self, total, df, features, category_weight, title_weight):
+        multipliers = {'t': 1.0, 'c': category_weight, 'w': title_weight}
+        self.squares = {
+            feature: (multipliers[feature[0]] * math.log(1 + total / max(df.get(feature, 1), 1))) ** 2
+            for feature in features
+        }
+
+    def dot(self, shared):
+        return sum(map(self.squares.__getitem__, shared))
+
+    def norm(self, features):
+        return math.sqrt(self.dot(features))
+
+
+def scores(pk, features, candidates, weights, norms=None):
+    """
+    features 和候选文章 {pk: 特征集合} 中每一篇的余弦相似度，norms 是事先算好的各篇文章的向量长度
+    """
+    norm = weights.norm(features)
+    result = {}
+    if not norm:
+        return result
+    # 打分是批量重算中最热的循环，这里把属性查找提到循环外面
+    square = weights.squares.__getitem__
+    for other, other_features in candidates.items():
+        shared = features & other_features
+        if other == pk or not shared:
+            continue
+        other_norm = norms[other] if norms is not None else weights.norm(other_features)
+        result[other] = sum(map(square, shared)) / (norm * other_norm)
+    return result
+
+
+def best(similarity, limit):
+    """
+    相似度最高的 limit 篇，返回 [(pk, 相似度)]，相似度相同时较新的文章（pk较大）排在前面
+    """
+    return [(other, score) for score, other in
+            heapq.nlargest(limit, ((score, other) for other, score in similarity.items() if score > 0))]
+
+
+class FeatureIndex(object):
+    """
+    批量重算用的内存索引：每篇文章的特征集合，以及每个标签/分类下最新的若干篇文章
+    """
+
+    def __init__(self, candidates_per_feature, category_weight, title_weight):
+        self.features = {}
+        self.postings = defaultdict(list)
+        self.candidates_per_feature = candidates_per_feature
+        tags = defaultdict(list)
+        for post_id, tag_id in Post.tags.through.objects.values_list('post_id', 'tag_id').iterator():
+            tags[post_id].append(tag_id)
+        df = Counter()
+        queryset = Post.objects.order_by('-created_time', '-pk').values_list('pk', 'category_id', 'title')
+        for pk, category_id, title in queryset.iterator():
+            features = post_features(category_id, tags.get(pk, ()), title, title_weight)
+            self.features[pk] = features
+            df.update(features)
+            for feature in features:
+                postings = self.postings[feature] if is_generator(feature) else None
+                if postings is not None and len(postings) < candidates_per_feature:
+                    postings.append(pk)
+        self.title_df = {feature[1:]: n for feature, n in df.items() if feature[0] == 'w'}
+        self.weights = FeatureWeights(len(self.features), df, df, category_weight, title_weight)
+        self.norms = {pk: self.weights.norm(features) for pk, features in self.features.items()}
+
+    def top(self, pk, limit):
+        features = self.features[pk]
+        candidates = {}
+        for feature in features:
+            for other in self.postings.get(feature, ()):
+                candidates[other] = self.features[other]
+        return best(scores(pk, features, candidates, self.weights, self.norms), limit)
+
+
+def _top_for_chunk(args):
+    pks, limit = args
+    return [(pk, _index.top(pk, limit)) for pk in pks]
+
+
+def rebuild(jobs=1, chunk_size=2000):
+    """
+    重算全部文章的相关文章，返回写入的行数
+    jobs 大于1并且系统支持fork时在多个进程中并行计算，写入数据库仍在当前进程中完成
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    global _index
+    limit, candidates, category_weight, title_weight = related_settings()
+    _index = FeatureIndex(candidates, category_weight, title_weight)
+    try:
+        pks = list(_index.features)
+        chunks = [(pks[i:i + chunk_size], limit) for i in range(0, len(pks), chunk_size)]
+        if jobs > 1 and len(chunks) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            # 子进程不使用数据库，fork之前关闭连接，避免子进程继承打开的连接
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('fork')) as pool:
+                results = [item for chunk in pool.map(_top_for_chunk, chunks) for item in chunk]
+        else:
+            results = [item for chunk in chunks for item in _top_for_chunk(chunk)]
+        title_df = _index.title_df
+    finally:
+        _index = None
+
+    rows = [RelatedPost(post_id=pk, related_id=other, score=score)
+            for pk, related in results for other, score in related]
+    with transaction.atomic():
+        RelatedPost.objects.all().delete()
+        RelatedPost.objects.bulk_create(rows)
+    if title_weight:
+        cache.set(TITLE_DF_KEY, title_df, None)
+    # 详情页的缓存版本包含sidebar，更新它让全部详情页重新渲染
+    pagecache.bump('sidebar')
+    return len(rows)
+
+
+def load_features(pks, title_weight):
+    """
+    从数据库读取一批文章的特征集合
+    """
+    tags = defaultdict(list)
+    for post_id, tag_id in Post.tags.through.objects.filter(post_id__in=pks).values_list('post_id', 'tag_id'):
+        tags[post_id].append(tag_id)
+    return {pk: post_features(category_id, tags.get(pk, ()), title, title_weight)
+            for pk, category_id, title in Post.objects.filter(pk__in=pks).values_list('pk', 'category_id', 'title')}
+
+
+def live_weights(features, category_weight, title_weight):
+    """
+    增量更新时的特征权重：标签和分类的文章数直接读物化的计数（见 blog/counts.py），
+    标题中的词用上次批量重算时的统计
+    """
+    tag_ids = {int(feature[1:]) for feature in features if feature[0] == 't'}
+    category_ids = {int(feature[1:]) for feature in features if feature[0] == 'c'}
+    df = {'t%d' % pk: n for pk, n in Tag.objects.filter(pk__in=tag_ids).values_list('pk', 'num_posts')}
+    df.update(('c%d' % pk, n) for pk, n in Category.objects.filter(pk__in=category_ids).values_list('pk', 'num_posts'))
+    if title_weight:
+        title_df = cache.get(TITLE_DF_KEY) or {}
+        df.update(('w' + feature[1:], title_df.get(feature[1:], 1)) for feature in features if feature[0] == 'w')
+    return FeatureWeights(Post.objects.count(), df, features, category_weight, title_weight)
+
+
+def candidate_pks(features, limit):
+    pks = set()
+    for feature in features:
+        if feature[0] == 't':
+            queryset = Post.objects.filter(tags=int(feature[1:]))
+        elif feature[0] == 'c':
+            queryset = Post.objects.filter(category_id=int(feature[1:]))
+        else:
+            continue
+        pks.update(queryset.order_by('-created_time', '-pk').values_list('pk', flat=True)[:limit])
+    return pks
+
+
+def update_post(pk):
+    """
+    重算一篇文章的相关文章；它在其他文章列表中的位置也一并更新：
+    原来把它列为相关文章的，更新相似度或者去掉；新的候选文章里相似度够高的，把它加进去
+    """
+    limit, candidates_per_feature, category_weight, title_weight = related_settings()
+    features = load_features([pk], title_weight).get(pk)
+    if features is None:
+        return
+    pks = candidate_pks(features, candidates_per_feature)
+    listed_by = listing(pk)
+    candidates = load_features(pks | listed_by, title_weight)
+    weights = live_weights(features.union(*candidates.values()), category_weight, title_weight)
+    similarity = scores(pk, features, candidates, weights)
+
+    with transaction.atomic():
+        RelatedPost.objects.filter(post_id=pk).delete()
+        RelatedPost.objects.bulk_create([
+            RelatedPost(post_id=pk, related_id=other, score=score)
+            for other, score in best(similarity, limit)
+        ])
+        # 反向：别的文章的列表里是否应该有这篇文章
+        touched = {pk}
+        current = defaultdict(dict)
+        for post_id, related_id, score in RelatedPost.objects.filter(post_id__in=similarity.keys() | listed_by) \
+                .values_list('post_id', 'related_id', 'score'):
+            current[post_id][related_id] = score
+        for other in similarity.keys() | listed_by:
+            entries = current[other]
+            score = similarity.get(other, 0)
+            if pk in entries:
+                touched.add(other)
+                if score > 0:
+                    RelatedPost.objects.filter(post_id=other, related_id=pk).update(score=score)
+                else:
+                    RelatedPost.objects.filter(post_id=other, related_id=pk).delete()
+            elif score > 0 and (len(entries) < limit or score > min(entries.values())):
+                touched.add(other)
+                if len(entries) >= limit:
+                    weakest = min(entries, key=lambda related_id: (entries[related_id], related_id))
+                    RelatedPost.objects.filter(post_id=other, related_id=weakest).delete()
+                RelatedPost.objects.create(post_id=other, related_id=pk, score=score)
+    pagecache.bump(*['post:%s' % other for other in touched])
+
+
+def listing(pk):
+    """
+    把这篇文章列为相关文章的那些文章的id
+    """
+    return set(RelatedPost.objects.filter(related_id=pk).values_list('post_id', flat=True))
+
+
+def refresh_listing(pks):
+    """
+    文章被删除后，原来把它列为相关文章的那些文章重新计算
+    """
+    for pk in pks:
+        update_post(pk)
+
+
+def related_for(post, limit=None):
+    """
+    详情页使用的相关文章列表，一次查询
+    """
+    limit = limit or related_settings()[0]
+    # 相似度相同时较新的文章排在前面，和计算时的顺序一致
+    entries = RelatedPost.objects.filter(post=post).select_related('related').order_by('-score', '-related_id') \
+        .only('score', 'related__id', 'related__title', 'related__created_time')[:limit]
+    return [entry.related for entry in entries]
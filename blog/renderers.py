@@ -0,0 +1,232 @@
+"""
+Markdown渲染服务
+
+保存文章和详情页补渲染都通过 get_renderer() 渲染正文，批量重新渲染用 render_many()：
+    InlineRenderer  在当前线程中渲染，只检查正文长度
+    PoolRenderer    在有上限的进程池中渲染，每篇有超时时间，批量渲染时用上全部CPU核
+正文超过 MARKDOWN_MAX_BODY_SIZE、渲染超时或者出错时，返回转义后的原文（<pre>），请求不会被一篇文章卡住。
+超时可能只是一时繁忙，超时和出错的结果都不计入 body_hash；超时还记录在缓存中，
+MARKDOWN_RENDER_RETRY_AFTER 秒内同样的正文直接返回转义后的原文，之后再重新尝试
+
+进程池由同一进程内的全部线程共用。某个线程的渲染超时时只能结束整个进程池，
+其他线程在这个进程池中等待的正文会失败（BrokenExecutor 或 CancelledError），它们换新的进程池重新提交，
+不会因为别人的超时得到转义后的原文
+
+进程池的子进程是fork出来的，会继承父进程的数据库连接，但渲染不访问数据库，
+子进程退出时（os._exit 或被 terminate）也不会关闭这些连接，所以不影响父进程
+"""
+import atexit
+import logging
+import os
+import threading
+import weakref
+from collections import namedtuple
+from concurrent.futures import BrokenExecutor, CancelledError, TimeoutError
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.html import escape
+
+from .instrumentation import count, timed
+from .rendering import body_hash, render_markdown
+
+logger = logging.getLogger(__name__)
+
+# status 为 'ok'、'too_large'、'timeout' 或 'error'
+RenderResult = namedtuple('RenderResult', ['html', 'toc', 'status'])
+FAILURE_KEY = 'blog:render_failed:%s'
+
+
+def init_worker():
+    # 进程池子进程的初始化函数，build_static_site 也使用。
+    # fork出来的子进程已经初始化过Django，spawn方式启动的子进程需要重新初始化
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+
+def render_fields(body):
+    # 进程池中执行的函数，返回值要能pickle，所以返回元组而不是RenderResult
+    return render_markdown(body)
+
+
+def fallback(body, status):
+    count('render.%s' % status)
+    return RenderResult('<pre class="render-fallback">%s</pre>' % escape(body), '', status)
+
+
+class BaseRenderer(object):
+    def __init__(self, max_body_size=None):
+        self._max_body_size = max_body_size
+
+    # 没有在构造时指定的参数每次从settings读取
+    @property
+    def max_body_size(self):
+        if self._max_body_size is not None:
+            return self._max_body_size
+        return getattr(settings, 'MARKDOWN_MAX_BODY_SIZE', 1024 * 1024)
+
+    def render(self, body):
+        return self.render_many([body])[0]
+
+    def render_many(self, bodies):
+        """
+        渲染一批正文，按顺序返回 RenderResult 列表
+        """
+        results = [None] * len(bodies)
+        pending = []
+        for i, body in enumerate(bodies):
+            if len(body) > self.max_body_size:
+                results[i] = fallback(body, 'too_large')
+            elif cache.get(FAILURE_KEY % body_hash(body)):
+                results[i] = fallback(body, 'timeout')
+            else:
+                pending.append(i)
+        if pending:
+            for i, result in zip(pending, self._render([bodies[i] for i in pending])):
+                if result.status == 'timeout':
+                    cache.set(FAILURE_KEY % body_hash(bodies[i]), True,
+                              getattr(settings, 'MARKDOWN_RENDER_RETRY_AFTER', 600))
+                results[i] = result
+        return results
+
+    def _render(self, bodies):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class InlineRenderer(BaseRenderer):
+    """
+    在当前线程中渲染，无法中断，没有超时
+    """
+
+    def _render(self, bodies):
+        results = []
+        for body in bodies:
+            try:
+                results.append(RenderResult(*render_markdown(body), status='ok'))
+            except Exception:
+                logger.exception('渲染Markdown失败')
+                results.append(fallback(body, 'error'))
+        return results
+
+
+class PoolRenderer(BaseRenderer):
+    """
+    在进程池中渲染。超时的子进程无法取消正在执行的任务，只能连同进程池一起结束掉，
+    同一批中还没完成的正文在新的进程池中重新提交
+    """
+
+    def __init__(self, max_workers=None, timeout=None, max_body_size=None, function=render_fields):
+        super().__init__(max_body_size)
+        self.max_workers = max_workers or getattr(settings, 'MARKDOWN_RENDER_WORKERS', None) or os.cpu_count()
+        self._timeout = timeout
+        self.function = function
+        self._lock = threading.Lock()
+        self._pool = None
+        # 已经被结束掉的进程池，在其中失败的任务不是正文本身的问题，需要重新提交
+        self._retired = weakref.WeakSet()
+
+    @property
+    def timeout(self):
+        if self._timeout is not None:
+            return self._timeout
+        return getattr(settings, 'MARKDOWN_RENDER_TIMEOUT', 5)
+
+    def get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # 进程池相关的模块（multiprocessing等）在第一次用到时才导入，不拖慢web进程启动
+                from concurrent.futures import ProcessPoolExecutor
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers, initializer=init_worker)
+            return self._pool
+
+    def discard_pool(self, pool, kill=False):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+            self._retired.add(pool)
+        if kill:
+            # ProcessPoolExecutor没有公开结束子进程的接口，卡住的子进程只能直接结束
+            for process in list((getattr(pool, '_processes', None) or {}).values()):
+                process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _render(self, bodies):
+        results = [None] * len(bodies)
+        pending = list(range(len(bodies)))
+        while pending:
+            pool = self.get_pool()
+            try:
+                futures = [(i, pool.submit(self.function, bodies[i])) for i in pending]
+            except (BrokenExecutor, RuntimeError) as e:
+                # 进程池已经坏掉，或者刚被其他线程结束掉（shutdown之后submit抛出RuntimeError）
+                if isinstance(e, RuntimeError) and pool not in self._retired:
+                    raise
+                self.discard_pool(pool)
+                continue
+            pending = []
+            for k, (i, future) in enumerate(futures):
+                try:
+                    with timed('markdown'):
+                        results[i] = RenderResult(*future.result(timeout=self.timeout), status='ok')
+                except (TimeoutError, BrokenExecutor, CancelledError) as e:
+                    if not isinstance(e, TimeoutError) and pool in self._retired:
+                        # 进程池被其他线程因为超时结束掉了，这一篇和后面的重新提交
+                        pending = [j for j, _ in futures[k:]]
+                        break
+                    if isinstance(e, TimeoutError):
+                        logger.warning('渲染Markdown超过 %s 秒，返回转义后的原文', self.timeout)
+                        results[i] = fallback(bodies[i], 'timeout')
+                    else:
+                        # 子进程异常退出（比如内存不足被系统结束），这一篇不再重试
+                        logger.error('渲染Markdown的子进程异常退出')
+                        results[i] = fallback(bodies[i], 'error')
+                    self.discard_pool(pool, kill=True)
+                    pending = [j for j, _ in futures[k + 1:]]
+                    break
+                except Exception:
+                    logger.exception('渲染Markdown失败')
+                    results[i] = fallback(bodies[i], 'error')
+        return results
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+
+_renderers = {}
+_renderers_lock = threading.Lock()
+
+
+def get_renderer():
+    """
+    MARKDOWN_RENDERER 为 'pool' 时使用进程池渲染，为 'inline' 时在当前线程中渲染
+    进程池在第一次渲染时才创建，同一进程内共用
+    """
+    name = getattr(settings, 'MARKDOWN_RENDERER', 'inline')
+    with _renderers_lock:
+        renderer = _renderers.get(name)
+        if renderer is None:
+            renderer = _renderers[name] = PoolRenderer() if name == 'pool' else InlineRenderer()
+    return renderer
+
+
+@atexit.register
+def close_renderers():
+    # 进程退出前关闭共用的进程池，否则解释器清理模块之后进程池才被回收，会打印 weakref_cb 的异常
+    with _renderers_lock:
+        renderers = list(_renderers.values())
+    for renderer in renderers:
+        renderer.close()
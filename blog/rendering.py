@@ -0,0 +1,153 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.html import strip_tags
+from django.utils.text import slugify
+
+from .instrumentation import count, timed
+
+# 渲染文章正文时使用的Markdown扩展
+# 注意：修改扩展列表后需要将RENDER_VERSION加1，然后运行 python manage.py render_posts 重新渲染全部文章
+MARKDOWN_EXTENSIONS = [
+    'markdown.extensions.extra',
+    'markdown.extensions.codehilite',
+]
+RENDER_VERSION = 1
+# 自动生成的摘要长度
+EXCERPT_LENGTH = 54
+
+
+def body_hash(body):
+    """
+    计算文章正文的摘要值，渲染版本号也参与计算，
+    这样扩展列表变化后所有已保存的渲染结果都会被视为过期
+    """
+    content = '%s:%s' % (RENDER_VERSION, body)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class HighlightCache(object):
+    """
+    代码块高亮结果的缓存，Pygments高亮是渲染长文章时最慢的一步
+    以代码块的源码和全部高亮参数为键：先查进程内的LRU，再查 HIGHLIGHT_CACHE_ALIAS 指定的持久缓存，
+    都没有时才调用Pygments。修改一段文字后重新渲染，没有变化的代码块直接复用之前的结果，
+    缓存的就是原来 hilite() 的返回值，所以渲染结果和不用缓存时逐字节相同
+    段落没有缓存：脚注、缩写和链接引用是整篇文章共享的，单独缓存段落无法保证结果不变，而且段落的渲染很快
+    """
+    KEY_PREFIX = 'blog:highlight:'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._versions = None
+
+    def key(self, codehilite, shebang):
+        if self._versions is None:
+            import markdown
+            try:
+                import pygments
+                self._versions = (markdown.__version__, pygments.__version__)
+            except ImportError:
+                self._versions = (markdown.__version__, None)
+        options = sorted((name, repr(value)) for name, value in vars(codehilite).items())
+        content = repr((self._versions, shebang, options))
+        return self.KEY_PREFIX + hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def get_or_highlight(self, codehilite, shebang, highlight):
+        key = self.key(codehilite, shebang)
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                count('highlight_cache.hit')
+                return html
+        store = self.store()
+        html = store.get(key) if store is not None else None
+        if html is None:
+            count('highlight_cache.miss')
+            with timed('highlight'):
+                html = highlight()
+            if store is not None:
+                store.set(key, html, None)
+        else:
+            count('highlight_cache.hit')
+        self.remember(key, html)
+        return html
+
+    def remember(self, key, html):
+        size = getattr(settings, 'HIGHLIGHT_CACHE_SIZE', 1024)
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def store():
+        alias = getattr(settings, 'HIGHLIGHT_CACHE_ALIAS', None)
+        return caches[alias] if alias else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+highlight_cache = HighlightCache()
+
+
+def install_highlight_cache():
+    """
+    让codehilite（包括extra中fenced_code调用的codehilite）的高亮结果经过 highlight_cache
+    """
+    from markdown.extensions.codehilite import CodeHilite
+
+    if getattr(CodeHilite.hilite, 'highlight_cache', None) is highlight_cache:
+        return
+    hilite = CodeHilite.hilite
+
+    @wraps(hilite)
+    def cached_hilite(self, shebang=True):
+        return highlight_cache.get_or_highlight(self, shebang, lambda: hilite(self, shebang))
+
+    cached_hilite.highlight_cache = highlight_cache
+    CodeHilite.hilite = cached_hilite
+
+
+_local = threading.local()
+
+
+def get_markdown():
+    """
+    每个线程复用一个Markdown实例，创建实例（加载扩展、编译正则）比渲染一篇普通文章还慢，
+    每次渲染前调用reset()清掉上一篇的目录、脚注等状态，结果和新建实例相同
+    """
+    md = getattr(_local, 'markdown', None)
+    if md is None:
+        import markdown
+        from markdown.extensions.toc import TocExtension
+
+        md = _local.markdown = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS + [TocExtension(slugify=slugify)])
+    return md.reset()
+
+
+def render_markdown(body):
+    """
+    将Markdown正文渲染成HTML，返回 (html, toc) 元组
+    markdown（以及codehilite用到的Pygments）在第一次渲染时才导入，导入模型时不会加载它们
+    """
+    install_highlight_cache()
+    with timed('markdown'):
+        md = get_markdown()
+        html = md.convert(body)
+    return html, md.toc
+
+
+def make_excerpt(html):
+    """
+    去掉渲染结果中的全部HTML标签，取前EXCERPT_LENGTH个字符作为摘要
+    """
+    return strip_tags(html)[:EXCERPT_LENGTH]
@@ -0,0 +1,294 @@
+import math
+import re
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+from django.utils.html import escape, strip_tags
+from django.utils.safestring import mark_safe
+
+# 中日韩文字没有空格分词，这里把连续的中日韩字符切成二元组(bigram)，
+# 其它文字按字母数字切词，搜索时对关键词做同样的处理；
+# 建立索引时另外加入每个单字，只有一个字的关键词也能搜到
+CJK_CHARS = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+TOKEN_RE = re.compile(r'[%s]+|[^\W_%s]+' % (CJK_CHARS, CJK_CHARS))
+CJK_RE = re.compile(r'[%s]' % CJK_CHARS)
+# 标题中的词比正文中的词权重更高
+TITLE_WEIGHT = 10.0
+BODY_WEIGHT = 1.0
+
+
+def tokenize(text, unigrams=False):
+    tokens = []
+    for word in TOKEN_RE.findall(text.lower()):
+        if CJK_RE.match(word) and len(word) > 1:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+            if unigrams:
+                tokens.extend(word)
+        else:
+            tokens.append(word)
+    return tokens
+
+
+def post_text(post):
+    """
+    返回用于建立索引的 (标题, 正文纯文本)
+    """
+    body = strip_tags(post.body_html) if post.body_html else post.body
+    return post.title, body
+
+
+def highlight(text, query, width=120):
+    """
+    从正文中截取包含关键词的一段文字，并用<mark>标出关键词
+    """
+    terms = sorted(set(query.lower().split()) | set(tokenize(query)), key=len, reverse=True)
+    terms = [t for t in terms if t]
+    if not terms:
+        return escape(text[:width])
+    pattern = re.compile('|'.join(re.escape(t) for t in terms), re.IGNORECASE)
+    match = pattern.search(text)
+    start = max(match.start() - width // 4, 0) if match else 0
+    fragment = text[start:start + width]
+    parts = []
+    last = 0
+    for m in pattern.finditer(fragment):
+        parts.append(escape(fragment[last:m.start()]))
+        parts.append('<mark>%s</mark>' % escape(m.group()))
+        last = m.end()
+    parts.append(escape(fragment[last:]))
+    prefix = '…' if start > 0 else ''
+    suffix = '…' if start + width < len(text) else ''
+    return mark_safe(prefix + ''.join(parts) + suffix)
+
+
+class SearchResults(object):
+    """
+    搜索结果的惰性序列，可以直接交给Paginator分页，
+    只有真正取某一页时才会去查询这一页的文章
+    """
+
+    def __init__(self, backend, query, queryset):
+        self.backend = backend
+        self.query = query
+        self.queryset = queryset
+        self.model = queryset.model
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self.backend.count(self.query)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self[0:self.count()])
+
+    def __getitem__(self, k):
+        if not isinstance(k, slice):
+            return self[k:k + 1][0]
+        offset = k.start or 0
+        limit = (k.stop if k.stop is not None else self.count()) - offset
+        if limit <= 0:
+            return []
+        ids = self.backend.search(self.query, offset, limit)
+        posts = {post.pk: post for post in self.queryset.filter(pk__in=ids)}
+        results = []
+        for pk in ids:
+            post = posts.get(pk)
+            if post is not None:
+                post.snippet = highlight(post_text(post)[1], self.query)
+                results.append(post)
+        return results
+
+
+class BaseSearchBackend(object):
+    def index_post(self, post):
+        raise NotImplementedError
+
+    def remove_post(self, pk):
+        raise NotImplementedError
+
+    def count(self, query):
+        raise NotImplementedError
+
+    def search(self, query, offset, limit):
+        """
+        返回按相关度排序的文章id列表
+        """
+        raise NotImplementedError
+
+    def rebuild(self, posts):
+        for post in posts:
+            self.index_post(post)
+
+
+class Fts5SearchBackend(BaseSearchBackend):
+    """
+    基于SQLite FTS5虚拟表的倒排索引，表由迁移0004创建，
+    写入的是预先分好词的文本，因此中文同样能按二元组检索
+    """
+    table = 'blog_post_fts'
+    _available = None
+
+    @classmethod
+    def is_available(cls):
+        # 结果在进程内缓存，避免每次搜索都多查一次表结构
+        if cls._available is None:
+            if connection.vendor != 'sqlite':
+                cls._available = False
+            else:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [cls.table])
+                    cls._available = cursor.fetchone() is not None
+        return cls._available
+
+    def match_expression(self, query):
+        return ' '.join('"%s"' % token for token in tokenize(query))
+
+    @staticmethod
+    def row(post):
+        """
+        索引表中的一行 (rowid, 标题, 正文)
+        """
+        title, body = post_text(post)
+        return post.pk, ' '.join(tokenize(title, unigrams=True)), ' '.join(tokenize(body, unigrams=True))
+
+    def index_post(self, post):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid = %%s' % self.table, [post.pk])
+            cursor.execute('INSERT INTO %s (rowid, title, body) VALUES (%%s, %%s, %%s)' % self.table, self.row(post))
+
+    def remove_post(self, pk):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid = %%s' % self.table, [pk])
+
+    def count(self, query):
+        expression = self.match_expression(query)
+        if not expression:
+            return 0
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT count(*) FROM %s WHERE %s MATCH %%s' % (self.table, self.table), [expression])
+            return cursor.fetchone()[0]
+
+    def search(self, query, offset, limit):
+        expression = self.match_expression(query)
+        if not expression:
+            return []
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT rowid FROM {table} WHERE {table} MATCH %s '
+                'ORDER BY bm25({table}, {title}, {body}) LIMIT %s OFFSET %s'.format(
+                    table=self.table, title=TITLE_WEIGHT, body=BODY_WEIGHT),
+                [expression, limit, offset],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def rebuild(self, posts):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s' % self.table)
+        super().rebuild(posts)
+
+
+class PythonSearchBackend(BaseSearchBackend):
+    """
+    纯Python实现的内存倒排索引，在数据库不支持FTS5时使用
+    索引在第一次搜索时从数据库加载，之后由文章的保存和删除信号增量维护，
+    注意它只对当前进程有效，多进程部署时请使用FTS5
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # token -> {文章id: 权重}
+        self._index = None
+        # 文章id -> 该文章包含的token，用于更新和删除
+        self._documents = {}
+
+    def _ensure_loaded(self):
+        if self._index is not None:
+            return
+        from .models import Post
+        with self._lock:
+            if self._index is None:
+                self._index = defaultdict(dict)
+                for post in Post.objects.only('id', 'title', 'body', 'body_html').iterator():
+                    self._add(post)
+
+    def _add(self, post):
+        title, body = post_text(post)
+        weights = defaultdict(float)
+        for token in tokenize(title, unigrams=True):
+            weights[token] += TITLE_WEIGHT
+        for token in tokenize(body, unigrams=True):
+            weights[token] += BODY_WEIGHT
+        for token, weight in weights.items():
+            self._index[token][post.pk] = weight
+        self._documents[post.pk] = list(weights)
+
+    def _remove(self, pk):
+        for token in self._documents.pop(pk, []):
+            postings = self._index.get(token)
+            if postings is not None:
+                postings.pop(pk, None)
+                if not postings:
+                    del self._index[token]
+
+    def index_post(self, post):
+        if self._index is None:
+            return
+        with self._lock:
+            self._remove(post.pk)
+            self._add(post)
+
+    def remove_post(self, pk):
+        if self._index is None:
+            return
+        with self._lock:
+            self._remove(pk)
+
+    def rebuild(self, posts):
+        with self._lock:
+            self._index = defaultdict(dict)
+            self._documents = {}
+            for post in posts:
+                self._add(post)
+
+    def ranked(self, query):
+        self._ensure_loaded()
+        tokens = set(tokenize(query))
+        if not tokens:
+            return []
+        with self._lock:
+            postings = [self._index.get(token, {}) for token in tokens]
+            total = len(self._documents) or 1
+        # 所有关键词都必须出现，按 TF-IDF 打分
+        candidates = set.intersection(*(set(p) for p in postings))
+        scores = defaultdict(float)
+        for p in postings:
+            idf = math.log(1 + total / (1 + len(p)))
+            for pk in candidates:
+                scores[pk] += (1 + math.log(p[pk])) * idf
+        return sorted(candidates, key=lambda pk: (-scores[pk], -pk))
+
+    def count(self, query):
+        return len(self.ranked(query))
+
+    def search(self, query, offset, limit):
+        return self.ranked(query)[offset:offset + limit]
+
+
+_python_backend = PythonSearchBackend()
+
+
+def get_search_backend():
+    """
+    SEARCH_BACKEND 为 'fts5' 或 'python' 时强制使用对应实现，
+    默认 'auto'：数据库中存在FTS5索引表时使用FTS5，否则使用纯Python索引
+    """
+    name = getattr(settings, 'SEARCH_BACKEND', 'auto')
+    if name == 'fts5' or (name == 'auto' and Fts5SearchBackend.is_available()):
+        return Fts5SearchBackend()
+    return _python_backend
@@ -0,0 +1,75 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from .instrumentation import count
+from .models import ArchiveMonth, Category, Post, Tag
+
+# 侧边栏数据缓存的键，文章、分类、标签变化时由signals模块删除对应的键
+KEYS = {
+    'recent_posts': 'blog:sidebar:recent_posts',
+    'archives': 'blog:sidebar:archives',
+    'categories': 'blog:sidebar:categories',
+    'tags': 'blog:sidebar:tags',
+}
+# 最新文章缓存的数量，模板里请求的数量不超过它时直接从缓存里切片
+RECENT_POSTS_CACHE_SIZE = 10
+
+
+def cached(name, producer):
+    value = cache.get(KEYS[name])
+    if value is None:
+        count('sidebar_cache.miss')
+        value = list(producer())
+        cache.set(KEYS[name], value, getattr(settings, 'SIDEBAR_CACHE_TIMEOUT', None))
+    else:
+        count('sidebar_cache.hit')
+    return value
+
+
+def invalidate(*names):
+    """
+    删除侧边栏缓存，不指定名字时删除全部
+    """
+    cache.delete_many([KEYS[name] for name in (names or KEYS)])
+
+
+def recent_posts(num=5):
+    # 侧边栏只显示标题，不加载正文，缓存里的对象也小得多
+    queryset = Post.objects.summaries().order_by('-created_time')
+    if num > RECENT_POSTS_CACHE_SIZE:
+        return list(queryset[:num])
+    return cached('recent_posts', lambda: queryset[:RECENT_POSTS_CACHE_SIZE])[:num]
+
+
+# 归档、分类和标签的文章数都是物化好的计数（见 blog/counts.py），不需要再聚合文章表
+def archives():
+    return cached('archives', lambda: ArchiveMonth.objects.filter(num_posts__gt=0))
+
+
+def categories():
+    return cached('categories', lambda: Category.objects.filter(num_posts__gt=0))
+
+
+def tags():
+    return cached('tags', lambda: Tag.objects.filter(num_posts__gt=0))
+
+
+# 列表页的分页总数也从这里取，不用再对文章表做 COUNT(*)，见 blog/paginators.py 的 CountedPaginator
+# 每篇文章都有且只有一个分类，所以全部文章数就是各分类文章数之和
+def post_count():
+    return sum(category.num_posts for category in categories())
+
+
+def archive_count(year, month):
+    return next((archive.num_posts for archive in archives() if (archive.year, archive.month) == (year, month)), 0)
+
+
+def category(pk):
+    """
+    侧边栏缓存中的分类，没有文章的分类不在缓存里，返回None
+    """
+    return next((category for category in categories() if category.pk == pk), None)
+
+
+def tag(pk):
+    return next((tag for tag in tags() if tag.pk == pk), None)
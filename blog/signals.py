@@ -0,0 +1,167 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import counts, pagecache, related, sidebar
+from .models import Category, Post, Tag
+from .search import get_search_backend
+
+
+# 文章保存或删除后同步更新搜索索引
+@receiver(post_save, sender=Post)
+def index_post(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not {'title', 'body'} & set(update_fields):
+        return
+    get_search_backend().index_post(instance)
+
+
+@receiver(post_delete, sender=Post)
+def unindex_post(sender, instance, **kwargs):
+    get_search_backend().remove_post(instance.pk)
+
+
+# 增量维护按月归档、分类和标签的文章数，见 blog/counts.py
+@receiver(pre_save, sender=Post)
+def remember_counted_fields(sender, instance, **kwargs):
+    # 记下修改前的分类、创建时间和标题，保存后据此调整计数和相关文章
+    instance._previous = None
+    if instance.pk is not None:
+        instance._previous = Post.objects.filter(pk=instance.pk) \
+            .values_list('category_id', 'created_time', 'title').first()
+
+
+@receiver(post_save, sender=Post)
+def update_counts_on_save(sender, instance, created, **kwargs):
+    old = getattr(instance, '_previous', None)
+    new = (instance.category_id, instance.created_time)
+    if created or old is None:
+        counts.adjust_category(instance.category_id, 1)
+        counts.adjust_month(instance.created_time, 1)
+        return
+    if old[0] != new[0]:
+        counts.adjust_category(old[0], -1)
+        counts.adjust_category(new[0], 1)
+    if counts.month_of(old[1]) != counts.month_of(new[1]):
+        counts.adjust_month(old[1], -1)
+        counts.adjust_month(new[1], 1)
+
+
+@receiver(pre_delete, sender=Post)
+def remember_post_tags(sender, instance, **kwargs):
+    # 删除文章时标签关系是级联删除的，不会发送m2m_changed信号，这里先记下标签
+    instance._tag_ids = list(instance.tags.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Post)
+def update_counts_on_delete(sender, instance, **kwargs):
+    counts.adjust_category(instance.category_id, -1)
+    counts.adjust_month(instance.created_time, -1)
+    counts.adjust_tags(getattr(instance, '_tag_ids', []), -1)
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def update_tag_counts(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # clear之后就不知道清掉了哪些关系，先记下来
+        if reverse:
+            instance._cleared = instance.post_set.count()
+        else:
+            instance._cleared = list(instance.tags.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if action == 'post_clear':
+        cleared = getattr(instance, '_cleared', None)
+        if reverse and cleared:
+            counts.adjust_tags([instance.pk], -cleared)
+        elif not reverse:
+            counts.adjust_tags(cleared, -1)
+        return
+    delta = 1 if action == 'post_add' else -1
+    if reverse:
+        counts.adjust_tags([instance.pk], delta * len(pk_set))
+    else:
+        counts.adjust_tags(pk_set, delta)
+
+
+# 文章的分类、标题或标签变化后增量更新相关文章，见 blog/related.py
+@receiver(post_save, sender=Post)
+def update_related_on_save(sender, instance, created, **kwargs):
+    old = getattr(instance, '_previous', None)
+    # 标题中的词默认不参与计算（RELATED_POSTS_TITLE_WEIGHT 为0），这时只改标题不需要重算
+    title_changed = old is not None and old[2] != instance.title and related.related_settings()[3]
+    if created or old is None or old[0] != instance.category_id or title_changed:
+        related.update_post(instance.pk)
+    elif old[2] != instance.title:
+        # 别的文章的详情页上显示着这篇文章的标题
+        pagecache.bump(*['post:%s' % pk for pk in related.listing(instance.pk)])
+
+
+@receiver(pre_delete, sender=Post)
+def remember_related_listing(sender, instance, **kwargs):
+    # 删除文章时它所在的相关文章行是级联删除的，先记下哪些文章列出了它，删除后给它们补上
+    instance._listed_by = related.listing(instance.pk)
+
+
+@receiver(post_delete, sender=Post)
+def update_related_on_delete(sender, instance, **kwargs):
+    related.refresh_listing(getattr(instance, '_listed_by', []))
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def update_related_on_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        instance._related_cleared = list(instance.post_set.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        post_pks = [instance.pk]
+    elif action == 'post_clear':
+        post_pks = getattr(instance, '_related_cleared', [])
+    else:
+        post_pks = pk_set or []
+    for pk in post_pks:
+        related.update_post(pk)
+
+
+# 文章、分类、标签变化后删除侧边栏缓存，需要注册在更新计数的信号处理函数之后
+@receiver([post_save, post_delete], sender=Post)
+def invalidate_sidebar_for_post(sender, **kwargs):
+    sidebar.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_sidebar_for_category(sender, **kwargs):
+    sidebar.invalidate('categories')
+
+
+@receiver([post_save, post_delete], sender=Tag)
+def invalidate_sidebar_for_tag(sender, **kwargs):
+    sidebar.invalidate('tags')
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def invalidate_sidebar_for_post_tags(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        sidebar.invalidate('tags')
+
+
+# 更新页面缓存依赖的内容版本号
+@receiver([post_save, post_delete], sender=Post)
+def bump_post_versions(sender, instance, **kwargs):
+    pagecache.bump('list', 'sidebar', 'post:%s' % instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Tag)
+def bump_taxonomy_versions(sender, **kwargs):
+    pagecache.bump('list', 'sidebar')
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def bump_post_tags_versions(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    # 正向（post.tags.add）时instance是文章，反向（tag.post_set.add）时pk_set是文章id
+    post_pks = (pk_set or []) if reverse else [instance.pk]
+    pagecache.bump('list', 'sidebar', *['post:%s' % pk for pk in post_pks])
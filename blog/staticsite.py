@@ -0,0 +1,337 @@
+"""
+把整站预先渲染成静态文件，由 build_static_site 命令调用
+
+每个URL对应输出目录下的一个文件：
+    /                       index.html
+    /post/1                 post/1/index.html
+    /category/1?page=3      category/1/page-3.html
+    /all/rss                all/rss/index.xml
+web服务器对匿名读者的GET请求先找这些文件，找不到再交给Django，nginx的配置大致是：
+    set $static_page index.html;
+    if ($arg_page) { set $static_page page-$arg_page.html; }
+    if ($http_cookie ~* "sessionid") { set $static_page none; }
+    try_files /site$uri/$static_page /site$uri/index.xml @django;
+"""
+import glob
+import hashlib
+import json
+import math
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import repeat
+from urllib.parse import parse_qs
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.db import connections
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from . import sidebar
+from .counts import month_of, month_range
+from .models import ArchiveMonth, Category, Post, RelatedPost, Tag
+from .pagecache import CSRF_PLACEHOLDER, CSRF_TOKEN_RE
+from .renderers import init_worker
+from .viewcount import view_counter
+
+STATE_FILE = '.build-state.json'
+SITEMAP_FILE = 'sitemap.xml'
+# 单个sitemap文件最多包含的URL数量（sitemap协议的上限）
+SITEMAP_LIMIT = 50000
+
+# 一个文章列表：列表页地址、对应的RSS地址（没有则为None）、文章数和按发布时间倒序的查询集
+SiteList = namedtuple('SiteList', ['url', 'feed_url', 'count', 'queryset'])
+BuildResult = namedtuple('BuildResult', ['full', 'rendered', 'removed'])
+
+
+class BuildError(Exception):
+    pass
+
+
+def output_path(root, url, extension='.html'):
+    path, _, query = url.partition('?')
+    page = parse_qs(query).get('page')
+    name = ('page-%s' % page[0]) if page else 'index'
+    return os.path.join(root, path.strip('/'), name + extension)
+
+
+def write_file(path, content):
+    # 先写临时文件再替换，web服务器不会读到写了一半的文件
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def remove_page(root, url):
+    for extension in ('.html', '.xml'):
+        try:
+            os.remove(output_path(root, url, extension))
+        except FileNotFoundError:
+            pass
+
+
+def render_urls(urls, root, host):
+    """
+    依次请求每个URL并把响应写成静态文件，返回写入的文件数
+    在进程池的子进程中执行，只有一个进程时直接在当前进程调用
+    """
+    client = Client(HTTP_HOST=host)
+    written = 0
+    # 不经过整页缓存，也不把生成页面的请求记成阅读量
+    with override_settings(PAGE_CACHE_ENABLED=False, VIEW_COUNT_FLUSH_INTERVAL=0):
+        try:
+            for url in urls:
+                response = client.get(url)
+                if response.status_code >= 400 and response.status_code != 404:
+                    # 比如域名不在ALLOWED_HOSTS中时每个页面都是400，不能当成页面已不存在而删掉
+                    raise BuildError('请求 %s 返回 %d' % (url, response.status_code))
+                if response.status_code != 200:
+                    remove_page(root, url)
+                    continue
+                extension = '.xml' if 'xml' in response['Content-Type'] else '.html'
+                # 静态页面里没有读者自己的CSRF令牌，换成占位符，评论表单提交前由页面脚本换成读者的令牌
+                content = CSRF_TOKEN_RE.sub(r'\g<1>%s\g<2>' % CSRF_PLACEHOLDER,
+                                            response.content.decode(response.charset))
+                write_file(output_path(root, url, extension), content)
+                written += 1
+        finally:
+            view_counter.clear()
+    return written
+
+
+def num_pages(count):
+    return max(1, math.ceil(count / settings.PAGE_NUM))
+
+
+def page_urls(site_list):
+    """
+    一个列表的全部页面；游标分页时后续页面的地址由游标决定，只能预先生成第一页
+    """
+    urls = [site_list.url]
+    if settings.PAGINATION_MODE == 'offset':
+        urls.extend('%s?page=%d' % (site_list.url, number) for number in range(1, num_pages(site_list.count) + 1))
+    if site_list.feed_url:
+        urls.append(site_list.feed_url)
+    return urls
+
+
+def page_of(site_list, created_time):
+    """
+    发布时间为 created_time 的文章在列表中所在的页面
+    """
+    if settings.PAGINATION_MODE != 'offset':
+        return [site_list.url]
+    number = site_list.queryset.filter(created_time__gt=created_time).count() // settings.PAGE_NUM + 1
+    urls = ['%s?page=%d' % (site_list.url, number)]
+    if number == 1:
+        urls.append(site_list.url)
+    return urls
+
+
+def current_lists():
+    """
+    当前所有有文章的列表，键为列表页地址
+    """
+    lists = [SiteList(reverse('blog:index'), reverse('blog:rss'), Post.objects.count(), Post.objects.all())]
+    for category in Category.objects.filter(num_posts__gt=0):
+        lists.append(SiteList(reverse('blog:category', args=[category.pk]),
+                              reverse('blog:category_rss', args=[category.pk]),
+                              category.num_posts, Post.objects.filter(category=category)))
+    for tag in Tag.objects.filter(num_posts__gt=0):
+        lists.append(SiteList(reverse('blog:tag', args=[tag.pk]), reverse('blog:tag_rss', args=[tag.pk]),
+                              tag.num_posts, Post.objects.filter(tags=tag)))
+    for month in ArchiveMonth.objects.filter(num_posts__gt=0):
+        start, end = month_range(month.year, month.month)
+        lists.append(SiteList(reverse('blog:archives', args=[month.year, month.month]), None, month.num_posts,
+                              Post.objects.filter(created_time__gte=start, created_time__lt=end)))
+    return {site_list.url: site_list for site_list in lists}
+
+
+def post_signatures():
+    """
+    每篇文章的签名：所在的分类、标签、归档月份和发布时间决定它出现在哪些列表的哪一页，
+    digest 覆盖详情页和列表页上显示的其他内容，related 是详情页上的相关文章及其标题，
+    两次生成之间签名不变的文章不需要重新生成
+    """
+    tags = {}
+    for post_id, tag_id in Post.tags.through.objects.order_by('post_id', 'tag_id').values_list('post_id', 'tag_id'):
+        tags.setdefault(post_id, []).append(tag_id)
+    related = {}
+    for post_id, related_id, title in RelatedPost.objects.order_by('post_id', '-score', '-related_id') \
+            .values_list('post_id', 'related_id', 'related__title'):
+        related.setdefault(post_id, []).append((related_id, title))
+    fields = ('pk', 'title', 'body_hash', 'excerpt', 'created_time', 'updated_time', 'comment_count',
+              'category_id', 'author_id')
+    signatures = {}
+    for pk, title, hash_, excerpt, created_time, updated_time, comment_count, category_id, author_id in \
+            Post.objects.order_by().values_list(*fields).iterator():
+        digest = hashlib.sha1(repr((title, hash_, excerpt, updated_time.isoformat(), comment_count,
+                                    author_id)).encode('utf-8')).hexdigest()[:16]
+        signatures[str(pk)] = {
+            'created': created_time.isoformat(),
+            'category': category_id,
+            'tags': tags.get(pk, []),
+            'month': list(month_of(created_time)),
+            'digest': digest,
+            'related': hashlib.sha1(repr(related.get(pk, [])).encode('utf-8')).hexdigest()[:16],
+        }
+    return signatures
+
+
+def sidebar_fingerprint():
+    # 侧边栏出现在每个页面上，它变化时所有页面都要重新生成
+    data = (
+        [(post.pk, post.title) for post in sidebar.recent_posts(sidebar.RECENT_POSTS_CACHE_SIZE)],
+        [(month.year, month.month, month.num_posts) for month in sidebar.archives()],
+        [(category.pk, category.name, category.num_posts) for category in sidebar.categories()],
+        [(tag.pk, tag.name, tag.num_posts) for tag in sidebar.tags()],
+    )
+    return hashlib.sha1(repr(data).encode('utf-8')).hexdigest()
+
+
+def lists_of(signature):
+    urls = [reverse('blog:index'), reverse('blog:category', args=[signature['category']]),
+            reverse('blog:archives', args=signature['month'])]
+    urls.extend(reverse('blog:tag', args=[tag_id]) for tag_id in signature['tags'])
+    return urls
+
+
+def placement(signature):
+    # 决定文章出现在哪些列表的哪一页的那部分签名
+    return {k: v for k, v in signature.items() if k not in ('digest', 'related')}
+
+
+def plan(state, signatures, lists, full):
+    """
+    根据上次生成时的状态算出需要生成和删除的页面
+    """
+    old_posts = state.get('posts', {})
+    old_lists = state.get('lists', {})
+    render, remove = set(), set()
+    # 文章集合或顺序变化的列表，每一页都会变
+    dirty_lists = set(lists) if full else set()
+    for pk in set(old_posts) | set(signatures):
+        old, new = old_posts.get(pk), signatures.get(pk)
+        if old == new and not full:
+            continue
+        detail_url = reverse('blog:detail', args=[pk])
+        if new is None:
+            remove.add(detail_url)
+            dirty_lists.update(lists_of(old))
+            continue
+        render.add(detail_url)
+        if full:
+            continue
+        if old is None or placement(old) != placement(new):
+            dirty_lists.update(lists_of(new))
+            if old is not None:
+                dirty_lists.update(lists_of(old))
+        elif old['digest'] != new['digest']:
+            # 只是内容变了，只需要重新生成文章所在的那一页和RSS
+            created_time = datetime.fromisoformat(new['created'])
+            for url in lists_of(new):
+                if url in lists:
+                    render.update(page_of(lists[url], created_time))
+                    if lists[url].feed_url:
+                        render.add(lists[url].feed_url)
+
+    for url in dirty_lists:
+        site_list = lists.get(url)
+        old_feed, old_pages = old_lists.get(url, (None, 0))
+        if site_list is None:
+            # 列表已经没有文章了
+            remove.update([url] + ['%s?page=%d' % (url, n) for n in range(1, old_pages + 1)])
+            if old_feed:
+                remove.add(old_feed)
+            continue
+        render.update(page_urls(site_list))
+        remove.update('%s?page=%d' % (url, n) for n in range(num_pages(site_list.count) + 1, old_pages + 1))
+    if full:
+        for url, (feed_url, pages) in old_lists.items():
+            if url not in lists:
+                remove.update([url] + ['%s?page=%d' % (url, n) for n in range(1, pages + 1)])
+                if feed_url:
+                    remove.add(feed_url)
+    return render, remove - render
+
+
+def write_sitemap(root, base_url, lists):
+    base_url = base_url.rstrip('/')
+    entries = [('%s%s' % (base_url, url), None) for url in sorted(lists)]
+    entries.extend(('%s%s' % (base_url, reverse('blog:detail', args=[pk])), updated_time.date().isoformat())
+                   for pk, updated_time in Post.objects.order_by('pk').values_list('pk', 'updated_time').iterator())
+    chunks = [entries[i:i + SITEMAP_LIMIT] for i in range(0, len(entries), SITEMAP_LIMIT)] or [[]]
+    for old in glob.glob(os.path.join(root, 'sitemap-*.xml')):
+        os.remove(old)
+    if len(chunks) == 1:
+        write_file(os.path.join(root, SITEMAP_FILE), sitemap_xml(chunks[0]))
+        return
+    # URL太多时拆成多个文件，sitemap.xml 作为索引
+    names = ['sitemap-%d.xml' % (i + 1) for i in range(len(chunks))]
+    for name, chunk in zip(names, chunks):
+        write_file(os.path.join(root, name), sitemap_xml(chunk))
+    write_file(os.path.join(root, SITEMAP_FILE), '\n'.join(
+        ['<?xml version="1.0" encoding="UTF-8"?>',
+         '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'] +
+        ['<sitemap><loc>%s/%s</loc></sitemap>' % (escape(base_url), name) for name in names] +
+        ['</sitemapindex>', '']))
+
+
+def sitemap_xml(entries):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
+    for loc, lastmod in entries:
+        if lastmod:
+            lines.append('<url><loc>%s</loc><lastmod>%s</lastmod></url>' % (escape(loc), lastmod))
+        else:
+            lines.append('<url><loc>%s</loc></url>' % escape(loc))
+    lines.extend(['</urlset>', ''])
+    return '\n'.join(lines)
+
+
+def load_state(root):
+    try:
+        with open(os.path.join(root, STATE_FILE), encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def build(root, host, base_url, jobs=None, full=False, chunk_size=50):
+    """
+    生成静态页面。上次生成的状态保存在输出目录的 .build-state.json 中，
+    没有状态、侧边栏变化或者指定 full 时全部重新生成，否则只生成文章变化影响到的页面
+    """
+    state = load_state(root)
+    signatures = post_signatures()
+    lists = current_lists()
+    fingerprint = sidebar_fingerprint()
+    full = full or state is None or state.get('fingerprint') != fingerprint
+    render, remove = plan(state or {}, signatures, lists, full)
+
+    for url in remove:
+        remove_page(root, url)
+    urls = sorted(render)
+    chunks = [urls[i:i + chunk_size] for i in range(0, len(urls), chunk_size)]
+    if jobs == 1 or len(chunks) <= 1:
+        rendered = sum(render_urls(chunk, root, host) for chunk in chunks)
+    else:
+        # 子进程不能共用父进程的数据库连接，fork之前先关掉
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker) as pool:
+            rendered = sum(pool.map(render_urls, chunks, repeat(root), repeat(host)))
+    if render or remove or full:
+        write_sitemap(root, base_url, lists)
+
+    write_file(os.path.join(root, STATE_FILE), json.dumps({
+        'fingerprint': fingerprint,
+        'posts': signatures,
+        'lists': {url: (site_list.feed_url, num_pages(site_list.count) if settings.PAGINATION_MODE == 'offset' else 0)
+                  for url, site_list in lists.items()},
+    }))
+    return BuildResult(full, rendered, len(remove))
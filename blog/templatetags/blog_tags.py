@@ -1,29 +1,52 @@
-from ..models import Post, Category,Tag
 from django import template
-from django.db.models.aggregates import Count
+from .. import sidebar
+from ..instrumentation import timed
 
 register = template.Library()
 
 
+# 侧边栏的数据都缓存在共享缓存里，文章、分类、标签变化时由信号删除缓存，见 blog/sidebar.py
 # 最新文章模板标签
 @register.simple_tag
 def get_recent_posts(num=5):
-    return Post.objects.all().order_by('-created_time')[:num]
+    return sidebar.recent_posts(num)
 
 
 # 归档模板标签
 @register.simple_tag
 def archives():
-    return Post.objects.dates('created_time', 'month', order='DESC')
+    return sidebar.archives()
 
 
 # 分类模板标签
 @register.simple_tag
 def get_categories():
-    return Category.objects.annotate(num_posts=Count('post')).filter(num_posts__gt=0)
+    return sidebar.categories()
 
 
 # 标签云
 @register.simple_tag
 def get_tags():
-    return Tag.objects.annotate(num_posts=Count('post')).filter(num_posts__gt=0)
+    return sidebar.tags()
+
+
+# {% timed "sidebar" %}...{% endtimed %} 记录一段模板的渲染耗时，见 blog/instrumentation.py
+@register.tag('timed')
+def do_timed(parser, token):
+    try:
+        tag_name, name = token.split_contents()
+    except ValueError:
+        raise template.TemplateSyntaxError('%r 标签需要一个名字参数' % token.contents.split()[0])
+    nodelist = parser.parse(('endtimed',))
+    parser.delete_first_token()
+    return TimedNode(nodelist, name.strip('"\''))
+
+
+class TimedNode(template.Node):
+    def __init__(self, nodelist, name):
+        self.nodelist = nodelist
+        self.name = name
+
+    def render(self, context):
+        with timed(self.name):
+            return self.nodelist.render(context)
@@ -1,3 +1,990 @@
-from django.test import TestCase
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from importlib import import_module
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps
+from django.contrib.admin.helpers import ACTION_CHECKBOX_NAME
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection, router
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from blogsite.db import PrimaryPinningMiddleware, use_primary
+from comments.models import Comment
+from . import pagecache, paginators, related, sidebar, staticsite, transfer, warmup
+from .metrics import Histogram, metrics
+from .models import ArchiveMonth, Category, Post, PostQuerySet, RelatedPost, Tag
+from .renderers import InlineRenderer, PoolRenderer, RenderResult
+from .rendering import highlight_cache, render_markdown
+from .search import Fts5SearchBackend, PythonSearchBackend, get_search_backend, tokenize
+from .views import IndexView
+from .viewcount import view_counter
+
+
+def slow_render(body):
+    # 进程池渲染测试用，模拟渲染时卡住的文章
+    if body.startswith('slow'):
+        time.sleep(30)
+    elif body.startswith('busy'):
+        time.sleep(0.6)
+    return render_markdown(body)
+
+
+@override_settings(VIEW_COUNT_FLUSH_INTERVAL=0, HIGHLIGHT_CACHE_ALIAS='default', MARKDOWN_RENDERER='inline')
+class BlogTestCase(TestCase):
+    def setUp(self):
+        view_counter.clear()
+        cache.clear()
+        highlight_cache.clear()
+        self.addCleanup(view_counter.clear)
+        self.user = User.objects.create_user('admin', 'admin@example.com', 'password')
+        self.category = Category.objects.create(name='Django')
+
+    def create_post(self, title='标题', body='# 标题\n\n正文', **kwargs):
+        now = timezone.now()
+        kwargs.setdefault('created_time', now)
+        kwargs.setdefault('updated_time', now)
+        kwargs.setdefault('category', self.category)
+        return Post.objects.create(title=title, body=body, author=self.user, **kwargs)
+
+
+class QueryBudgetMixin(object):
+    """
+    查询预算断言：用不同的每页文章数请求同一个列表页，查询次数都必须等于budget，
+    保证列表页的查询次数不会随着每页文章数增长（即没有N+1查询）
+    测量时关闭整页缓存，测量前先请求一次，让侧边栏缓存处于已预热的状态
+    """
+    page_sizes = (1, 5)
+
+    @override_settings(PAGE_CACHE_ENABLED=False)
+    def assertQueryBudget(self, url, budget, data=None):
+        self.client.get(url, data)
+        for page_size in self.page_sizes:
+            with mock.patch.object(IndexView, 'paginate_by', page_size):
+                with self.assertNumQueries(budget):
+                    response = self.client.get(url, data)
+                    self.assertEqual(response.status_code, 200)
+
+
+class PostRenderTestCase(BlogTestCase):
+    def test_save_renders_body_and_toc(self):
+        post = self.create_post(body='# Hello\n\n```python\nprint(1)\n```')
+        self.assertIn('<h1 id="hello">Hello</h1>', post.body_html)
+        self.assertIn('codehilite', post.body_html)
+        self.assertIn('href="#hello"', post.toc_html)
+        self.assertFalse(post.needs_render())
+
+    def test_reused_markdown_keeps_no_state_between_documents(self):
+        # 同一个实例渲染第二次时标题id不会因为上一篇的标题变成 hello_1
+        first = render_markdown('# Hello\n\n正文')
+        self.assertEqual(render_markdown('# Hello\n\n正文'), first)
+        html, toc = render_markdown('# World')
+        self.assertIn('id="world"', html)
+        self.assertNotIn('hello', toc)
+
+    def test_save_without_body_change_does_not_render(self):
+        post = self.create_post()
+        post.body_html = 'cached'
+        post.title = '新标题'
+        post.save()
+        self.assertEqual(Post.objects.get(pk=post.pk).body_html, 'cached')
+
+    def test_excerpt_comes_from_the_same_render(self):
+        with mock.patch('blog.renderers.render_markdown', return_value=('<p>渲染一次</p>', '')) as render:
+            post = self.create_post(body='渲染一次')
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(post.excerpt, '渲染一次')
+
+    def test_save_without_render_defers_to_command(self):
+        post = Post(title='导入', body='**导入**的文章', author=self.user, category=self.category,
+                    created_time=timezone.now(), updated_time=timezone.now())
+        post.save(render=False)
+        self.assertEqual((post.body_html, post.excerpt), ('', ''))
+        call_command('render_posts', stdout=StringIO())
+        post.refresh_from_db()
+        self.assertEqual(post.excerpt, '导入的文章')
+
+    def test_detail_uses_stored_html(self):
+        post = self.create_post()
+        Post.objects.filter(pk=post.pk).update(body_html='<p>stored</p>')
+        response = self.client.get(reverse('blog:detail', args=[post.pk]))
+        self.assertContains(response, '<p>stored</p>')
+
+    def test_detail_write_back_updates_search_index(self):
+        post = self.create_post(body='旧的正文')
+        Post.objects.filter(pk=post.pk).update(body='新的正文 pelican', body_hash='')
+        self.assertEqual(get_search_backend().count('pelican'), 0)
+        self.client.get(post.get_absolute_url())
+        self.assertEqual(get_search_backend().search('pelican', 0, 10), [post.pk])
+
+    def test_render_posts_command_backfills_stale_posts(self):
+        post = self.create_post(body='**bold**')
+        Post.objects.filter(pk=post.pk).update(body_html='', toc_html='', body_hash='')
+        call_command('render_posts', stdout=StringIO())
+        post.refresh_from_db()
+        self.assertIn('<strong>bold</strong>', post.body_html)
+        self.assertFalse(post.needs_render())
+
+
+    def assertRerenderRefreshes(self, rerender):
+        post = self.create_post(body='旧的正文')
+        url = post.get_absolute_url()
+        etag = self.client.get(url)['ETag']
+        Post.objects.filter(pk=post.pk).update(body='新的正文 pelican', body_hash='')
+        rerender(post)
+        # 先查索引再访问详情页，详情页自己也会补渲染并更新索引
+        self.assertEqual(get_search_backend().search('pelican', 0, 10), [post.pk])
+        response = self.client.get(url)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertContains(response, 'pelican')
+
+    def test_render_posts_command_refreshes_page_cache_and_index(self):
+        self.assertRerenderRefreshes(lambda post: call_command('render_posts', jobs=1, stdout=StringIO()))
+
+    def test_admin_render_selected_refreshes_page_cache_and_index(self):
+        def rerender(post):
+            self.user.is_staff = self.user.is_superuser = True
+            self.user.save()
+            self.client.force_login(self.user)
+            self.client.post(reverse('admin:blog_post_changelist'), {
+                'action': 'render_selected', ACTION_CHECKBOX_NAME: [post.pk],
+            })
+            self.client.logout()
+        self.assertRerenderRefreshes(rerender)
+
+class ViewCountTestCase(BlogTestCase):
+    def test_detail_view_does_not_write(self):
+        post = self.create_post()
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('blog:detail', args=[post.pk]))
+        writes = [q['sql'] for q in ctx.captured_queries if not q['sql'].startswith('SELECT')]
+        self.assertEqual(writes, [])
+        self.assertEqual(view_counter.pending(post.pk), 1)
+
+    def test_flush_applies_buffered_increments(self):
+        first = self.create_post()
+        second = self.create_post()
+        for _ in range(3):
+            first.increase_views()
+        second.increase_views()
+        self.assertEqual(view_counter.flush(), 2)
+        self.assertEqual(Post.objects.get(pk=first.pk).views, 3)
+        self.assertEqual(Post.objects.get(pk=second.pk).views, 1)
+        self.assertEqual(view_counter.flush(), 0)
+
+
+    @override_settings(VIEW_COUNT_FLUSH_INTERVAL=3600)
+    def test_forked_child_starts_its_own_worker(self):
+        view_counter.incr(1)
+        self.assertTrue(view_counter._worker.is_alive())
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # 父进程缓冲的阅读量不会在子进程里再写回一次
+                pending = view_counter.pending(1)
+                view_counter.incr(2)
+                os.write(write, b'%d %d' % (pending, view_counter._worker.is_alive()))
+            finally:
+                os._exit(0)
+        os.close(write)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(read, 100), b'0 1')
+        os.close(read)
+
+
+class ListQueryBudgetTestCase(QueryBudgetMixin, BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tag = Tag.objects.create(name='python')
+        for i in range(6):
+            post = self.create_post(title='文章 %d' % i)
+            post.tags.add(self.tag)
+            for j in range(i):
+                Comment.objects.create(name='u', email='u@example.com', url='', text='评论', post=post)
+        self.post = post
+
+    def test_index(self):
+        # 只查询本页文章，分页总数和侧边栏都来自缓存的物化计数
+        self.assertQueryBudget(reverse('blog:index'), 1)
+
+    def test_archives(self):
+        created = timezone.localtime(self.post.created_time)
+        self.assertQueryBudget(reverse('blog:archives', args=[created.year, created.month]), 1)
+
+    def test_category(self):
+        self.assertQueryBudget(reverse('blog:category', args=[self.category.pk]), 1)
+
+    def test_tag(self):
+        self.assertQueryBudget(reverse('blog:tag', args=[self.tag.pk]), 1)
+
+    def test_listing_counts_follow_changes(self):
+        other = Category.objects.create(name='其他')
+        response = self.client.get(reverse('blog:category', args=[other.pk]))
+        self.assertEqual(response.context['paginator'].count, 0)
+        self.post.category = other
+        self.post.save()
+        self.post.tags.remove(self.tag)
+        response = self.client.get(reverse('blog:category', args=[other.pk]))
+        self.assertEqual(response.context['paginator'].count, 1)
+        for url, count in ((reverse('blog:index'), 6), (reverse('blog:category', args=[self.category.pk]), 5),
+                           (reverse('blog:tag', args=[self.tag.pk]), 5)):
+            paginator = self.client.get(url).context['paginator']
+            self.assertEqual(paginator.count, count)
+            self.assertEqual(paginator.count, paginator.object_list.count())
+
+    def test_search(self):
+        self.assertQueryBudget(reverse('blog:search'), 3, {'q': '文章'})
+
+    def test_hot_queries_use_indexes(self):
+        call_command('check_query_plans', stdout=StringIO())
+
+    def test_archives_month_boundaries(self):
+        december = timezone.make_aware(timezone.datetime(2018, 12, 31, 23, 59))
+        self.create_post(title='十二月', created_time=december)
+        self.create_post(title='一月', created_time=december + timezone.timedelta(minutes=2))
+        response = self.client.get(reverse('blog:archives', args=[2018, 12]))
+        self.assertEqual([post.title for post in response.context['posts']], ['十二月'])
+        self.assertEqual(self.client.get(reverse('blog:archives', args=[2018, 13])).status_code, 404)
+
+    def test_comment_count(self):
+        response = self.client.get(reverse('blog:index'))
+        self.assertContains(response, '5 评论')
+
+
+class SearchTestCase(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.django = self.create_post(title='Django 入门教程', body='介绍如何使用 Django 搭建博客')
+        self.python = self.create_post(title='Python 笔记', body='在博客里记录 Python 和 Django 的学习')
+        self.other = self.create_post(title='随笔', body='今天天气不错')
+
+    def test_tokenize_splits_cjk_into_bigrams(self):
+        self.assertEqual(tokenize('Django博客教程'), ['django', '博客', '客教', '教程'])
+
+    def test_backends_rank_title_matches_first(self):
+        python_backend = PythonSearchBackend()
+        python_backend.rebuild(Post.objects.all())
+        for backend in (Fts5SearchBackend(), python_backend):
+            self.assertEqual(backend.count('django'), 2)
+            self.assertEqual(backend.search('django', 0, 10), [self.django.pk, self.python.pk])
+            self.assertEqual(backend.search('天气', 0, 10), [self.other.pk])
+            self.assertEqual(backend.search('博客 python', 0, 10), [self.python.pk])
+
+    def test_single_cjk_character_matches(self):
+        python_backend = PythonSearchBackend()
+        python_backend.rebuild(Post.objects.all())
+        for backend in (Fts5SearchBackend(), python_backend):
+            self.assertCountEqual(backend.search('博', 0, 10), [self.django.pk, self.python.pk])
+            self.assertEqual(backend.search('记', 0, 10), [self.python.pk])
+            self.assertEqual(backend.search('天', 0, 10), [self.other.pk])
+
+    def test_migration_fills_index_of_existing_posts(self):
+        fill_fts_table = import_module('blog.migrations.0009_reindex_post_fts').fill_fts_table
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM blog_post_fts')
+        self.assertEqual(Fts5SearchBackend().count('django'), 0)
+        fill_fts_table(apps, connection)
+        self.assertEqual(Fts5SearchBackend().search('django', 0, 10), [self.django.pk, self.python.pk])
+
+    def test_index_follows_save_and_delete(self):
+        backend = Fts5SearchBackend()
+        self.other.body = '学习 Django'
+        self.other.save()
+        self.assertEqual(backend.count('django'), 3)
+        self.other.delete()
+        self.assertEqual(backend.count('django'), 2)
+
+    def test_search_view_paginates_with_highlight(self):
+        response = self.client.get(reverse('blog:search'), {'q': '博客'})
+        self.assertEqual(response.context['paginator'].count, 2)
+        self.assertContains(response, '<mark>博客</mark>')
+        self.assertContains(response, '?q=%E5%8D%9A%E5%AE%A2&page=2')
+
+
+class SidebarCacheTestCase(BlogTestCase):
+    def test_warm_sidebar_costs_no_queries(self):
+        self.create_post()
+        sidebar.recent_posts(), sidebar.archives(), sidebar.categories(), sidebar.tags()
+        hits = metrics.get('sidebar_cache.hit')
+        with self.assertNumQueries(0):
+            sidebar.recent_posts(), sidebar.archives(), sidebar.categories(), sidebar.tags()
+        self.assertEqual(metrics.get('sidebar_cache.hit'), hits + 4)
+
+    def test_signals_invalidate_sidebar(self):
+        post = self.create_post(title='旧标题')
+        tag = Tag.objects.create(name='django')
+        self.assertEqual(sidebar.tags(), [])
+        self.assertEqual(sidebar.recent_posts()[0].title, '旧标题')
+        post.tags.add(tag)
+        self.assertEqual([t.name for t in sidebar.tags()], ['django'])
+        post.title = '新标题'
+        post.save()
+        self.assertEqual(sidebar.recent_posts()[0].title, '新标题')
+        Category.objects.create(name='Python')
+        self.create_post(category=Category.objects.get(name='Python'))
+        self.assertEqual(len(sidebar.categories()), 2)
+
+
+@mock.patch.object(IndexView, 'pagination_mode', 'cursor')
+@mock.patch.object(IndexView, 'paginate_by', 2)
+class CursorPaginationTestCase(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        now = timezone.now()
+        # 两篇文章的创建时间相同，用来检查id作为第二排序键
+        self.posts = [self.create_post(title='文章 %d' % i, created_time=now - timezone.timedelta(days=i // 2 * 2))
+                      for i in range(5)]
+
+    def titles(self, response):
+        return [post.title for post in response.context['posts']]
+
+    def test_walk_forward_and_back(self):
+        url = reverse('blog:index')
+        response = self.client.get(url)
+        self.assertEqual(self.titles(response), ['文章 1', '文章 0'])
+        self.assertIsNone(response.context['previous_cursor'])
+        response = self.client.get(url, {'after': response.context['next_cursor']})
+        self.assertEqual(self.titles(response), ['文章 3', '文章 2'])
+        page_two = response.context
+        response = self.client.get(url, {'after': page_two['next_cursor']})
+        self.assertEqual(self.titles(response), ['文章 4'])
+        self.assertIsNone(response.context['next_cursor'])
+        response = self.client.get(url, {'before': page_two['previous_cursor']})
+        self.assertEqual(self.titles(response), ['文章 1', '文章 0'])
+        self.assertContains(response, '(共有5篇文章) 共3页')
+
+    def test_deep_page_is_a_single_query(self):
+        url = reverse('blog:index')
+        response = self.client.get(url)
+        with self.assertNumQueries(1):
+            self.client.get(url, {'after': response.context['next_cursor']})
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(reverse('blog:index'), {'after': 'abc'}).status_code, 404)
+
+    def test_cursor_past_either_end(self):
+        url = reverse('blog:index')
+        newest, oldest = paginators.encode_cursor(self.posts[1]), paginators.encode_cursor(self.posts[4])
+        future = paginators.encode_cursor(Post(pk=1, created_time=timezone.now() + timezone.timedelta(days=365)))
+        self.assertEqual(self.client.get(url, {'before': newest}).status_code, 404)
+        self.assertEqual(self.client.get(url, {'after': oldest}).status_code, 404)
+        self.assertEqual(self.client.get(url, {'before': future}).status_code, 404)
+        response = self.client.get(url, {'after': future})
+        self.assertEqual(self.titles(response), ['文章 1', '文章 0'])
+        # 旧链接指向的文章被删除后，游标仍然按时间定位
+        cursor = paginators.encode_cursor(self.posts[2])
+        self.posts[2].delete()
+        response = self.client.get(url, {'after': cursor})
+        self.assertEqual(self.titles(response), ['文章 4'])
+
+
+class PageCacheTestCase(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.post = self.create_post()
+        self.url = reverse('blog:detail', args=[self.post.pk])
+
+    def test_cached_page_skips_orm_and_counts_view(self):
+        self.client.get(self.url)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(view_counter.pending(self.post.pk), 2)
+
+    def test_conditional_get_returns_304(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_comment_invalidates_post_and_lists_only(self):
+        other = self.create_post()
+        other_url = reverse('blog:detail', args=[other.pk])
+        etags = {url: self.client.get(url)['ETag'] for url in (self.url, other_url, reverse('blog:index'))}
+        Comment.objects.create(name='u', email='u@example.com', url='', text='新评论', post=self.post)
+        self.assertNotEqual(self.client.get(self.url)['ETag'], etags[self.url])
+        self.assertNotEqual(self.client.get(reverse('blog:index'))['ETag'], etags[reverse('blog:index')])
+        self.assertEqual(self.client.get(other_url)['ETag'], etags[other_url])
+        self.assertContains(self.client.get(self.url), '新评论')
+
+    def test_cached_page_carries_each_readers_csrf_token(self):
+        self.client.get(self.url)
+        reader = Client(enforce_csrf_checks=True)
+        content = reader.get(self.url).content.decode()
+        self.assertNotIn(pagecache.CSRF_PLACEHOLDER, content)
+        token = re.search(r'name="csrfmiddlewaretoken" value="([^"]+)"', content).group(1)
+        response = reader.post(reverse('comments:post_comment', args=[self.post.pk]), {
+            'name': 'u', 'email': 'u@example.com', 'url': 'http://example.com', 'text': '评论',
+            'csrfmiddlewaretoken': token,
+        })
+        self.assertEqual(response.status_code, 302)
+
+
+@override_settings(FEED_ITEM_LIMIT=3)
+class FeedTestCase(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tag = Tag.objects.create(name='django')
+        for i in range(5):
+            post = self.create_post(title='文章 %d' % i, body='**正文 %d**' % i)
+            if i % 2:
+                post.tags.add(self.tag)
+
+    @override_settings(PAGE_CACHE_ENABLED=False)
+    def test_feed_is_bounded_and_joined(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('blog:rss'))
+        content = response.content.decode()
+        self.assertEqual(content.count('<item>'), 3)
+        self.assertIn('[Django] 文章 4', content)
+        self.assertIn('&lt;strong&gt;正文 4&lt;/strong&gt;', content)
+
+    def test_tag_and_category_feeds(self):
+        content = self.client.get(reverse('blog:tag_rss', args=[self.tag.pk])).content.decode()
+        self.assertEqual(content.count('<item>'), 2)
+        content = self.client.get(reverse('blog:category_rss', args=[self.category.pk])).content.decode()
+        self.assertEqual(content.count('<item>'), 3)
+        self.assertEqual(self.client.get(reverse('blog:tag_rss', args=[999])).status_code, 404)
+
+    def test_feed_ignores_comments_but_follows_posts(self):
+        etag = self.client.get(reverse('blog:rss'))['ETag']
+        Comment.objects.create(name='u', email='u@example.com', url='', text='评论', post=Post.objects.first())
+        self.assertEqual(self.client.get(reverse('blog:rss'), HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.create_post(title='新文章')
+        self.assertContains(self.client.get(reverse('blog:rss'), HTTP_IF_NONE_MATCH=etag), '新文章')
+
+
+class PostCountsTestCase(BlogTestCase):
+    def month_counts(self):
+        return {(m.year, m.month): m.num_posts for m in ArchiveMonth.objects.all()}
+
+    def num_posts(self, obj):
+        return type(obj).objects.get(pk=obj.pk).num_posts
+
+    def test_counts_follow_post_changes(self):
+        python = Category.objects.create(name='Python')
+        django, web = Tag.objects.create(name='django'), Tag.objects.create(name='web')
+        march = timezone.make_aware(timezone.datetime(2019, 3, 15))
+        post = self.create_post(created_time=march)
+        self.create_post(created_time=march)
+        self.assertEqual(self.month_counts(), {(2019, 3): 2})
+        self.assertEqual(self.num_posts(self.category), 2)
+
+        post.created_time = march + timezone.timedelta(days=30)
+        post.category = python
+        post.save()
+        self.assertEqual(self.month_counts(), {(2019, 3): 1, (2019, 4): 1})
+        self.assertEqual((self.num_posts(self.category), self.num_posts(python)), (1, 1))
+
+        post.tags.add(django, web)
+        web.post_set.add(Post.objects.exclude(pk=post.pk).get())
+        self.assertEqual((self.num_posts(django), self.num_posts(web)), (1, 2))
+        post.tags.remove(django)
+        web.post_set.clear()
+        self.assertEqual((self.num_posts(django), self.num_posts(web)), (0, 0))
+
+        post.tags.add(web)
+        post.delete()
+        self.assertEqual(self.month_counts(), {(2019, 3): 1, (2019, 4): 0})
+        self.assertEqual((self.num_posts(python), self.num_posts(web)), (0, 0))
+
+    def test_sidebar_archives_show_counts(self):
+        self.create_post()
+        self.create_post()
+        response = self.client.get(reverse('blog:index'))
+        self.assertEqual(response.context['date_list'][0].num_posts, 2)
+        self.assertContains(response, 'class="post-count">(2)</span>', count=2)
+
+    def test_rebuild_command(self):
+        tag = Tag.objects.create(name='django')
+        post = self.create_post()
+        post.tags.add(tag)
+        ArchiveMonth.objects.all().delete()
+        Category.objects.update(num_posts=0)
+        Tag.objects.update(num_posts=9)
+        call_command('rebuild_post_counts', stdout=StringIO())
+        self.assertEqual(sum(self.month_counts().values()), 1)
+        self.assertEqual((self.num_posts(self.category), self.num_posts(tag)), (1, 1))
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class DatabaseRoutingTestCase(SimpleTestCase):
+    def routed_alias(self, request):
+        middleware = PrimaryPinningMiddleware(lambda request: router.db_for_read(Post))
+        return middleware(request)
+
+    def test_reads_go_to_replica_unless_pinned(self):
+        self.assertEqual(router.db_for_read(Post), 'replica')
+        self.assertEqual(router.db_for_write(Post), 'default')
+        with use_primary():
+            self.assertEqual(router.db_for_read(Post), 'default')
+        self.assertEqual(router.db_for_read(Post), 'replica')
+
+    def test_middleware_pins_writes_admin_and_sessions(self):
+        factory = RequestFactory()
+        self.assertEqual(self.routed_alias(factory.get('/')), 'replica')
+        self.assertEqual(self.routed_alias(factory.post('/comment/1')), 'default')
+        self.assertEqual(self.routed_alias(factory.get('/admin/')), 'default')
+        request = factory.get('/')
+        request.COOKIES['sessionid'] = 'x'
+        self.assertEqual(self.routed_alias(request), 'default')
+        self.assertEqual(router.db_for_read(Post), 'replica')
+
+
+    def test_read_then_write_commands_use_primary(self):
+        seen = []
+
+        def record(*args, **kwargs):
+            seen.append(router.db_for_read(Post))
+            return 0
+
+        with mock.patch('blog.counts.rebuild', record), mock.patch('blog.related.rebuild', record):
+            call_command('rebuild_post_counts', stdout=StringIO())
+            call_command('rebuild_related_posts', stdout=StringIO())
+        self.assertEqual(seen, ['default', 'default'])
+        self.assertEqual(router.db_for_read(Post), 'replica')
+
+
+class SqlitePragmaTestCase(TestCase):
+    def test_pragmas_applied_on_connect(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 5000)
+
+
+class StaticSiteTestCase(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.posts = [self.create_post(title='文章 %d' % i, created_time=timezone.now() - timezone.timedelta(hours=i))
+                      for i in range(3)]
+
+    def build(self, **kwargs):
+        return staticsite.build(self.root, 'testserver', 'https://example.com', jobs=1, **kwargs)
+
+    def page(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def test_full_then_incremental_build(self):
+        result = self.build()
+        self.assertTrue(result.full)
+        for parts in [('index.html',), ('page-3.html',), ('post', str(self.posts[0].pk), 'index.html'),
+                      ('category', str(self.category.pk), 'page-2.html'), ('all', 'rss', 'index.xml')]:
+            self.assertTrue(os.path.exists(self.page(*parts)), parts)
+        with open(self.page('post', str(self.posts[0].pk), 'index.html'), encoding='utf-8') as f:
+            self.assertIn('value="__CSRF_TOKEN__"', f.read())
+        with open(self.page('sitemap.xml'), encoding='utf-8') as f:
+            self.assertIn('<loc>https://example.com/post/%d</loc>' % self.posts[2].pk, f.read())
+        self.assertEqual(self.build().rendered, 0)
+
+        # 只改了正文：重新生成详情页、文章所在的那一页和RSS
+        post = self.posts[2]
+        post.body = '新的正文'
+        post.save()
+        result = self.build()
+        self.assertFalse(result.full)
+        self.assertEqual(result.rendered, 6)
+
+        # 删除文章后侧边栏变化，全量生成并删掉多出来的页面
+        post.delete()
+        result = self.build()
+        self.assertTrue(result.full)
+        self.assertFalse(os.path.exists(self.page('post', str(post.pk), 'index.html')))
+        self.assertFalse(os.path.exists(self.page('page-3.html')))
+        self.assertTrue(os.path.exists(self.page('page-2.html')))
+
+    def test_error_responses_fail_the_build_without_removing_pages(self):
+        self.build()
+        with override_settings(ALLOWED_HOSTS=['example.com']):
+            with self.assertRaisesMessage(staticsite.BuildError, '400'):
+                self.build(full=True)
+            with self.assertRaisesMessage(CommandError, 'ALLOWED_HOSTS'):
+                call_command('build_static_site', output=self.root, jobs=1, host='testserver', stdout=StringIO())
+        self.assertTrue(os.path.exists(self.page('post', str(self.posts[0].pk), 'index.html')))
+        with override_settings(ALLOWED_HOSTS=[], DEBUG=False):
+            with self.assertRaisesMessage(CommandError, '--host'):
+                call_command('build_static_site', output=self.root, jobs=1, stdout=StringIO())
+
+    def test_related_title_change_rerenders_detail_only(self):
+        renamed = str(self.posts[1].pk)
+        listed_by = {str(pk) for pk in RelatedPost.objects.filter(related=self.posts[1]).values_list('post_id', flat=True)}
+        self.assertTrue(listed_by)
+        before = staticsite.post_signatures()
+        Post.objects.filter(pk=renamed).update(title='新标题')
+        after = staticsite.post_signatures()
+        # 只看列出了这篇文章的那些文章：只需要重新生成它们的详情页
+        before[renamed] = after[renamed]
+        render, remove = staticsite.plan({'posts': before, 'lists': {}}, after, staticsite.current_lists(), False)
+        self.assertEqual(render, {reverse('blog:detail', args=[pk]) for pk in listed_by})
+        self.assertEqual(remove, set())
+
+    def test_csrf_token_endpoint_sets_cookie(self):
+        response = self.client.get(reverse('comments:csrf_token'))
+        self.assertTrue(response.json()['token'])
+        self.assertIn('csrftoken', response.cookies)
+
+
+class InstrumentationTestCase(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+        self.post = self.create_post(body='# 标题\n\n```python\nprint(1)\n```')
+
+    @override_settings(PERF_SAMPLE_RATE=1, PERF_SERVER_TIMING=True, PAGE_CACHE_ENABLED=False)
+    def test_sampled_request_reports_server_timing(self):
+        Post.objects.filter(pk=self.post.pk).update(body_hash='')
+        response = self.client.get(reverse('blog:detail', args=[self.post.pk]))
+        entries = {entry.split(';')[0]: entry for entry in response['Server-Timing'].split(', ')}
+        for name in ('total', 'db', 'markdown', 'template', 'sidebar', 'sidebar_cache.miss'):
+            self.assertIn(name, entries)
+        self.assertEqual(metrics.histogram('request:blog:detail')['count'], 1)
+        self.assertEqual(metrics.histogram('markdown')['count'], 1)
+        self.assertGreater(metrics.get('db.queries'), 0)
+
+    @override_settings(PERF_SAMPLE_RATE=1, PERF_SERVER_TIMING=False)
+    def test_server_timing_can_be_turned_off(self):
+        response = self.client.get(reverse('blog:index'))
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(metrics.histogram('request')['count'], 1)
+
+    @override_settings(PERF_SAMPLE_RATE=0)
+    def test_unsampled_request_is_not_recorded(self):
+        response = self.client.get(reverse('blog:index'))
+        self.assertNotIn('Server-Timing', response)
+        self.assertIsNone(metrics.histogram('request'))
+        # 计数器不受抽样影响
+        self.assertEqual(metrics.get('page_cache.miss'), 1)
+
+    def test_metrics_view_reports_rates_and_histograms(self):
+        metrics.incr('page_cache.hit', 3)
+        metrics.incr('page_cache.miss')
+        metrics.observe('request', 12)
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        report = self.client.get(reverse('blog:metrics')).json()
+        self.assertEqual(report['rates']['page_cache.hit_rate'], 0.75)
+        self.assertEqual(report['histograms']['request']['p50_ms'], 25)
+
+    def test_histogram_quantiles(self):
+        histogram = Histogram()
+        for value in [0.5] * 90 + [30] * 9 + [9000]:
+            histogram.observe(value)
+        self.assertEqual((histogram.quantile(0.5), histogram.quantile(0.99)), (1, 50))
+        self.assertEqual(histogram.snapshot()['buckets']['le_+Inf'], 1)
+
+
+class HighlightCacheTestCase(BlogTestCase):
+    BODY = '[TOC]\n\n## 第一节\n\n说明 %s\n\n```python\ndef a():\n    return %d\n```\n\n' \
+           '    :::js\n    var b = 2;\n\n```\nno language\n```\n'
+
+    def render(self, text='一', value=1):
+        return render_markdown(self.BODY % (text, value))
+
+    def test_output_matches_uncached_rendering(self):
+        from markdown.extensions.codehilite import CodeHilite
+        self.render()
+        with mock.patch.object(CodeHilite, 'hilite', CodeHilite.hilite.__wrapped__):
+            expected = self.render()
+        self.assertIn('class="codehilite"', expected[0])
+        self.assertEqual(self.render(), expected)
+
+    def test_only_changed_blocks_are_highlighted(self):
+        self.render()
+        misses = metrics.get('highlight_cache.miss')
+        self.render(text='二')
+        self.assertEqual(metrics.get('highlight_cache.miss'), misses)
+        self.render(text='二', value=2)
+        self.assertEqual(metrics.get('highlight_cache.miss'), misses + 1)
+
+    def test_persistent_store_survives_lru_eviction(self):
+        self.render()
+        highlight_cache.clear()
+        misses = metrics.get('highlight_cache.miss')
+        with override_settings(HIGHLIGHT_CACHE_SIZE=1):
+            self.render()
+        self.assertEqual(metrics.get('highlight_cache.miss'), misses)
+        highlight_cache.clear()
+        with override_settings(HIGHLIGHT_CACHE_ALIAS=None):
+            self.render()
+        self.assertEqual(metrics.get('highlight_cache.miss'), misses + 3)
+
+
+class RelatedPostsTestCase(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.python, self.web, self.common = [Tag.objects.create(name=name) for name in ('python', 'web', 'common')]
+        other = Category.objects.create(name='其他')
+        self.post = self.create_post(title='主文章')
+        self.post.tags.add(self.python, self.web, self.common)
+        self.close = self.create_post(title='很相关', category=other)
+        self.close.tags.add(self.python, self.web)
+        self.loose = self.create_post(title='有点相关', category=other)
+        self.loose.tags.add(self.common)
+        self.unrelated = self.create_post(title='无关', category=other)
+        for i in range(3):
+            self.create_post(title='填充 %d' % i, category=other).tags.add(self.common)
+
+    def related_titles(self, post):
+        return [p.title for p in related.related_for(post)]
+
+    def test_rebuild_ranks_by_shared_rare_tags(self):
+        incremental = self.related_titles(self.post)
+        self.assertGreater(related.rebuild(), 0)
+        titles = self.related_titles(self.post)
+        self.assertEqual(titles[0], '很相关')
+        self.assertIn('有点相关', titles)
+        self.assertNotIn('无关', titles)
+        # 增量维护时各篇的得分用的是当时的标签文章数，排序可能不同，但选出的文章一致
+        self.assertEqual(set(titles), set(incremental))
+
+    def test_tag_changes_update_both_sides(self):
+        self.unrelated.tags.add(self.python, self.web)
+        self.assertIn('无关', self.related_titles(self.post))
+        self.assertIn('主文章', self.related_titles(self.unrelated))
+        self.unrelated.tags.clear()
+        self.assertNotIn('无关', self.related_titles(self.post))
+        self.python.post_set.clear()
+        self.web.post_set.clear()
+        self.assertNotIn('很相关', self.related_titles(self.post))
+
+    def test_deleted_post_is_replaced(self):
+        self.close.delete()
+        self.assertNotIn('很相关', self.related_titles(self.post))
+        self.assertIn('有点相关', self.related_titles(self.post))
+
+    def test_detail_shows_related_posts(self):
+        response = self.client.get(self.post.get_absolute_url())
+        self.assertContains(response, '相关文章')
+        self.assertEqual(response.context['related_posts'][0], self.close)
+
+
+class TransferTestCase(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        python = Tag.objects.create(name='python')
+        post = self.create_post(title='第一篇', body='# 标题\n\n```python\nprint(1)\n```\n')
+        post.tags.add(python, Tag.objects.create(name='web'))
+        self.create_post(title='第二篇', category=Category.objects.create(name='随笔'))
+
+    def reimport(self, source, **options):
+        Post.objects.all().delete()
+        call_command('import_posts', source, jobs=1, stdout=StringIO(), **options)
+        return Post.objects.order_by('pk')
+
+    def assertRoundTrip(self, posts):
+        self.assertEqual([(p.title, p.category.name, sorted(t.name for t in p.tags.all())) for p in posts],
+                         [('第一篇', 'Django', ['python', 'web']), ('第二篇', '随笔', [])])
+        self.assertIn('codehilite', posts[0].body_html)
+        self.assertFalse(posts[0].needs_render())
+        # 名字相同的分类和标签复用原来的记录
+        self.assertEqual(Category.objects.count(), 2)
+        self.assertEqual(Tag.objects.count(), 2)
+        self.assertEqual(Tag.objects.get(name='python').num_posts, 1)
+        self.assertEqual(Category.objects.get(name='Django').num_posts, 1)
+        self.assertEqual(get_search_backend().count('第一篇'), 1)
+
+    def test_jsonl_round_trip(self):
+        path = os.path.join(self.tmpdir, 'posts.jsonl')
+        call_command('export_posts', path, stdout=StringIO())
+        self.assertRoundTrip(self.reimport(path, batch_size=1))
+
+    def test_markdown_round_trip(self):
+        path = os.path.join(self.tmpdir, 'posts')
+        call_command('export_posts', path, format='markdown', stdout=StringIO())
+        self.assertEqual(len(os.listdir(path)), 2)
+        self.assertRoundTrip(self.reimport(path))
+
+    def test_handwritten_front_matter(self):
+        record = transfer.parse_front_matter('---\ntitle: 你好\ntags: ["a", "b"]\ncategory: 随笔\n---\n正文\n')
+        self.assertEqual(record, {'title': '你好', 'tags': ['a', 'b'], 'category': '随笔', 'body': '正文\n'})
+        path = os.path.join(self.tmpdir, 'posts.jsonl')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('{"title": "无作者", "category": "随笔", "body": "x"}\n')
+        with self.assertRaisesMessage(CommandError, '--author'):
+            call_command('import_posts', path, jobs=1, stdout=StringIO())
+        call_command('import_posts', path, jobs=1, author='admin', stdout=StringIO())
+        self.assertEqual(Post.objects.get(title='无作者').author, self.user)
+
+    def test_aborted_import_rebuilds_counts_of_committed_batches(self):
+        path = os.path.join(self.tmpdir, 'posts.jsonl')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('{"title": "已导入", "category": "Django", "tags": ["python"], "author": "admin", "body": "x"}\n')
+            f.write('{"title": "另一篇", "category": "Django", "tags": ["python"], "author": "admin", "body": "x"}\n')
+            f.write('{"title": "出错", "category": "随笔", "author": "nobody", "body": "x"}\n')
+        with self.assertRaisesMessage(CommandError, '已导入 2 篇'):
+            call_command('import_posts', path, jobs=1, batch_size=2, stdout=StringIO())
+        self.assertFalse(Post.objects.filter(title='出错').exists())
+        self.assertEqual(Tag.objects.get(name='python').num_posts, 3)
+        self.assertEqual(Category.objects.get(name='Django').num_posts, 3)
+        related_titles = RelatedPost.objects.filter(post__title='已导入').values_list('related__title', flat=True)
+        self.assertIn('第一篇', list(related_titles))
+
+    def test_import_does_not_reuse_deleted_ids(self):
+        deleted_pk = self.create_post(title='已删除').pk
+        Post.objects.filter(pk=deleted_pk).delete()
+        path = os.path.join(self.tmpdir, 'posts.jsonl')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('{"title": "新文章", "category": "Django", "tags": ["python"], "author": "admin", "body": "x"}\n')
+        call_command('import_posts', path, jobs=1, stdout=StringIO())
+        post = Post.objects.get(title='新文章')
+        self.assertGreater(post.pk, deleted_pk)
+        self.assertEqual([t.name for t in post.tags.all()], ['python'])
+        self.assertGreater(self.create_post(title='之后').pk, post.pk)
+
+    def test_plain_string_tags(self):
+        path = os.path.join(self.tmpdir, 'posts')
+        os.mkdir(path)
+        for name, tags in [('a.md', 'python'), ('b.md', 'python, 随笔'), ('c.md', '')]:
+            with open(os.path.join(path, name), 'w', encoding='utf-8') as f:
+                f.write('---\ntitle: %s\ncategory: 随笔\ntags: %s\n---\n正文\n' % (name, tags))
+        posts = self.reimport(path, author='admin')
+        self.assertEqual([sorted(t.name for t in p.tags.all()) for p in posts], [['python'], ['python', '随笔'], []])
+        self.assertFalse(Tag.objects.filter(name='p').exists())
+        with self.assertRaisesMessage(ValueError, '标签'):
+            transfer.tag_names({'title': 'x', 'tags': 3})
+
+
+@override_settings(PAGE_CACHE_ENABLED=False)
+class ListMemoryTestCase(BlogTestCase):
+    BODY_SIZE = 200 * 1024
+
+    def setUp(self):
+        super().setUp()
+        for i in range(5):
+            self.create_post(title='长文章 %d' % i)
+        # 直接改数据库，不用真的渲染几百KB的Markdown
+        Post.objects.update(body='正' * self.BODY_SIZE, body_html='<p>%s</p>' % ('文' * self.BODY_SIZE))
+
+    def peak(self, url):
+        self.client.get(url)
+        tracemalloc.start()
+        try:
+            response = self.client.get(url)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            self.assertEqual(response.status_code, 200)
+
+    @mock.patch.object(IndexView, 'paginate_by', 5)
+    def test_list_pages_do_not_load_bodies(self):
+        urls = [reverse('blog:index'), reverse('blog:category', args=[self.category.pk])]
+        self.client.get(urls[0])
+        with self.assertNumQueries(1):
+            self.client.get(urls[0])
+        for url in urls:
+            light = self.peak(url)
+            with mock.patch.object(PostQuerySet, 'summaries', lambda queryset, *keep: queryset):
+                full = self.peak(url)
+            # 5篇文章的正文加正文HTML至少有2MB（中文字符在Python中每个2字节以上），不加载时峰值内存小得多
+            self.assertGreater(full - light, 5 * 2 * self.BODY_SIZE * 2)
+            self.assertLess(light, self.BODY_SIZE * 2)
+
+
+class RendererTestCase(BlogTestCase):
+    def test_oversized_body_is_escaped(self):
+        with override_settings(MARKDOWN_MAX_BODY_SIZE=20):
+            post = self.create_post(body='<script>x</script> **很长很长的正文**')
+        self.assertTrue(post.body_html.startswith('<pre class="render-fallback">&lt;script&gt;'))
+        # 过大的正文重试也一样，记下摘要值不再重新渲染
+        self.assertFalse(post.needs_render())
+
+    def test_pool_timeout_falls_back_without_blocking_the_batch(self):
+        with PoolRenderer(max_workers=1, timeout=1, function=slow_render) as renderer:
+            started = time.perf_counter()
+            with self.assertLogs('blog.renderers', 'WARNING'):
+                results = renderer.render_many(['# 一', 'slow', '# 二'])
+            self.assertLess(time.perf_counter() - started, 10)
+            self.assertEqual([result.status for result in results], ['ok', 'timeout', 'ok'])
+            self.assertEqual(results[0][:2], render_markdown('# 一'))
+            self.assertEqual(results[1].html, '<pre class="render-fallback">slow</pre>')
+            self.assertEqual(results[2][:2], render_markdown('# 二'))
+            # 刚超时的正文在 MARKDOWN_RENDER_RETRY_AFTER 内直接返回转义后的原文
+            started = time.perf_counter()
+            self.assertEqual(renderer.render('slow').status, 'timeout')
+            self.assertLess(time.perf_counter() - started, 0.5)
+
+    def test_timeout_in_one_thread_does_not_fail_another(self):
+        with PoolRenderer(max_workers=2, timeout=2, function=slow_render) as renderer:
+            results = {}
+            slow = threading.Thread(target=lambda: results.update(slow=renderer.render('slow')))
+            with self.assertLogs('blog.renderers', 'WARNING'):
+                slow.start()
+                # 另一个线程的正文在进程池被结束时正在渲染
+                time.sleep(1.7)
+                busy = renderer.render('busy')
+                slow.join()
+        self.assertEqual(results['slow'].status, 'timeout')
+        self.assertEqual(busy, RenderResult(*render_markdown('busy'), status='ok'))
+
+    def test_failed_render_is_not_recorded_as_rendered(self):
+        with mock.patch.object(InlineRenderer, '_render', lambda self, bodies: [
+                RenderResult('<pre class="render-fallback">x</pre>', '', 'error') for body in bodies]):
+            post = self.create_post(body='# 标题')
+        self.assertTrue(post.needs_render())
+
+    def test_detail_does_not_store_failed_render(self):
+        post = self.create_post(body='# 标题')
+        Post.objects.filter(pk=post.pk).update(body_html='<p>旧的</p>', body_hash='')
+        with mock.patch.object(InlineRenderer, '_render', lambda self, bodies: [
+                RenderResult('<pre class="render-fallback">x</pre>', '', 'timeout') for body in bodies]):
+            response = self.client.get(post.get_absolute_url())
+        self.assertContains(response, 'render-fallback')
+        self.assertEqual(Post.objects.get(pk=post.pk).body_html, '<p>旧的</p>')
+
+    def test_timed_out_post_is_rendered_again_later(self):
+        renderer = InlineRenderer()
+        with mock.patch('blog.models.get_renderer', return_value=renderer), \
+                mock.patch.object(InlineRenderer, '_render', lambda self, bodies: [
+                    RenderResult('<pre class="render-fallback">x</pre>', '', 'timeout') for body in bodies]):
+            post = self.create_post(body='# 标题')
+        self.assertTrue(post.needs_render())
+        cache.clear()
+        response = self.client.get(post.get_absolute_url())
+        self.assertContains(response, render_markdown('# 标题')[0])
+        self.assertFalse(Post.objects.get(pk=post.pk).needs_render())
+
+
+class StartupTestCase(BlogTestCase):
+    def test_warm_up_primes_sidebar_cache(self):
+        self.create_post()
+        timings = warmup.warm_up()
+        self.assertEqual(list(timings), ['urls', 'templates', 'markdown', 'caches'])
+        with self.assertNumQueries(0):
+            sidebar.recent_posts(), sidebar.archives(), sidebar.categories(), sidebar.tags()
+
+    def test_wsgi_import_skips_rendering_stack(self):
+        # 在新进程中检查，当前进程里这些模块早已被其他测试导入
+        code = ('import sys, blogsite.wsgi; from django.urls import get_resolver; get_resolver().url_patterns; '
+                'print(sorted(m for m in ("markdown", "pygments", "multiprocessing") if m in sys.modules))')
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='blogsite.settings', DJANGO_WARM_UP='0')
+        output = subprocess.run([sys.executable, '-c', code], env=env, stdout=subprocess.PIPE,
+                                universal_newlines=True, check=True).stdout
+        self.assertEqual(output.strip(), '[]')
+
+    def test_profile_startup_reports_modules(self):
+        out = StringIO()
+        call_command('profile_startup', '--limit', '5', '--prefix', 'blog', '--json', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['module'], 'blogsite.wsgi')
+        self.assertTrue(report['modules'])
+        self.assertTrue(all(m['name'].startswith('blog') for m in report['modules']))
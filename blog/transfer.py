@@ -0,0 +1,296 @@
+"""
+文章的批量导入和导出，由 import_posts 和 export_posts 命令调用
+
+支持两种格式：
+    JSON Lines   每行一篇文章，{"title": ..., "body": ..., "category": "分类名", "tags": ["标签名"], ...}
+    Markdown目录 每篇文章一个 .md 文件，开头是 --- 包围的头信息，每行 "键: 值"，值是JSON（也是合法的YAML），
+                 手写的头信息里不是JSON的值按原样当作字符串（tags 按逗号分隔）；头信息之后是正文
+
+导入时按批处理，内存占用只和批大小有关：分类、标签和作者按名字解析，
+解析过的名字缓存在内存里，每批只查一次数据库；文章和标签关系都用 bulk_create 写入；
+Markdown用 blog/renderers.py 的进程池渲染。bulk_create 不发送信号，导入后统一重建计数、相关文章和侧边栏缓存
+"""
+import json
+import os
+from collections import namedtuple
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.text import slugify
+
+from . import counts, pagecache, related, sidebar
+from .models import Category, Post, Tag
+from .renderers import InlineRenderer, PoolRenderer
+from .search import get_search_backend
+
+FRONT_MATTER = '---'
+# 导出的字段，导入时除 id 外都会读取，没有的字段用默认值
+FIELDS = ['id', 'title', 'created_time', 'updated_time', 'category', 'tags', 'author', 'views', 'excerpt']
+
+ImportResult = namedtuple('ImportResult', 'posts categories tags')
+
+
+def read_jsonl(path):
+    with open(path, encoding='utf-8') as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                raise ValueError('%s 第 %d 行不是合法的JSON：%s' % (path, lineno, e))
+
+
+def parse_front_matter(text, name=''):
+    lines = text.split('\n')
+    if lines[0].strip() != FRONT_MATTER:
+        return {'body': text}
+    record = {}
+    for i, line in enumerate(lines[1:], 1):
+        if line.strip() == FRONT_MATTER:
+            record['body'] = '\n'.join(lines[i + 1:])
+            return record
+        if not line.strip():
+            continue
+        key, sep, value = line.partition(':')
+        if not sep:
+            raise ValueError('%s 的头信息第 %d 行缺少冒号' % (name, i))
+        value = value.strip()
+        try:
+            record[key.strip()] = json.loads(value)
+        except ValueError:
+            record[key.strip()] = value
+    raise ValueError('%s 的头信息没有结束标记 %s' % (name, FRONT_MATTER))
+
+
+def read_markdown_dir(path):
+    # 按文件名排序，导出的文件名以id开头，重新导入时保持原来的顺序
+    for name in sorted(os.listdir(path)):
+        if name.endswith('.md'):
+            with open(os.path.join(path, name), encoding='utf-8') as f:
+                yield parse_front_matter(f.read(), name)
+
+
+def read_records(path):
+    return read_markdown_dir(path) if os.path.isdir(path) else read_jsonl(path)
+
+
+def parse_time(value, default):
+    if not value:
+        return default
+    parsed = parse_datetime(value) if isinstance(value, str) else None
+    if parsed is None:
+        raise ValueError('无法识别的时间：%r' % value)
+    return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+
+class NameCache(object):
+    """
+    名字到id的缓存，每批需要的名字只查一次数据库；同名的有多个时取id最小的
+    create 为True时自动创建数据库里没有的名字
+    """
+
+    def __init__(self, model, field='name', create=True):
+        self.model = model
+        self.field = field
+        self.create = create
+        self.ids = {}
+        self.created = 0
+
+    def resolve(self, names):
+        missing = set(names) - self.ids.keys()
+        if missing:
+            queryset = self.model.objects.filter(**{self.field + '__in': missing}).order_by('-pk')
+            self.ids.update(queryset.values_list(self.field, 'pk'))
+            missing -= self.ids.keys()
+        if missing and not self.create:
+            raise ValueError('%s 不存在：%s' % (self.model._meta.verbose_name, '、'.join(sorted(missing))))
+        for name in sorted(missing):
+            # 新名字只有少数，逐个创建以拿到id
+            self.ids[name] = self.model.objects.create(**{self.field: name}).pk
+            self.created += 1
+        return self.ids
+
+    def __getitem__(self, name):
+        return self.ids[name]
+
+
+def tag_names(record):
+    """
+    文章的标签名列表。手写头信息里 tags 不是JSON时是字符串，按逗号分隔，"tags: python" 即一个标签
+    """
+    tags = record.get('tags') or []
+    if isinstance(tags, str):
+        tags = tags.replace('，', ',').split(',')
+    if not isinstance(tags, list) or not all(isinstance(name, str) for name in tags):
+        raise ValueError('文章《%s》的标签应为字符串或字符串列表：%r' % (record.get('title'), tags))
+    return [name.strip() for name in tags if name.strip()]
+
+
+def batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Importer(object):
+    def __init__(self, author=None, batch_size=500, jobs=1, render=True):
+        self.default_author = author
+        self.batch_size = batch_size
+        self.jobs = jobs
+        self.render = render
+        self.categories = NameCache(Category)
+        self.tags = NameCache(Tag)
+        self.authors = NameCache(User, 'username', create=False)
+        self.search = get_search_backend()
+        self.imported = 0
+
+    def run(self, records):
+        # 单篇过大或渲染超时的文章先导入转义后的原文，见 blog/renderers.py
+        renderer = PoolRenderer(max_workers=self.jobs) if self.jobs > 1 else InlineRenderer()
+        try:
+            with renderer:
+                for batch in batches(records, self.batch_size):
+                    self.import_batch(batch, renderer)
+        finally:
+            # 中途出错时已提交的批次也要重建计数和相关文章，不能等重新导入
+            if self.imported:
+                finish_import(self.jobs)
+        return ImportResult(self.imported, self.categories.created, self.tags.created)
+
+    def import_batch(self, records, renderer):
+        now = timezone.now()
+        posts = [self.build_post(record, now) for record in records]
+        if self.render:
+            for post, result in zip(posts, renderer.render_many([post.body for post in posts])):
+                post.render_body(result)
+
+        with transaction.atomic():
+            self.categories.resolve(record['category'] for record in records)
+            self.tags.resolve(name for record in records for name in record['tags'])
+            self.authors.resolve(record.get('author') or self.default_author for record in records)
+            for post, record in zip(posts, records):
+                post.category_id = self.categories[record['category']]
+                post.author_id = self.authors[record.get('author') or self.default_author]
+            self.insert_posts(posts)
+            Post.tags.through.objects.bulk_create([
+                Post.tags.through(post_id=post.pk, tag_id=self.tags[name])
+                for post, record in zip(posts, records) for name in set(record['tags'])
+            ], batch_size=self.batch_size)
+            for post in posts:
+                self.search.index_post(post)
+        self.imported += len(posts)
+
+    def build_post(self, record, now):
+        if not record.get('title') or not record.get('category'):
+            raise ValueError('文章缺少标题或分类：%r' % (record.get('title') or record.get('body', '')[:30]))
+        if not record.get('author') and not self.default_author:
+            raise ValueError('文章《%s》没有作者，请用 --author 指定默认作者' % record['title'])
+        record['tags'] = tag_names(record)
+        created_time = parse_time(record.get('created_time'), now)
+        return Post(
+            title=record['title'],
+            body=record.get('body', ''),
+            excerpt=record.get('excerpt') or '',
+            created_time=created_time,
+            updated_time=parse_time(record.get('updated_time'), created_time),
+            views=record.get('views') or 0,
+        )
+
+    @staticmethod
+    def insert_posts(posts):
+        if connection.features.can_return_ids_from_bulk_insert:
+            Post.objects.bulk_create(posts)
+            return
+        # SQLite的bulk_create拿不到新文章的id，写标签关系时要用。AutoField建表时带AUTOINCREMENT，
+        # 在事务里把 sqlite_sequence 往后推，预留一段id：UPDATE 先拿到写锁，并发的写入不会拿到同样的id，
+        # 也不会像按最大id分配那样重新用到已删除文章的id
+        table = Post._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE sqlite_sequence SET seq = seq + %s WHERE name = %s', [len(posts), table])
+            if not cursor.rowcount:
+                cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, len(posts)])
+            cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+            last_pk = cursor.fetchone()[0]
+        for pk, post in enumerate(posts, last_pk - len(posts) + 1):
+            post.pk = pk
+        Post.objects.bulk_create(posts)
+
+
+def finish_import(jobs=1):
+    """
+    bulk_create 不发送信号，导入后重建信号原本会维护的数据
+    """
+    counts.rebuild()
+    related.rebuild(jobs=jobs)
+    sidebar.invalidate()
+    pagecache.bump('list', 'sidebar')
+
+
+def export_records(batch_size=500):
+    """
+    按id顺序逐批导出全部文章，每批只查文章和标签关系两次；分类、标签和作者的名字事先一次性读入
+    """
+    categories = dict(Category.objects.values_list('pk', 'name'))
+    tags = dict(Tag.objects.values_list('pk', 'name'))
+    authors = dict(User.objects.values_list('pk', 'username'))
+    last_pk = 0
+    while True:
+        rows = list(Post.objects.filter(pk__gt=last_pk).order_by('pk').values(
+            'id', 'title', 'body', 'excerpt', 'created_time', 'updated_time', 'category_id', 'author_id', 'views',
+        )[:batch_size])
+        if not rows:
+            return
+        post_tags = {}
+        for post_id, tag_id in Post.tags.through.objects.filter(post_id__in=[row['id'] for row in rows]) \
+                .order_by('pk').values_list('post_id', 'tag_id'):
+            post_tags.setdefault(post_id, []).append(tags[tag_id])
+        for row in rows:
+            yield {
+                'id': row['id'],
+                'title': row['title'],
+                'created_time': row['created_time'].isoformat(),
+                'updated_time': row['updated_time'].isoformat(),
+                'category': categories[row['category_id']],
+                'tags': post_tags.get(row['id'], []),
+                'author': authors[row['author_id']],
+                'views': row['views'],
+                'excerpt': row['excerpt'],
+                'body': row['body'],
+            }
+        last_pk = rows[-1]['id']
+
+
+def write_jsonl(records, path):
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False))
+            f.write('\n')
+            count += 1
+    return count
+
+
+def markdown_filename(record):
+    slug = slugify(record['title'], allow_unicode=True)[:50]
+    return '%06d-%s.md' % (record['id'], slug) if slug else '%06d.md' % record['id']
+
+
+def write_markdown_dir(records, path):
+    os.makedirs(path, exist_ok=True)
+    count = 0
+    for record in records:
+        lines = [FRONT_MATTER]
+        lines.extend('%s: %s' % (field, json.dumps(record[field], ensure_ascii=False)) for field in FIELDS)
+        lines.append(FRONT_MATTER)
+        with open(os.path.join(path, markdown_filename(record)), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n' + record['body'])
+        count += 1
+    return count
@@ -1,6 +1,7 @@
 from django.urls import path
 from . import views
-from .feeds import AllPostRssFeed
+from .feeds import AllPostRssFeed, CategoryPostRssFeed, TagPostRssFeed
+from .pagecache import feed_versions, page_cache
 
 app_name = 'blog'
 urlpatterns = [
@@ -9,6 +10,9 @@ urlpatterns = [
     path('archives/<str:year>/<str:month>', views.ArchivesView.as_view(), name='archives'),
     path('category/<int:pk>', views.CategoryView.as_view(), name='category'),
     path('tag/<int:pk>', views.TagView.as_view(), name='tag'),
-    path('search/', views.search, name='search'),
-    path('all/rss', AllPostRssFeed(), name='rss'),
+    path('search/', views.SearchView.as_view(), name='search'),
+    path('all/rss', page_cache(feed_versions)(AllPostRssFeed()), name='rss'),
+    path('category/<int:pk>/rss', page_cache(feed_versions)(CategoryPostRssFeed()), name='category_rss'),
+    path('tag/<int:pk>/rss', page_cache(feed_versions)(TagPostRssFeed()), name='tag_rss'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
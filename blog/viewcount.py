@@ -0,0 +1,107 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+
+logger = logging.getLogger(__name__)
+
+
+class ViewCountBuffer(object):
+    """
+    文章阅读量的写回缓冲
+    每次访问只在内存里累加，由后台线程每隔 VIEW_COUNT_FLUSH_INTERVAL 秒
+    用 views = views + n 的原子更新批量写回数据库，进程退出时也会写回一次，
+    这样详情页的请求本身不会再产生任何写操作
+    """
+
+    def __init__(self):
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._worker = None
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # fork出来的子进程（gunicorn --preload、进程池）里没有父进程的后台线程，锁也可能正被父进程的线程持有；
+        # 缓冲中的阅读量由父进程写回，子进程从空的缓冲开始，下次累加时重新启动后台线程
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'VIEW_COUNT_FLUSH_INTERVAL', 10)
+
+    def incr(self, pk, n=1):
+        with self._lock:
+            self._pending[pk] += n
+        self._ensure_worker()
+
+    def pending(self, pk):
+        with self._lock:
+            return self._pending[pk]
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+
+    def flush(self):
+        """
+        把缓冲的阅读量写回数据库，返回写回的文章数量
+        """
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+        if not pending:
+            return 0
+        # 增量相同的文章合并成一条UPDATE语句
+        by_increment = defaultdict(list)
+        for pk, n in pending.items():
+            by_increment[n].append(pk)
+        Post = apps.get_model('blog', 'Post')
+        try:
+            with transaction.atomic():
+                for n, pks in by_increment.items():
+                    Post.objects.filter(pk__in=pks).update(views=F('views') + n)
+        except Exception:
+            # 写回失败时把增量放回缓冲区，等下一次再写
+            with self._lock:
+                self._pending.update(pending)
+            raise
+        return len(pending)
+
+    def _ensure_worker(self):
+        if self._worker is not None or not self.flush_interval:
+            return
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='view-count-flusher', daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('阅读量写回数据库失败')
+            finally:
+                # 后台线程使用的是自己的数据库连接，用完及时关闭
+                connection.close()
+
+
+view_counter = ViewCountBuffer()
+
+
+@atexit.register
+def _flush_on_exit():
+    try:
+        view_counter.flush()
+    except Exception:
+        logger.exception('进程退出时阅读量写回数据库失败')
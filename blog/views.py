@@ -1,20 +1,68 @@
-import markdown
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import Http404, JsonResponse
 from django.shortcuts import render, get_object_or_404
+from django.utils.decorators import method_decorator
 from comments.forms import CommentForm
+from comments.models import Comment
 from .models import Post, Category, Tag
 from django.views.generic import ListView, DetailView
 from django.conf import settings
-from django.utils.text import slugify
-from markdown.extensions.toc import TocExtension
-from django.db.models import Q
+from django.utils.http import urlencode
+from .counts import month_range
+from .metrics import metrics
+from .pagecache import list_versions, page_cache, post_versions
+from . import sidebar
+from .paginators import CountedPaginator, CursorPage, CursorPaginator
+from .related import related_for
+from .search import SearchResults, get_search_backend
+from .viewcount import view_counter
 
 
+def with_list_relations(queryset, *keep):
+    # 评论数直接读文章上的comment_count字段，列表模板用不到正文，不加载正文这些大字段
+    return queryset.select_related('category', 'author').summaries(*keep)
+
+
+# 列表页（包括归档、分类、标签和搜索这些子类）对匿名读者整页缓存，见 blog/pagecache.py
+@method_decorator(page_cache(list_versions), name='dispatch')
 class IndexView(ListView):
     model = Post
     template_name = 'blog/index.html'
     context_object_name = 'posts'
     # 指定paginate_by属性后开启分页功能，其值代表每一页包含多少篇文章
     paginate_by = settings.PAGE_NUM
+    # 分页方式：'offset' 为按页码分页，'cursor' 为按 (created_time, id) 游标分页，深翻页时开销不变
+    pagination_mode = getattr(settings, 'PAGINATION_MODE', 'offset')
+    # 分页总数取自物化的计数，列表页只需要一次查询本页文章
+    paginator_class = CountedPaginator
+
+    def listing_count(self):
+        """
+        这个列表的文章总数，子类按各自的过滤条件覆写，返回None时由分页器执行COUNT(*)
+        """
+        return sidebar.post_count()
+
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs):
+        return self.paginator_class(
+            queryset, per_page, orphans=orphans, allow_empty_first_page=allow_empty_first_page,
+            count=self.listing_count(), **kwargs)
+
+    def paginate_queryset(self, queryset, page_size):
+        if self.pagination_mode != 'cursor':
+            return super().paginate_queryset(queryset, page_size)
+        paginator = CursorPaginator(
+            queryset, page_size,
+            count_key='blog:listing_count:%s' % self.request.path,
+            count_timeout=getattr(settings, 'PAGINATION_COUNT_TIMEOUT', 300),
+            count=self.listing_count(),
+        )
+        page = paginator.page(after=self.request.GET.get('after'), before=self.request.GET.get('before'))
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_queryset(self):
+        # 列表模板要显示每篇文章的分类和作者，
+        # 这里一次性把分类和作者join进来，避免渲染每篇文章时再各查一次数据库
+        return with_list_relations(super().get_queryset())
 
     def get_context_data(self, **kwargs):
         """
@@ -49,6 +97,13 @@ class IndexView(ListView):
         if not is_paginated:
             # 如果没有分页，则无需显示分页条，不用任何分页导航条的数据，因此返回一个空的字典
             return {}
+        if isinstance(page, CursorPage):
+            # 游标分页只能前后翻页，不显示页码列表
+            return {
+                'cursor_pagination': True,
+                'next_cursor': page.next_cursor(),
+                'previous_cursor': page.previous_cursor(),
+            }
         # # 当前页左边连续的页码号，初始值为空
         # left = []
         # # 当前页右边连续的页码号，初始值为空
@@ -162,7 +217,13 @@ class IndexView(ListView):
 #
 #     return render(request, 'blog/detail.html', {'post': post, 'form': form, 'comment_list': comment_list})
 
+def count_cached_view(request, pk):
+    # 命中页面缓存时视图不会执行，在这里给文章记一次阅读量
+    view_counter.incr(pk)
+
+
 # 类视图
+@method_decorator(page_cache(post_versions, on_hit=count_cached_view), name='dispatch')
 class PostDetailView(DetailView):
     # 这些含义和ListView是一样的
     model = Post
@@ -184,14 +245,18 @@ class PostDetailView(DetailView):
     def get_object(self, queryset=None):
         # 覆写get_object方法的目的是因为需要对post的body值进行渲染
         post = super(PostDetailView, self).get_object(queryset=None)
-        md = markdown.Markdown(extensions=[
-            'markdown.extensions.extra',
-            'markdown.extensions.codehilite',
-            TocExtension(slugify=slugify)
-        ])
-        post.body = md.convert(post.body)
-        # 插入侧边文章目录
-        post.toc = md.toc
+        # 正文的HTML和目录在保存文章时已经渲染好了，
+        # 只有历史数据或者扩展列表变化后还没有重新渲染的文章才需要在这里渲染一次并保存下来
+        # 超时或出错时返回的是转义后的原文，不写回数据库，免得每次访问这篇文章都多一次写入
+        if post.needs_render() and post.render_body().status == 'ok':
+            Post.objects.filter(pk=post.pk).update(
+                body_html=post.body_html,
+                toc_html=post.toc_html,
+                body_hash=post.body_hash,
+                excerpt=post.excerpt,
+            )
+            # update() 不发送信号，索引是用渲染后的HTML建立的，这里一起更新
+            get_search_backend().index_post(post)
         return post
 
     def get_context_data(self, **kwargs):
@@ -199,10 +264,14 @@ class PostDetailView(DetailView):
         # 还要把评论表单、post下的评论列表传递给模板
         context = super(PostDetailView, self).get_context_data(**kwargs)
         form = CommentForm()
-        comment_list = self.object.comment_set.all()
+        # 只取第一页评论，后面的评论由页面上的“加载更多”按需请求
+        comment_list, next_comment_cursor = Comment.objects.page(self.object)
         context.update({
             'form': form,
-            'comment_list': comment_list
+            'comment_list': comment_list,
+            'next_comment_cursor': next_comment_cursor,
+            # 相关文章是预先计算好的，按相似度一次索引查询取出，见 blog/related.py
+            'related_posts': related_for(self.object),
         })
         return context
 
@@ -217,10 +286,15 @@ class PostDetailView(DetailView):
 # 类视图
 class ArchivesView(IndexView):
     def get_queryset(self):
-        return super(ArchivesView, self).get_queryset().filter(
-            created_time__year=self.kwargs.get('year'),
-            created_time__month=self.kwargs.get('month'),
-        )
+        # 用创建时间的范围过滤而不是 created_time__year/month，这样才能用上created_time上的索引
+        try:
+            start, end = month_range(int(self.kwargs.get('year')), int(self.kwargs.get('month')))
+        except (ValueError, OverflowError):
+            raise Http404('无效的归档日期')
+        return super(ArchivesView, self).get_queryset().filter(created_time__gte=start, created_time__lt=end)
+
+    def listing_count(self):
+        return sidebar.archive_count(int(self.kwargs.get('year')), int(self.kwargs.get('month')))
 
 
 # 分类查找
@@ -231,23 +305,65 @@ class ArchivesView(IndexView):
 # 类视图
 class CategoryView(IndexView):
     def get_queryset(self):
-        cate = get_object_or_404(Category, pk=self.kwargs.get('pk'))
-        return super(CategoryView, self).get_queryset().filter(category=cate)
+        # 有文章的分类在侧边栏缓存里，不用再查一次分类表
+        pk = int(self.kwargs.get('pk'))
+        self.category = sidebar.category(pk) or get_object_or_404(Category, pk=pk)
+        return super(CategoryView, self).get_queryset().filter(category=self.category)
+
+    def listing_count(self):
+        return self.category.num_posts
 
 
 # 标签云
 class TagView(IndexView):
     def get_queryset(self):
-        tag = get_object_or_404(Tag, pk=self.kwargs.get('pk'))
-        return super(TagView, self).get_queryset().filter(tags=tag)
+        pk = int(self.kwargs.get('pk'))
+        self.tag = sidebar.tag(pk) or get_object_or_404(Tag, pk=pk)
+        return super(TagView, self).get_queryset().filter(tags=self.tag)
+
+    def listing_count(self):
+        return self.tag.num_posts
 
 
 # 搜索
-def search(request):
-    q = request.GET.get('q')
-    error_msg = ''
-    if not q:
-        error_msg = '请输入关键词'
-        return render(request, 'blog/index.html', {'error_msg': error_msg})
-    posts = Post.objects.filter(Q(title__icontains=q) | Q(body__icontains=q))
-    return render(request, 'blog/index.html', {'error_msg': error_msg, 'posts': posts})
+# def search(request):
+#     q = request.GET.get('q')
+#     error_msg = ''
+#     if not q:
+#         error_msg = '请输入关键词'
+#         return render(request, 'blog/index.html', {'error_msg': error_msg})
+#     posts = Post.objects.filter(Q(title__icontains=q) | Q(body__icontains=q))
+#     return render(request, 'blog/index.html', {'error_msg': error_msg, 'posts': posts})
+# 类视图，使用全文索引检索，结果按相关度排序并和首页一样分页
+class SearchView(IndexView):
+    # 搜索结果按相关度排序，不能使用按时间的游标分页
+    pagination_mode = 'offset'
+
+    def get(self, request, *args, **kwargs):
+        self.q = request.GET.get('q', '').strip()
+        if not self.q:
+            return render(request, 'blog/index.html', {'error_msg': '请输入关键词'})
+        return super(SearchView, self).get(request, *args, **kwargs)
+
+    def get_queryset(self):
+        # 搜索结果的摘录从正文HTML中截取
+        return SearchResults(get_search_backend(), self.q, with_list_relations(Post.objects.all(), 'body_html'))
+
+    def listing_count(self):
+        # 搜索结果的总数由搜索后端计算
+        return None
+
+    def get_context_data(self, **kwargs):
+        context = super(SearchView, self).get_context_data(**kwargs)
+        # 分页链接需要带上搜索关键词
+        context.update({
+            'q': self.q,
+            'query_string': urlencode({'q': self.q}),
+        })
+        return context
+
+
+# 进程内的性能计数器、缓存命中率和抽样请求的耗时直方图，仅管理员可见
+@staff_member_required
+def metrics_view(request):
+    return JsonResponse(metrics.report())
@@ -0,0 +1,81 @@
+"""
+新进程的预热：在接收第一个请求之前把第一个请求才会做的事情先做掉
+
+    加载URL配置（导入全部视图、表单、RSS）
+    编译常用模板（DEBUG=False时Django使用缓存的模板加载器，编译结果会一直留在进程里）
+    导入Markdown、各扩展和Pygments，渲染一段带代码块的示例，Pygments的词法分析器和格式化器也一并加载
+    填充侧边栏缓存，检查全文索引表是否存在
+
+由 blogsite/wsgi.py 在 WARM_UP_ON_START 为True时调用。
+预热结束时关闭数据库连接，gunicorn --preload 在主进程中预热后fork出的worker不会共用连接
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+# 列表页、详情页和评论列表使用的模板，base.html 由它们继承时一起编译
+TEMPLATES = ['blog/index.html', 'blog/detail.html', 'comments/comment_items.html']
+# 预热时渲染的示例，覆盖目录、表格和代码高亮
+SAMPLE_MARKDOWN = '[TOC]\n\n# 标题\n\n| a | b |\n|---|---|\n| 1 | 2 |\n\n```python\ndef f():\n    return 1\n```\n'
+
+
+def load_urls():
+    from django.urls import get_resolver
+    get_resolver().url_patterns
+
+
+def compile_templates():
+    from django.template.loader import get_template
+    for name in TEMPLATES:
+        get_template(name)
+
+
+def load_markdown():
+    # 直接在当前进程中渲染，不经过渲染服务的进程池
+    from .rendering import render_markdown
+    render_markdown(SAMPLE_MARKDOWN)
+
+
+def prime_caches():
+    from . import sidebar
+    from .search import Fts5SearchBackend
+    sidebar.recent_posts()
+    sidebar.archives()
+    sidebar.categories()
+    sidebar.tags()
+    Fts5SearchBackend.is_available()
+
+
+STEPS = [
+    ('urls', load_urls),
+    ('templates', compile_templates),
+    ('markdown', load_markdown),
+    ('caches', prime_caches),
+]
+
+
+def warm_up():
+    """
+    依次执行预热的各个步骤，返回 {步骤名: 耗时（秒）}
+    数据库还没有迁移等原因导致某一步失败时只记录日志，不影响进程启动
+    """
+    timings = {}
+    for name, step in STEPS:
+        started = time.perf_counter()
+        try:
+            step()
+        except DatabaseError:
+            logger.warning('预热步骤 %s 访问数据库失败，跳过', name, exc_info=True)
+        timings[name] = time.perf_counter() - started
+    connections.close_all()
+    logger.info('预热完成：%s', ', '.join('%s %.1fms' % (name, seconds * 1000) for name, seconds in timings.items()))
+    return timings
+
+
+def warm_up_on_start():
+    if getattr(settings, 'WARM_UP_ON_START', False):
+        warm_up()
@@ -0,0 +1,88 @@
+"""
+数据库连接配置和主从路由
+"""
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+_state = threading.local()
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    connection_created 信号处理函数，给新建的SQLite连接设置 SQLITE_PRAGMAS
+    """
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', {})
+    if connection.settings_dict['NAME'] == ':memory:' or 'mode=memory' in str(connection.settings_dict['NAME']):
+        # 内存数据库（比如测试数据库）不支持WAL
+        pragmas = {name: value for name, value in pragmas.items() if name != 'journal_mode'}
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+
+
+def is_pinned():
+    return getattr(_state, 'pinned', 0) > 0
+
+
+@contextmanager
+def use_primary():
+    """
+    在这个上下文中所有读查询都走主库，用于写入之后需要立即读到结果的地方
+    """
+    _state.pinned = getattr(_state, 'pinned', 0) + 1
+    try:
+        yield
+    finally:
+        _state.pinned -= 1
+
+
+class PrimaryReplicaRouter:
+    """
+    写入总是走主库 default；读取在没有固定到主库时随机选择一个 DATABASE_REPLICAS 中的副本
+    没有配置副本时所有查询都走主库
+    """
+
+    def db_for_read(self, model, **hints):
+        replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+        if not replicas or is_pinned():
+            return 'default'
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # 主库和副本是同一份数据
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # 副本的表结构从主库同步过来
+        return db == 'default'
+
+
+class PrimaryPinningMiddleware:
+    """
+    决定一个请求能否从副本读取：
+    只有匿名读者的GET/HEAD请求（首页、文章详情、RSS、标签页等）读副本；
+    发表评论等写请求、后台管理和带会话cookie的请求全部走主库，保证读到自己刚写入的数据
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if self.reads_from_replica(request):
+            return self.get_response(request)
+        with use_primary():
+            return self.get_response(request)
+
+    @staticmethod
+    def reads_from_replica(request):
+        return (request.method in ('GET', 'HEAD')
+                and settings.SESSION_COOKIE_NAME not in request.COOKIES
+                and not request.path.startswith('/admin/'))
@@ -22,11 +22,10 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 SECRET_KEY = '9tuvnf*i-o#f_2)&$p^0gw^p9s@7($-1-_^orsvxiu8h+i7$+4'
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# 部署时通过环境变量关闭调试，例如 DJANGO_DEBUG=0 DJANGO_ALLOWED_HOSTS=127.0.0.1,localhost,.zmrenwu.com
+DEBUG = os.environ.get('DJANGO_DEBUG', '1').lower() in ('1', 'true', 'yes', 'on')
 
-ALLOWED_HOSTS = []
-# DEBUG = False
-# ALLOWED_HOSTS = ['127.0.0.1', 'localhost ', '.zmrenwu.com']
+ALLOWED_HOSTS = [host.strip() for host in os.environ.get('DJANGO_ALLOWED_HOSTS', '').split(',') if host.strip()]
 # Application definition
 # ALLOWED_HOSTS 是允许访问的域名列表，127.0.0.1 和 localhost 是本地访问的域名，.zmrenwu.com 是访问服务器的域名（换成你自己的域名）。域名前加一个点表示允许访问该域名下的子域名，比如 www.zmrenwu.com、test.zmrenwu.com 等二级域名同样允许访问。如果不加前面的点则只允许访问 zmrenwu.com。
 INSTALLED_APPS = [
@@ -37,11 +36,13 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'blog.apps.BlogConfig',
-    'comments',  # 注册新创建的comments应用
+    'comments.apps.CommentsConfig',  # 注册新创建的comments应用
 ]
 
 MIDDLEWARE = [
+    'blog.instrumentation.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'blogsite.db.PrimaryPinningMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -54,7 +55,8 @@ ROOT_URLCONF = 'blogsite.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # 在Django模板引擎的基础上记录模板渲染耗时，见 blog/instrumentation.py
+        'BACKEND': 'blog.instrumentation.TimedDjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')]
         ,
         'APP_DIRS': True,
@@ -74,11 +76,53 @@ WSGI_APPLICATION = 'blogsite.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
 
+# 持久连接的秒数，0表示每个请求结束后关闭连接，None表示永不关闭
+CONN_MAX_AGE = int(os.environ.get('DJANGO_CONN_MAX_AGE', 60))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'NAME': os.environ.get('DJANGO_DB_NAME', os.path.join(BASE_DIR, 'db.sqlite3')),
+        'CONN_MAX_AGE': CONN_MAX_AGE,
+    }
+}
+
+# 只读副本：设置 DJANGO_DB_REPLICA_NAME 后，匿名读者的GET请求从副本读取，写入和其他请求都走主库
+# 副本的数据同步由部署负责（比如用litestream或定时复制主库文件），本地测试可以直接用两个SQLite文件
+if os.environ.get('DJANGO_DB_REPLICA_NAME'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ['DJANGO_DB_REPLICA_NAME'],
+        'CONN_MAX_AGE': CONN_MAX_AGE,
+        # 测试时副本指向主库的测试数据库，避免读不到刚写入的数据
+        'TEST': {'MIRROR': 'default'},
     }
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['blogsite.db.PrimaryReplicaRouter']
+
+# 每个SQLite连接建立时执行的PRAGMA：WAL模式下读写互不阻塞，synchronous=NORMAL在WAL模式下仍然安全
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -20000,
+    'temp_store': 'MEMORY',
+    'mmap_size': 134217728,
+}
+
+# 缓存，侧边栏等数据缓存在这里
+# 多进程部署时请换成memcached等所有进程共享的缓存，否则各进程的缓存无法被同时删除
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # 代码块高亮结果的持久缓存，重启和多进程之间共享，见 blog/rendering.py
+    'highlight': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'highlight'),
+        'TIMEOUT': None,
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    },
 }
 
 # Password validation
@@ -118,3 +162,53 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 PAGE_NUM = 1
+# 阅读量缓冲写回数据库的间隔（秒），设为0则不启动后台线程，只在进程退出时写回
+VIEW_COUNT_FLUSH_INTERVAL = 10
+# 侧边栏缓存的过期时间（秒），None表示永不过期，依靠信号删除缓存
+SIDEBAR_CACHE_TIMEOUT = None
+# 列表页分页方式：'offset' 按页码分页，'cursor' 按发布时间游标分页（深翻页不变慢，适合爬虫大量抓取）
+PAGINATION_MODE = 'offset'
+# 游标分页时文章总数的缓存时间（秒）
+PAGINATION_COUNT_TIMEOUT = 300
+# 匿名读者整页缓存的过期时间（秒），内容变化时缓存会立即失效，过期时间只影响阅读量等数字的刷新
+PAGE_CACHE_ENABLED = True
+PAGE_CACHE_TIMEOUT = 600
+# RSS中输出的最新文章数量
+FEED_ITEM_LIMIT = 20
+# 文章详情页每次加载的评论数量
+COMMENTS_PER_PAGE = 20
+# 评论写入队列：开启后评论先写入本地的SQLite日志文件，由后台线程批量写入数据库
+COMMENT_QUEUE_ENABLED = False
+COMMENT_QUEUE_PATH = os.path.join(BASE_DIR, 'comment_queue.sqlite3')
+COMMENT_QUEUE_FLUSH_INTERVAL = 2
+COMMENT_QUEUE_BATCH_SIZE = 100
+# 评论频率限制：同一IP或邮箱在窗口时间（秒）内最多发表的评论数，设为0不限制
+COMMENT_RATE_LIMIT = 5
+COMMENT_RATE_LIMIT_WINDOW = 60
+# build_static_site 命令生成静态页面的目录
+STATIC_SITE_ROOT = os.path.join(BASE_DIR, 'site')
+# 记录性能数据的请求比例（0到1），被抽中的请求计入 /metrics/ 的直方图
+PERF_SAMPLE_RATE = 1.0 if DEBUG else 0.01
+# 是否在被抽中的请求上返回 Server-Timing 响应头，头里有数据库和模板的耗时，默认只在开发时返回
+PERF_SERVER_TIMING = DEBUG
+# 代码块高亮结果的进程内LRU缓存大小，以及持久缓存使用的CACHES别名（设为None只用进程内缓存）
+HIGHLIGHT_CACHE_SIZE = 1024
+HIGHLIGHT_CACHE_ALIAS = 'highlight'
+# Markdown渲染服务，见 blog/renderers.py：'pool' 在进程池中渲染（有超时），'inline' 在请求线程中渲染
+# 进程池只处理保存文章和详情页补渲染，子进程数不用太多；批量渲染的命令用 --jobs 指定自己的进程数
+MARKDOWN_RENDERER = 'pool'
+MARKDOWN_RENDER_WORKERS = 2
+# 单篇渲染的超时时间（秒）和正文长度上限（字符），超过时显示转义后的原文
+MARKDOWN_RENDER_TIMEOUT = 5
+MARKDOWN_MAX_BODY_SIZE = 1024 * 1024
+# 渲染超时的正文在这段时间（秒）内不再重试
+MARKDOWN_RENDER_RETRY_AFTER = 600
+# 相关文章：每篇文章保存的数量，每个标签/分类取的候选文章数，分类和标题中的词相对于标签的权重
+# 修改后运行 python manage.py rebuild_related_posts 重新计算
+RELATED_POSTS_COUNT = 5
+RELATED_POSTS_CANDIDATES = 200
+RELATED_POSTS_CATEGORY_WEIGHT = 0.5
+RELATED_POSTS_TITLE_WEIGHT = 0.0
+# 进程启动时（blogsite/wsgi.py）先加载URL配置、编译模板、导入Markdown和Pygments并填充侧边栏缓存，
+# 第一个请求不用再等这些，见 blog/warmup.py；默认开发时关闭，runserver的自动重载不用每次都预热
+WARM_UP_ON_START = os.environ.get('DJANGO_WARM_UP', '0' if DEBUG else '1').lower() in ('1', 'true', 'yes', 'on')
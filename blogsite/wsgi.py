@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'blogsite.settings')
 
 application = get_wsgi_application()
+
+# 接收第一个请求前先预热，见 blog/warmup.py
+from blog.warmup import warm_up_on_start  # noqa: E402
+
+warm_up_on_start()
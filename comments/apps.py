@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class CommentsConfig(AppConfig):
     name = 'comments'
+
+    def ready(self):
+        # 注册信号处理函数
+        from . import signals  # noqa: F401
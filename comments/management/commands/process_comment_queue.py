@@ -0,0 +1,21 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from comments.queue import comment_queue
+
+
+class Command(BaseCommand):
+    help = '把评论队列中的评论批量写入数据库'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='持续运行，每隔 COMMENT_QUEUE_FLUSH_INTERVAL 秒处理一次')
+
+    def handle(self, *args, **options):
+        while True:
+            count = comment_queue.drain()
+            if count:
+                self.stdout.write('写入了 %d 条评论' % count)
+            if not options['loop']:
+                return
+            time.sleep(settings.COMMENT_QUEUE_FLUSH_INTERVAL or 1)
@@ -1,4 +1,22 @@
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
+
+
+class CommentManager(models.Manager):
+    def page(self, post, after=None, per_page=None):
+        """
+        按id游标分页取某篇文章的评论，返回 (本页评论列表, 下一页的游标)，没有下一页时游标为None
+        每一页都只需要一次带索引条件的查询，与评论总数无关
+        """
+        per_page = per_page or settings.COMMENTS_PER_PAGE
+        queryset = self.filter(post=post).order_by('pk')
+        if after:
+            queryset = queryset.filter(pk__gt=after)
+        comments = list(queryset[:per_page + 1])
+        if len(comments) > per_page:
+            return comments[:per_page], comments[per_page - 1].pk
+        return comments, None
 
 
 class Comment(models.Model):
@@ -6,8 +24,11 @@ class Comment(models.Model):
     email = models.EmailField(max_length=32)
     url = models.URLField(max_length=255)
     text = models.TextField()
-    created_time = models.DateTimeField(auto_now_add=True)
+    # 不用auto_now_add：评论队列批量写入时要保留提交评论的时间，见 comments/queue.py
+    created_time = models.DateTimeField(default=timezone.now, editable=False)
     post = models.ForeignKey('blog.Post', on_delete=models.CASCADE)
 
+    objects = CommentManager()
+
     def __str__(self):
         return self.text[:20]
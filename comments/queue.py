@@ -0,0 +1,145 @@
+import atexit
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+from contextlib import closing
+
+from django.conf import settings
+from django.db import connection, router, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from blog import pagecache
+from blog.models import Post
+from .models import Comment
+
+logger = logging.getLogger(__name__)
+
+# 评论队列的日志表，存放在独立的SQLite文件中，不占用主数据库的写锁
+SCHEMA = 'CREATE TABLE IF NOT EXISTS pending (id INTEGER PRIMARY KEY AUTOINCREMENT, post_id INTEGER, payload TEXT)'
+
+
+class CommentQueue(object):
+    """
+    评论写入队列
+    post_comment 校验通过后只把评论追加到本地的SQLite日志文件里，
+    由后台线程（或 python manage.py process_comment_queue 进程）定期取出一批，
+    在一个事务中用 bulk_create 写入主数据库，再更新文章评论数并让页面缓存失效，
+    这样评论高峰时写请求不会和读请求争抢主数据库的写锁
+    日志中的评论在写入主数据库提交之后才删除，进程崩溃不会丢评论（极端情况下可能重复写入）
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._worker = None
+        self._initialized = set()
+
+    @property
+    def path(self):
+        return settings.COMMENT_QUEUE_PATH
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        if self.path not in self._initialized:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute(SCHEMA)
+            self._initialized.add(self.path)
+        return conn
+
+    def enqueue(self, post_id, data):
+        # 记下提交的时间，写入数据库时作为评论时间，而不是处理队列的时间
+        data = dict(data, created_time=timezone.now().isoformat())
+        with closing(self.connect()) as conn, conn:
+            conn.execute('INSERT INTO pending (post_id, payload) VALUES (?, ?)',
+                         [post_id, json.dumps(data, ensure_ascii=False)])
+        self._ensure_worker()
+
+    def __len__(self):
+        with closing(self.connect()) as conn:
+            return conn.execute('SELECT count(*) FROM pending').fetchone()[0]
+
+    def process(self, batch_size=None):
+        """
+        取出一批评论写入数据库，返回写入的评论数量
+        """
+        batch_size = batch_size or settings.COMMENT_QUEUE_BATCH_SIZE
+        with self._lock, closing(self.connect()) as conn:
+            # BEGIN IMMEDIATE 锁住日志文件，多个进程同时处理队列时不会取到同一批评论
+            conn.isolation_level = None
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute('SELECT id, post_id, payload FROM pending ORDER BY id LIMIT ?',
+                                    [batch_size]).fetchall()
+                if not rows:
+                    conn.execute('COMMIT')
+                    return 0
+                # 文章可能在评论排队期间被删除了，这些评论直接丢弃；副本可能有延迟，从主库确认
+                existing = set(Post.objects.using(router.db_for_write(Post)).filter(pk__in={row[1] for row in rows}).values_list('pk', flat=True))
+                comments = [self.build_comment(post_id, payload)
+                            for _, post_id, payload in rows if post_id in existing]
+                counts = Counter(comment.post_id for comment in comments)
+                with transaction.atomic():
+                    Comment.objects.bulk_create(comments)
+                    # bulk_create 不会发送信号，评论数在这里统一更新
+                    for post_id, n in counts.items():
+                        Post.objects.filter(pk=post_id).update(comment_count=F('comment_count') + n)
+                conn.execute('DELETE FROM pending WHERE id <= ?', [rows[-1][0]])
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        if counts:
+            pagecache.bump('list', *['post:%s' % post_id for post_id in counts])
+        return len(comments)
+
+    @staticmethod
+    def build_comment(post_id, payload):
+        fields = json.loads(payload)
+        # 升级前排队的评论没有提交时间，使用默认的当前时间
+        if 'created_time' in fields:
+            fields['created_time'] = parse_datetime(fields['created_time'])
+        return Comment(post_id=post_id, **fields)
+
+    def drain(self):
+        total = 0
+        while True:
+            n = self.process()
+            total += n
+            if not n:
+                return total
+
+    def _ensure_worker(self):
+        interval = settings.COMMENT_QUEUE_FLUSH_INTERVAL
+        if self._worker is not None or not interval:
+            return
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='comment-queue', daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            time.sleep(settings.COMMENT_QUEUE_FLUSH_INTERVAL)
+            try:
+                self.drain()
+            except Exception:
+                logger.exception('评论队列写入数据库失败')
+            finally:
+                connection.close()
+
+
+comment_queue = CommentQueue()
+
+
+@atexit.register
+def _drain_on_exit():
+    if comment_queue._worker is None:
+        return
+    try:
+        comment_queue.drain()
+    except Exception:
+        logger.exception('进程退出时评论队列写入数据库失败')
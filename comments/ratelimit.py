@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.cache import cache
+
+
+def client_ip(request):
+    # 部署在反向代理后面时，需要由代理（或中间件）把真实IP写入REMOTE_ADDR
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def hit(key, limit, window):
+    """
+    固定时间窗口计数，返回本次请求之后窗口内是否超过了limit次
+    """
+    if cache.add(key, 1, window):
+        return 1 > limit
+    try:
+        return cache.incr(key) > limit
+    except ValueError:
+        # 计数刚好过期被删掉了
+        cache.set(key, 1, window)
+        return False
+
+
+def is_rate_limited(request, email):
+    """
+    同一个IP或同一个邮箱在 COMMENT_RATE_LIMIT_WINDOW 秒内最多发表 COMMENT_RATE_LIMIT 条评论
+    """
+    limit = settings.COMMENT_RATE_LIMIT
+    window = settings.COMMENT_RATE_LIMIT_WINDOW
+    if not limit:
+        return False
+    by_ip = hit('comments:rate:ip:%s' % client_ip(request), limit, window)
+    by_email = hit('comments:rate:email:%s' % email.lower(), limit, window)
+    return by_ip or by_email
@@ -0,0 +1,25 @@
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from blog import pagecache
+from blog.models import Post
+from .models import Comment
+
+
+# 评论变化后，文章详情页和显示评论数的列表页缓存都需要失效
+@receiver([post_save, post_delete], sender=Comment)
+def bump_comment_versions(sender, instance, **kwargs):
+    pagecache.bump('list', 'post:%s' % instance.post_id)
+
+
+# 维护文章上的评论数
+@receiver(post_save, sender=Comment)
+def increase_comment_count(sender, instance, created, **kwargs):
+    if created:
+        Post.objects.filter(pk=instance.post_id).update(comment_count=F('comment_count') + 1)
+
+
+@receiver(post_delete, sender=Comment)
+def decrease_comment_count(sender, instance, **kwargs):
+    Post.objects.filter(pk=instance.post_id, comment_count__gt=0).update(comment_count=F('comment_count') - 1)
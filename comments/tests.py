@@ -1,3 +1,101 @@
-from django.test import TestCase
+import os
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from blog.models import Category, Post
+from blog.viewcount import view_counter
+from .models import Comment
+from .queue import comment_queue
+
+
+@override_settings(VIEW_COUNT_FLUSH_INTERVAL=0, COMMENTS_PER_PAGE=2, HIGHLIGHT_CACHE_ALIAS='default', MARKDOWN_RENDERER='inline')
+class BaseCommentTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(view_counter.clear)
+        user = User.objects.create_user('admin', 'admin@example.com', 'password')
+        category = Category.objects.create(name='Django')
+        self.post = Post.objects.create(title='标题', body='正文', author=user, category=category,
+                                        created_time=timezone.now(), updated_time=timezone.now())
+
+    def add_comments(self, n):
+        return [Comment.objects.create(name='读者', email='u@example.com', url='http://example.com',
+                                       text='评论 %d' % i, post=self.post) for i in range(n)]
+
+
+class CommentTestCase(BaseCommentTestCase):
+    def test_comment_count_follows_create_and_delete(self):
+        comments = self.add_comments(3)
+        self.assertEqual(Post.objects.get(pk=self.post.pk).comment_count, 3)
+        comments[0].delete()
+        self.assertEqual(Post.objects.get(pk=self.post.pk).comment_count, 2)
+
+    def test_detail_renders_first_page_only(self):
+        self.add_comments(5)
+        response = self.client.get(reverse('blog:detail', args=[self.post.pk]))
+        self.assertEqual([c.text for c in response.context['comment_list']], ['评论 0', '评论 1'])
+        self.assertContains(response, '共 <span>5</span> 条评论')
+        self.assertContains(response, '加载更多评论')
+
+    def test_comment_list_pages(self):
+        comments = self.add_comments(5)
+        url = reverse('comments:comment_list', args=[self.post.pk])
+        data = self.client.get(url, {'after': comments[1].pk, 'format': 'json'}).json()
+        self.assertIn('评论 2', data['html'])
+        self.assertIn('评论 3', data['html'])
+        self.assertNotIn('评论 4', data['html'])
+        data = self.client.get(data['next'] + '&format=json').json()
+        self.assertIn('评论 4', data['html'])
+        self.assertIsNone(data['next'])
+        self.assertContains(self.client.get(url), '评论 0')
+        self.assertEqual(self.client.get(reverse('comments:comment_list', args=[999])).status_code, 404)
+
+
+@override_settings(VIEW_COUNT_FLUSH_INTERVAL=0, COMMENT_QUEUE_FLUSH_INTERVAL=0, COMMENT_QUEUE_ENABLED=True)
+class CommentQueueTestCase(BaseCommentTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        patcher = override_settings(COMMENT_QUEUE_PATH=os.path.join(self.tmpdir.name, 'queue.sqlite3'))
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+
+    def post_comment(self, email='u@example.com', **extra):
+        return self.client.post(reverse('comments:post_comment', args=[self.post.pk]), {
+            'name': '读者', 'email': email, 'url': 'http://example.com', 'text': '排队的评论',
+        }, **extra)
+
+    def test_comment_is_queued_then_written_in_batch(self):
+        for i in range(3):
+            self.assertEqual(self.post_comment(email='u%d@example.com' % i).status_code, 302)
+        self.assertEqual(Comment.objects.count(), 0)
+        self.assertEqual(len(comment_queue), 3)
+        etag = self.client.get(reverse('blog:detail', args=[self.post.pk]))['ETag']
+        with self.assertNumQueries(5):
+            # 查询文章是否存在、事务保存点、批量插入、更新评论数
+            self.assertEqual(comment_queue.process(), 3)
+        self.assertEqual(len(comment_queue), 0)
+        self.assertEqual(Post.objects.get(pk=self.post.pk).comment_count, 3)
+        self.assertNotEqual(self.client.get(reverse('blog:detail', args=[self.post.pk]))['ETag'], etag)
+
+    def test_queued_comment_keeps_submission_time(self):
+        submitted = timezone.now() - timezone.timedelta(minutes=10)
+        with mock.patch('comments.queue.timezone.now', return_value=submitted):
+            self.post_comment()
+        comment_queue.process()
+        self.assertEqual(Comment.objects.get().created_time, submitted)
+
+    @override_settings(COMMENT_RATE_LIMIT=2)
+    def test_rate_limit_per_email_and_ip(self):
+        self.assertEqual(self.post_comment().status_code, 302)
+        self.assertEqual(self.post_comment().status_code, 302)
+        self.assertEqual(self.post_comment().status_code, 429)
+        self.assertEqual(self.post_comment(email='other@example.com', REMOTE_ADDR='10.0.0.1').status_code, 302)
+        self.assertEqual(self.post_comment(email='new@example.com').status_code, 429)
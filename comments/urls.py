@@ -4,4 +4,6 @@ from . import views
 app_name = 'comments'
 urlpatterns = [
     path('comment/post/<int:pk>', views.post_comment, name='post_comment'),
+    path('comment/post/<int:pk>/list', views.comment_list, name='comment_list'),
+    path('comment/csrf', views.csrf_token, name='csrf_token'),
 ]
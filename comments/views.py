@@ -1,7 +1,17 @@
+from django.conf import settings
+from django.http import Http404, HttpResponse, JsonResponse
+from django.middleware.csrf import get_token
 from django.shortcuts import render, get_object_or_404, redirect
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.http import urlencode
+from django.views.decorators.cache import never_cache
 from blog.models import Post
 from .forms import CommentForm
+from blog.pagecache import page_cache, post_versions
 from .models import Comment
+from .queue import comment_queue
+from .ratelimit import is_rate_limited
 
 
 def post_comment(request, pk):
@@ -17,6 +27,13 @@ def post_comment(request, pk):
         form = CommentForm(request.POST)
         # 当调用from.is_valid()方法时，Django自动帮我们检查表单的数据是否符合格式要求
         if form.is_valid():
+            # 同一IP或邮箱评论太频繁时拒绝
+            if is_rate_limited(request, form.cleaned_data['email']):
+                return HttpResponse('评论太频繁了，请稍后再试', status=429)
+            # 开启评论队列时只把评论放进队列，由后台批量写入数据库
+            if settings.COMMENT_QUEUE_ENABLED:
+                comment_queue.enqueue(post.pk, form.cleaned_data)
+                return redirect('blog:detail', pk=post.pk)
             # 检查到数据是合法的，调用表单的save方法保存数据到数据库
             # commit = False 的作用是仅仅利用表单的数据生Comment模型类的实例，但还不倮存评论数据到数据库
             comment = form.save(commit=False)
@@ -36,6 +53,39 @@ def post_comment(request, pk):
             # 其作用是获取这篇post下的全部评论
             # 因为Post和Comment是ForeignKey关联的
             # 因此使用post.comment_set.all()反向查询全部评论
-            comment_list = post.comment_set.all()
-            return render(request, 'blog/detail.html', {'post': post, 'form': form, 'comment_list': comment_list})
+            # 评论可能很多，这里和详情页一样只取第一页评论
+            comment_list, next_comment_cursor = Comment.objects.page(post)
+            return render(request, 'blog/detail.html', {
+                'post': post,
+                'form': form,
+                'comment_list': comment_list,
+                'next_comment_cursor': next_comment_cursor,
+            })
     return redirect('blog:detail')
+
+
+# 评论分页，详情页的“加载更多评论”按钮请求这个视图
+# 默认返回HTML片段，format=json时返回 {"html": 片段, "next": 下一页地址}
+@page_cache(post_versions)
+def comment_list(request, pk):
+    try:
+        after = int(request.GET.get('after', 0))
+    except ValueError:
+        raise Http404('无效的分页游标')
+    comments, next_cursor = Comment.objects.page(pk, after=after)
+    if not comments and not Post.objects.filter(pk=pk).exists():
+        raise Http404('文章不存在')
+    html = render_to_string('comments/comment_items.html', {'comment_list': comments}, request=request)
+    if request.GET.get('format') == 'json':
+        next_url = None
+        if next_cursor:
+            next_url = '%s?%s' % (reverse('comments:comment_list', args=[pk]), urlencode({'after': next_cursor}))
+        return JsonResponse({'html': html, 'next': next_url})
+    return HttpResponse(html)
+
+
+# 预先生成的静态页面里没有读者自己的CSRF令牌（见 blog/staticsite.py），
+# 详情页的脚本在提交评论前请求这个视图，拿到令牌的同时也设置好csrftoken cookie
+@never_cache
+def csrf_token(request):
+    return JsonResponse({'token': get_token(request)})